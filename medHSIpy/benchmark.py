@@ -0,0 +1,35 @@
+import argparse
+import tempfile
+
+from tools import benchmark_utils
+
+# Synthetic benchmarks for the hsi_utils and model hot paths.
+# Example: python benchmark.py --models cnn3d xception3d3_max --output bench.json --baseline bench_previous.json
+
+parser = argparse.ArgumentParser(description='Benchmark medHSIpy on synthetic HSI data.')
+parser.add_argument('--images', type=int, default=8, help='number of synthetic images')
+parser.add_argument('--height', type=int, default=64)
+parser.add_argument('--width', type=int, default=64)
+parser.add_argument('--bands', type=int, default=311)
+parser.add_argument('--crop', type=int, default=32, help='crop size used for the models')
+parser.add_argument('--models', nargs='*', default=benchmark_utils.DEFAULT_MODELS)
+parser.add_argument('--repeats', type=int, default=3)
+parser.add_argument('--output', default='benchmark.json')
+parser.add_argument('--baseline', default=None, help='previous results to compare against')
+parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative slowdown before reporting a regression')
+args = parser.parse_args()
+
+settings = vars(args)
+
+with tempfile.TemporaryDirectory() as dataDir:
+    results = benchmark_utils.run_suite(dataDir, args.images, args.height, args.width, args.bands, args.crop, args.models, args.repeats)
+
+benchmark_utils.save_results(args.output, results, settings)
+
+if args.baseline is not None:
+    regressions = benchmark_utils.compare_results(results, benchmark_utils.load_results(args.baseline), args.tolerance)
+    if regressions:
+        print("Regressions:", regressions)
+        raise SystemExit(1)
+
+print("Finished")
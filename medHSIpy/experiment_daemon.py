@@ -0,0 +1,68 @@
+import argparse
+import json
+
+from tools import experiment_worker
+
+# Keeps TF, segmentation_models and the datasets loaded between experiments.
+#   python experiment_daemon.py serve --preload full 1 2 3
+#   python experiment_daemon.py submit cnn3d --fold 1 --set learning_rate=0.001 --wait
+#   python experiment_daemon.py status
+#   python experiment_daemon.py shutdown
+# Clients authenticate with MEDHSI_DAEMON_KEY or the key file the daemon writes in the home directory,
+# a daemon on a non-local --host requires MEDHSI_DAEMON_KEY.
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def parse_fold(value):
+    return None if value == 'full' else int(value)
+
+if __name__ == "__main__":
+    # spawned worker processes import this module again
+    parser = argparse.ArgumentParser(description='Persistent medHSIpy experiment worker.')
+    parser.add_argument('--host', default=experiment_worker.DEFAULT_ADDRESS[0], help='other than localhost only with MEDHSI_DAEMON_KEY set')
+    parser.add_argument('--port', type=int, default=experiment_worker.DEFAULT_ADDRESS[1])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve = commands.add_parser('serve')
+    serve.add_argument('--workers', type=int, default=0, help='0 runs jobs sequentially in the daemon, N runs them in N worker processes')
+    serve.add_argument('--cache-dir', default=None, help='memory-mapped dataset cache shared by the worker processes')
+    serve.add_argument('--preload', nargs='*', type=parse_fold, default=[], help="folds to load at startup, 'full' is the default split")
+
+    submit = commands.add_parser('submit')
+    submit.add_argument('framework')
+    submit.add_argument('--fold', type=int, default=None)
+    submit.add_argument('--name', default=None)
+    submit.add_argument('--set', nargs='*', default=[], help='settings as key=value, e.g. learning_rate=0.001 numEpochs=50')
+    submit.add_argument('--wait', action='store_true')
+
+    status = commands.add_parser('status')
+    status.add_argument('id', type=int, nargs='?', default=None)
+
+    commands.add_parser('shutdown')
+    args = parser.parse_args()
+
+    address = (args.host, args.port)
+
+    if args.command == 'serve':
+        daemon = experiment_worker.ExperimentDaemon(address, numWorkers=args.workers, cacheDir=args.cache_dir)
+        if args.preload:
+            daemon.submit({"preload": args.preload})
+        daemon.serve_forever()
+
+    else:
+        with experiment_worker.ExperimentClient(address) as client:
+            if args.command == 'submit':
+                job = {"framework": args.framework, "fold": args.fold, "name": args.name}
+                job.update({k: parse_value(v) for k, v in (x.split('=', 1) for x in args.set)})
+                jobId = client.submit(job)
+                print("Submitted job", jobId)
+                if args.wait:
+                    print(json.dumps(client.wait(jobId), indent=1, default=str))
+            elif args.command == 'status':
+                print(json.dumps(client.status(args.id), indent=1, default=str))
+            elif args.command == 'shutdown':
+                print(client.shutdown())
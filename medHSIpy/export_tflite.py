@@ -0,0 +1,21 @@
+import argparse
+
+from tools import tflite_utils, train_utils
+
+# Exports registered models to TFLite and compares IoU and CPU latency against the Keras model.
+# Example: python export_tflite.py cnn3d --quantizations float16 int8 --calibration 64
+
+parser = argparse.ArgumentParser(description='Export trained medHSIpy models to TFLite with post-training quantization.')
+parser.add_argument('models', nargs='+', help='registered model names, a prefix selects the most recent entry')
+parser.add_argument('--quantizations', nargs='*', default=tflite_utils.QUANTIZATIONS, choices=tflite_utils.QUANTIZATIONS)
+parser.add_argument('--calibration', type=int, default=tflite_utils.DEFAULT_CALIBRATION_SAMPLES, help='number of calibration images for int8')
+parser.add_argument('--fold', type=int, default=None, help='cross validation fold of the calibration and test data')
+parser.add_argument('--images', type=int, default=None, help='limit the number of test images')
+args = parser.parse_args()
+
+for name in args.models:
+    print("Exporting " + name)
+    tflite_utils.export_model(name, args.quantizations, args.calibration, args.fold, args.images)
+
+train_utils.save_profile()
+print("Finished")
@@ -0,0 +1,44 @@
+import argparse
+
+from keras import backend
+
+from tools import benchmark_utils, cost_utils, hsi_segment_from_sm as segsm
+
+# Compares the cost of candidate architectures before training them.
+# Example: python model_cost.py --models cnn3d xception3d_10n sm_resnet --batch 8 --output cost_comparison.txt
+# Memory saved by recomputing every second encoder block: python model_cost.py --models cnn3d xception3d_max --recompute every2
+
+parser = argparse.ArgumentParser(description='Report parameters, FLOPs, activation memory and CPU latency of medHSIpy models.')
+parser.add_argument('--models', nargs='*', default=benchmark_utils.DEFAULT_MODELS + ['sm_resnet', 'sm_vgg'])
+parser.add_argument('--height', type=int, default=64)
+parser.add_argument('--width', type=int, default=64)
+parser.add_argument('--bands', type=int, default=311)
+parser.add_argument('--batch', type=int, default=4)
+parser.add_argument('--runs', type=int, default=10, help='number of timed batches')
+parser.add_argument('--no-latency', dest='latency', action='store_false')
+parser.add_argument('--recompute', default=None, help="recomputed encoder blocks of the 3D models: 'all' or 'everyN'")
+parser.add_argument('--details', action='store_true', help='also print the per-layer table of every model')
+parser.add_argument('--output', default=None, help='text file for the comparison table')
+args = parser.parse_args()
+
+def build_model(name):
+    if name.startswith('sm_'):
+        # the sm models take the flattened spectrum as 2D channels
+        return segsm.get_sm_model(name, args.height, args.width, args.bands, 1), (args.height, args.width, args.bands)
+    # xception3d2 has no recomputed blocks
+    builderArgs = {} if args.recompute is None or name.startswith('xception3d2') else {"checkpointPolicy": args.recompute}
+    return benchmark_utils.get_model_builder(name)(args.height, args.width, args.bands, 1, **builderArgs), (args.height, args.width, args.bands, 1)
+
+reports = {}
+for name in args.models:
+    backend.clear_session()
+    model, inputShape = build_model(name)
+    reports[name] = cost_utils.get_cost_report(model, args.batch, inputShape, args.latency, args.runs)
+    if args.details:
+        print(cost_utils.format_cost_report(reports[name]))
+
+comparison = cost_utils.format_cost_comparison(reports)
+print(comparison)
+if args.output is not None:
+    with open(args.output, 'w', encoding='utf-8') as f:
+        f.write(comparison)
@@ -0,0 +1,39 @@
+import argparse
+
+from tools import ensemble_utils, hio, eval_utils, artifact_writer, train_utils
+
+# Evaluates the fold models of a cross-validation run as one ensemble, e.g.
+#   python predict_ensemble.py cnn3d --method vote --threads 4
+#   python predict_ensemble.py cnn3d --models cnn3d_1_2024-05-02 cnn3d_2_2024-05-02 --data full
+
+parser = argparse.ArgumentParser(description='Ensemble prediction with registered medHSIpy models.')
+parser.add_argument('framework', help='framework of the fold models, also names the output folder')
+parser.add_argument('--models', nargs='*', default=None, help='registered model names, instead of all fold models of framework')
+parser.add_argument('--date', default=None, help='run date of the fold models, the most recent entry of each fold by default')
+parser.add_argument('--method', default='mean', choices=ensemble_utils.ENSEMBLE_METHODS)
+parser.add_argument('--threads', type=int, default=None, help='models run in parallel, 1 runs them one after the other')
+parser.add_argument('--tta', default=None, help="test-time transforms, a set such as 'flips' or 'd4', or a list such as 'identity,hflip'")
+parser.add_argument('--batch-size', type=int, default=32)
+parser.add_argument('--data', default='test', help="dataset to evaluate on: 'test', 'train' or 'full'")
+parser.add_argument('--fold', type=int, default=None)
+args = parser.parse_args()
+
+if args.models:
+    ensemble = ensemble_utils.EnsemblePredictor.from_registry(args.models, method=args.method, numThreads=args.threads, transforms=args.tta)
+else:
+    ensemble = ensemble_utils.load_ensemble(args.framework, runDate=args.date, method=args.method, numThreads=args.threads,
+        transforms=args.tta)
+print("Ensemble of", len(ensemble.models), "models:", ', '.join(x["name"] for x in ensemble.metadatas))
+
+x, y, names = hio.load_data(args.data, args.fold)
+folder = args.framework + '_' + ensemble.name
+session = eval_utils.EvaluationSession(x, y, names)
+session.predict(ensemble, args.batch_size)
+fpr, tpr, auc = session.calc_plot_roc(ensemble.name, folder)
+session.save_metrics(folder, [0.3, 0.5, 0.7])
+session.visualize(folder)
+print("AUC:", auc)
+
+ensemble.close()
+artifact_writer.close_writer()
+train_utils.save_profile(folder, withTrace=False)
@@ -0,0 +1,50 @@
+import argparse
+import json
+from datetime import date
+
+from tools import experiment_scheduler, train_utils
+
+# Runs a declarative list of experiments in a pool of worker processes, e.g. schedule.json:
+#   {"frameworks": ["cnn3d", "xception3d_10n"], "folds": [1, 2, 3, 4, 5],
+#    "settings": {"learning_rate": [0.001, 0.0001], "numEpochs": 100}}
+#   python schedule.py schedule.json --workers 4 --memory-mb 16000
+# Completed jobs are skipped, so the same command resumes an interrupted schedule. Job names contain the run date,
+# on another day resume with the --run-date printed at the start, or set "runDate" in the spec.
+
+if __name__ == "__main__":
+    # spawned job processes import this module again
+    parser = argparse.ArgumentParser(description='Schedule medHSIpy experiments with resource limits.')
+    parser.add_argument('spec', help='JSON file with frameworks, folds, settings and/or explicit jobs')
+    parser.add_argument('--workers', type=int, default=1, help='number of jobs running at the same time')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads per job, defaults to the CPU count / workers')
+    parser.add_argument('--memory-mb', type=float, default=None, help='kill a job whose RSS exceeds this')
+    parser.add_argument('--retries', type=int, default=1)
+    parser.add_argument('--rerun', action='store_true', help='also run jobs that already have results')
+    parser.add_argument('--cache-dir', default=None, help='memory-mapped dataset cache shared by the jobs')
+    parser.add_argument('--status-file', default=None, help='JSON file with the status of every job, updated on progress')
+    parser.add_argument('--dry-run', action='store_true', help='only list the jobs')
+    parser.add_argument('--run-date', default=None, help="date in the job names, the spec's runDate or today by default")
+    args = parser.parse_args()
+
+    spec = experiment_scheduler.load_spec(args.spec)
+    runDate = args.run_date or spec.get("runDate") or str(date.today())
+    print("Run date", runDate)
+    jobs = experiment_scheduler.expand_jobs(spec, runDate)
+
+    if args.dry_run:
+        for job in jobs:
+            print(json.dumps(job))
+        print(len(jobs), "jobs")
+        raise SystemExit(0)
+
+    scheduler = experiment_scheduler.ExperimentScheduler(jobs, args.workers, args.threads, args.memory_mb, args.retries,
+        not args.rerun, args.cache_dir, statusFile=args.status_file)
+    results = scheduler.run()
+
+    failed = [name for name, x in results.items() if x["status"] == 'failed']
+    for name in failed:
+        print("Failed:", name, results[name]["result"].get("error"))
+    train_utils.save_profile()
+    print("Finished")
+    if failed:
+        raise SystemExit(1)
@@ -2,7 +2,7 @@ from random import seed
 from datetime import date
 from keras import backend
 
-from tools import hio, train_utils, cmdl, xmdl, segsm
+from tools import hio, train_utils, cmdl, xmdl, segsm, eval_utils, artifact_writer, model_registry
 import segmentation_models as sm
 
 import tensorflow as tf
@@ -25,23 +25,25 @@ hio.show_label_montage('test')
 hio.show_label_montage('full')
 
 X_train, X_test, y_train, y_test, names_train, names_test = hio.get_train_test()
+session = eval_utils.EvaluationSession(X_test, y_test, names_test)
+registry = model_registry.get_registry()
 
 
 def get_framework(framework, xtrain, xtest, ytrain, ytest):
     if 'sm' in framework:
         prerpared_model, train_history = segsm.fit_sm_model(framework, xtrain, ytrain, xtest, ytest,
                                                             height=HEIGHT, width=WIDTH, numChannels=NUMBER_OF_CHANNELS,
-                                                            numClasses=NUMBER_OF_CLASSES, numEpochs=NUMBER_OF_EPOCHS)
+                                                            numClasses=NUMBER_OF_CLASSES, numEpochs=NUMBER_OF_EPOCHS, executionMode=train_utils.get_execution_mode(framework))
 
     elif 'cnn3d' in framework:
         prerpared_model, train_history = cmdl.get_cnn_model(framework, xtrain, ytrain, xtest, ytest,
                                                             HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES, NUMBER_OF_EPOCHS,
-                                                            64, "RMSProp", 0.0001, 0, "BCE+JC")
+                                                            64, "RMSProp", 0.0001, 0, "BCE+JC", executionMode=train_utils.get_execution_mode(framework))
 
     else:
         prerpared_model, train_history = xmdl.get_xception_model(framework, xtrain, ytrain, xtest, ytest,
                                                                  height=HEIGHT, width=WIDTH, numChannels=NUMBER_OF_CHANNELS,
-                                                                 numClasses=NUMBER_OF_CLASSES, numEpochs=NUMBER_OF_EPOCHS)
+                                                                 numClasses=NUMBER_OF_CLASSES, numEpochs=NUMBER_OF_EPOCHS, executionMode=train_utils.get_execution_mode(framework))
 
     return prerpared_model, train_history
 
@@ -58,6 +60,9 @@ flist = [
 
     # 'sm_resnet_pretrained',
 
+    # # decoder only, on cached encoder features
+    # 'sm_resnet_pretrained_frozen', 'sm_resnet_pretrained_frozen_learned',
+
     'cnn3d',
     # 'cnn3d2'
     # 'xception3d5_max', 'xception3d5_mean',
@@ -82,19 +87,24 @@ for framework in flist:
 
     folder = framework
 
-    # prepare again in order to avoid pre-processing errors
-    X_train, X_test, y_train, y_test, names_train, names_test = hio.get_train_test()
-    [fpr_, tpr_, auc_val_] = train_utils.save_evaluate_model(model, history.history, framework, folder, X_test, y_test)
+    # predict once, the session holds a frozen copy of the test set
+    session.predict(model)
+    [fpr_, tpr_, auc_val_] = session.save_evaluate(history, framework, folder)
     fpr.append(fpr_)
     tpr.append(tpr_)
     auc_val.append(auc_val_)
 
-    preds = model.predict(X_test)
-    k = 0
-    for (hsi, gt, id, pred) in zip(X_test, y_test, names_test, preds):
-        iou = sm.metrics.iou_score(gt, pred)
-        k += 1
-        train_utils.visualize(hsi, gt, pred, folder, round(iou.numpy() * 100, 2), id)
+    # keep the trained weights, reload with model_registry.load_model(framework)
+    registry.save(model, framework, HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES,
+        executionMode=train_utils.get_execution_mode(framework), metrics={"auc": auc_val_})
+
+    session.save_metrics(folder, [0.3, 0.5, 0.7])
+
+    session.visualize(folder)
 
 # ROC AUC comparison 
 train_utils.plot_roc(fpr, tpr, auc_val, flist, None)
+
+# wait for the background figure and file writes
+artifact_writer.close_writer()
+train_utils.save_profile()
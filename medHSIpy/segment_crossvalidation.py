@@ -3,7 +3,7 @@ from datetime import date
 from keras import backend
 
 
-from tools import hio, train_utils, cmdl, xmdl, segsm
+from tools import hio, train_utils, cmdl, xmdl, segsm, eval_utils, metrics_utils, artifact_writer, results_store, model_registry
 import segmentation_models as sm
 
 WIDTH = 32 #64
@@ -25,18 +25,18 @@ def get_framework(framework, xtrain, xtest, ytrain, ytest):
     if 'sm' in framework:
         model, history = segsm.fit_sm_model(framework, xtrain, ytrain, xtest, ytest, 
             HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES, NUMBER_OF_EPOCHS, 
-            "RMSProp", 0.0001, 0, "BCE+JC")
+            "RMSProp", 0.0001, 0, "BCE+JC", executionMode=train_utils.get_execution_mode(framework))
             
             
     elif 'cnn3d' in framework:
         model, history = cmdl.get_cnn_model(framework, xtrain, ytrain, xtest, ytest, 
             HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES, NUMBER_OF_EPOCHS, 
-            64, "RMSProp", 0.001, 0, "BCE+JC")
+            64, "RMSProp", 0.001, 0, "BCE+JC", executionMode=train_utils.get_execution_mode(framework))
 
     else:
         model, history = xmdl.get_xception_model(framework, xtrain, ytrain, xtest, ytest, 
             height=HEIGHT, width=WIDTH,  numChannels=NUMBER_OF_CHANNELS, 
-            numClasses=NUMBER_OF_CLASSES, numEpochs=NUMBER_OF_EPOCHS)
+            numClasses=NUMBER_OF_CLASSES, numEpochs=NUMBER_OF_EPOCHS, executionMode=train_utils.get_execution_mode(framework))
 
     return model, history
 
@@ -48,6 +48,9 @@ flist = [
  ]
 
 
+store = results_store.get_results_store()
+registry = model_registry.get_registry()
+
 for framework in flist: 
 
     fpr = [] 
@@ -57,16 +60,19 @@ for framework in flist:
     testEval = []
     history = []
     foldNames = [] 
+    pooledRoc = metrics_utils.BinnedRoc()
 
     print("Running for framework:" + framework)
 
     folds = 19
 
     baseDate = str(date.today())
+    runId = store.start_run('crossvalidation_' + framework + '_' + baseDate)
     for fold in range(1, folds+1):
         backend.clear_session()
         
         X_train, X_test, y_train, y_test, names_train, names_test = hio.get_train_test(fold)
+        session = eval_utils.EvaluationSession(X_test, y_test, names_test)
 
         dictVal = "Fold" + str(fold)
 
@@ -77,28 +83,39 @@ for framework in flist:
 
         folder = foldFramework
 
-        #prepare again in order to avoid pre-processing errors 
-        X_train, X_test, y_train, y_test, names_train, names_test = hio.get_train_test(fold)
+        # predict once, the session holds a frozen copy of the test set
+        session.predict(model)
 
-        [fpr_, tpr_, auc_val_, trainEval_, testEval_]  = train_utils.evaluate_model(model, history_, framework, folder, X_test, y_test)
+        [fpr_, tpr_, auc_val_, trainEval_, testEval_]  = session.evaluate(history_, framework, folder)
         fpr.append(fpr_)
         tpr.append(tpr_)
         auc_val.append(auc_val_)
         trainEval.append(trainEval_)
         testEval.append(testEval_)
         history.append(history_.history)
+        pooledRoc.merge(session.get_roc())
+        store.add_trial(runId, framework, {"fold": fold}, dict(testEval_, auc=auc_val_), history_.history)
+        registry.save(model, foldFramework, HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES,
+            executionMode=train_utils.get_execution_mode(framework), metrics=dict(testEval_, auc=auc_val_))
 
-        preds = model.predict(X_test)
-        k = 0
-        for (hsi, gt, id, pred) in zip(X_test, y_test, names_test, preds):
-            iou = sm.metrics.iou_score(gt, pred)
-            k += 1 
-            train_utils.visualize(hsi, gt, pred, folder, round(iou.numpy() * 100,2), id)
+        session.save_metrics(folder, [0.3, 0.5, 0.7])
+
+        session.visualize(folder)
     
     folder = framework + '_' + baseDate 
     train_utils.save_evaluate_model_folds(folder, fpr, tpr, auc_val, trainEval, testEval, history)
 
-    # ROC AUC comparison 
+    # ROC AUC comparison, with the ROC over the pixels of all folds
+    pooledFpr, pooledTpr, _ = pooledRoc.get_curve()
+    fpr.append(pooledFpr)
+    tpr.append(pooledTpr)
+    auc_val.append(pooledRoc.get_auc())
+    foldNames.append("Pooled")
     train_utils.plot_roc(fpr, tpr, auc_val, foldNames, folder)
 
+# wait for the background figure and file writes
+artifact_writer.close_writer()
+train_utils.save_profile()
+store.close()
+
 print("Finished")
\ No newline at end of file
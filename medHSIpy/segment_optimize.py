@@ -1,9 +1,10 @@
 from random import seed
 from datetime import date
+import time
 from keras import backend
 
 
-from tools import hio, train_utils, cmdl, xmdl, segsm
+from tools import hio, train_utils, cmdl, xmdl, segsm, artifact_writer, results_store
 import segmentation_models as sm
 
 WIDTH = 32 #64
@@ -25,17 +26,17 @@ def get_framework(framework, xtrain, xtest, ytrain, ytest, optimizerName, learni
     if 'sm' in framework:
         model, history = segsm.fit_sm_model(framework, xtrain, ytrain, xtest, ytest, 
             HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES, NUMBER_OF_EPOCHS, 
-            optimizerName, learning_rate, decay, lossFunction)
+            optimizerName, learning_rate, decay, lossFunction, executionMode=train_utils.get_execution_mode(framework))
             
     elif 'cnn3d' in framework:
         model, history = cmdl.get_cnn_model(framework, xtrain, ytrain, xtest, ytest, 
             HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES, NUMBER_OF_EPOCHS, 
-            64, optimizerName, learning_rate, decay, lossFunction)
+            64, optimizerName, learning_rate, decay, lossFunction, executionMode=train_utils.get_execution_mode(framework))
 
     else:
         model, history = xmdl.get_xception_model(framework, xtrain, ytrain, xtest, ytest, 
             HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES, NUMBER_OF_EPOCHS, 
-            optimizerName, learning_rate, decay, lossFunction)
+            optimizerName, learning_rate, decay, lossFunction, executionMode=train_utils.get_execution_mode(framework))
 
     return model, history
 
@@ -47,20 +48,23 @@ flist = [
  ]
 
 baseDate = str(date.today())
+store = results_store.get_results_store()
+
+# loaded once, the sm models preprocess inside the model and leave the raw arrays intact
+X_train, X_test, y_train, y_test, names_train, names_test = hio.get_train_test()
 
 for framework in flist: 
     testEval = []
     print("Running for framework:" + framework)
 
     framework = framework + '_' + baseDate 
+    runId = store.start_run('optimize_' + framework)
 
     learningRates = [0.001, 0.0001, 0.00001, 0.000001]
     exponentialDecay = [0, 1e-5, 1e-6] 
     optimizers = ["RMSProp"] #"Adam"
     lossFunctions = ["BCE", "BCE+JC"]
 
-    X_train, X_test, y_train, y_test, names_train, names_test = hio.get_train_test()
-
     folder = framework 
     counter = 0 
     for lr in learningRates:
@@ -70,11 +74,23 @@ for framework in flist:
                     backend.clear_session()
                     counter = counter + 1    
 
+                    startTime = time.time()
                     model, history_ = get_framework(framework, X_train, X_test, y_train, y_test, optz, lr, ed, lossFun)
+                    fitTime = time.time() - startTime
                     testEval_ = train_utils.get_eval_metrics_and_settings(history_.history, True, optz, lr, ed, lossFun)
 
                     testEval.append(testEval_)
 
-                    train_utils.save_performance(folder, testEval)
+                    settings = {"optimizer": optz, "learningRate": lr, "decay": ed, "lossFunction": lossFun, "executionMode": train_utils.get_execution_mode(framework)}
+                    store.add_trial(runId, framework, settings, testEval_, history_.history, {"fit": fitTime})
+
+    # the full table is written once, trials are appended to the results store as they finish
+    train_utils.save_performance(folder, testEval)
+    store.print_leaderboard('val_iou_score', runId=runId)
+
+# wait for the background figure and file writes
+artifact_writer.close_writer()
+train_utils.save_profile()
+store.close()
 
 print("Finished.")
@@ -3,7 +3,7 @@ from datetime import date
 from keras import backend
 
 
-from tools import hio, train_utils, cmdl, xmdl, segsm
+from tools import hio, train_utils, cmdl, xmdl, segsm, eval_utils, artifact_writer, model_registry
 import segmentation_models as sm
 
 WIDTH = 32 #64
@@ -25,18 +25,18 @@ def get_framework(framework, xtrain, xtest, ytrain, ytest):
     if 'sm' in framework:
         model, history = segsm.fit_sm_model(framework, xtrain, ytrain, xtest, ytest, 
             HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES, NUMBER_OF_EPOCHS, 
-            "RMSProp", 0.0001, 0, "BCE+JC")
+            "RMSProp", 0.0001, 0, "BCE+JC", executionMode=train_utils.get_execution_mode(framework))
             
             
     elif 'cnn3d' in framework:
         model, history = cmdl.get_cnn_model(framework, xtrain, ytrain, xtest, ytest, 
             HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES, NUMBER_OF_EPOCHS, 
-            64, "RMSProp", 0.0001, 0, "BCE+JC")
+            64, "RMSProp", 0.0001, 0, "BCE+JC", executionMode=train_utils.get_execution_mode(framework))
 
     else:
         model, history = xmdl.get_xception_model(framework, xtrain, ytrain, xtest, ytest, 
             height=HEIGHT, width=WIDTH,  numChannels=NUMBER_OF_CHANNELS, 
-            numClasses=NUMBER_OF_CLASSES, numEpochs=NUMBER_OF_EPOCHS)
+            numClasses=NUMBER_OF_CLASSES, numEpochs=NUMBER_OF_EPOCHS, executionMode=train_utils.get_execution_mode(framework))
 
     return model, history
 
@@ -59,36 +59,37 @@ testEval = []
 history = []
 foldNames = [] 
 baseDate = str(date.today())
+registry = model_registry.get_registry()
 
+# loaded once, the sm models preprocess inside the model and leave the raw arrays intact
+X_train, X_test, y_train, y_test, names_train, names_test = hio.get_train_test()
+session = eval_utils.EvaluationSession(X_test, y_test, names_test)
 
 for framework in flist: 
     print("Running for framework:" + framework)
     backend.clear_session()
-    
-    X_train, X_test, y_train, y_test, names_train, names_test = hio.get_train_test()
 
     foldNames.append(framework) 
 
     folder = framework
     model, history_ = get_framework(folder, X_train, X_test, y_train, y_test)
 
-    #prepare again in order to avoid pre-processing errors 
-    X_train, X_test, y_train, y_test, names_train, names_test = hio.get_train_test()
+    # predict once, the session holds a frozen copy of the test set
+    session.predict(model)
 
-    [fpr_, tpr_, auc_val_, trainEval_, testEval_]  = train_utils.evaluate_model(model, history_, framework, folder, X_test, y_test)
+    [fpr_, tpr_, auc_val_, trainEval_, testEval_]  = session.evaluate(history_, framework, folder)
     fpr.append(fpr_)
     tpr.append(tpr_)
     auc_val.append(auc_val_)
     trainEval.append(trainEval_)
     testEval.append(testEval_)
     history.append(history_.history)
+    registry.save(model, framework, HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES,
+        executionMode=train_utils.get_execution_mode(framework), metrics=dict(testEval_, auc=auc_val_))
+
+    session.save_metrics(folder, [0.3, 0.5, 0.7])
 
-    preds = model.predict(X_test)
-    k = 0
-    for (hsi, gt, id, pred) in zip(X_test, y_test, names_test, preds):
-        iou = sm.metrics.iou_score(gt, pred)
-        k += 1 
-        train_utils.visualize(hsi, gt, pred, folder, round(iou.numpy() * 100,2), id)
+    session.visualize(folder)
     
 folder = framework + '_' + baseDate 
 train_utils.save_evaluate_model_folds(folder, fpr, tpr, auc_val, trainEval, testEval, history)
@@ -96,4 +97,8 @@ train_utils.save_evaluate_model_folds(folder, fpr, tpr, auc_val, trainEval, test
 # ROC AUC comparison 
 train_utils.plot_roc(fpr, tpr, auc_val, foldNames, folder)
 
+# wait for the background figure and file writes
+artifact_writer.close_writer()
+train_utils.save_profile()
+
 print("Finished")
\ No newline at end of file
@@ -0,0 +1,34 @@
+import argparse
+
+from tools import inference_server
+
+# Serves registered models over local HTTP or a Unix socket, e.g.
+#   python serve.py cnn3d sm_resnet --port 8765
+#   python serve.py cnn3d --socket /tmp/medhsi.sock
+# and from a client:
+#   probabilities, masks = inference_server.request_prediction('cnn3d', hsi, port=8765)
+
+parser = argparse.ArgumentParser(description='Micro-batching inference server for trained medHSIpy models.')
+parser.add_argument('models', nargs='+', help='registered model names, a prefix selects the most recent entry')
+parser.add_argument('--host', default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8765)
+parser.add_argument('--socket', default=None, help='serve on this Unix socket instead of TCP')
+parser.add_argument('--max-batch', type=int, default=inference_server.DEFAULT_MAX_BATCH_SIZE)
+parser.add_argument('--max-latency-ms', type=float, default=inference_server.DEFAULT_MAX_LATENCY * 1000,
+    help='longest time an image waits for a batch to fill')
+parser.add_argument('--tta', default=None, help="test-time transforms, e.g. 'flips' or 'identity,hflip'")
+args = parser.parse_args()
+
+service = inference_server.InferenceService(args.models, maxBatchSize=args.max_batch, maxLatency=args.max_latency_ms / 1000,
+    transforms=args.tta)
+server = inference_server.get_server(service, args.host, args.port, args.socket)
+print("Listening on", args.socket if args.socket is not None else args.host + ':' + str(args.port))
+
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    pass
+finally:
+    server.server_close()
+    service.close()
+    print(service.get_stats())
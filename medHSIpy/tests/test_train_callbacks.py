@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*
+
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from keras import layers
+from keras.models import Model
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tools import train_callbacks
+
+def get_list_features(numSamples, folder):
+    # Encoder features as the feature cache returns them, one memory-mapped array per decoder input
+    rng = np.random.default_rng(0)
+    features = []
+    for i, shape in enumerate([(4, 4, 3), (8, 8, 2)]):
+        array = np.lib.format.open_memmap(os.path.join(folder, 'feature_' + str(i) + '.npy'), mode='w+',
+            dtype=np.float32, shape=(numSamples,) + shape)
+        array[:] = rng.random(array.shape, dtype=np.float32)
+        features.append(array)
+    y = (rng.random((numSamples, 8, 8, 1)) > 0.5).astype(np.float32)
+    return features, y
+
+def get_tiny_decoder():
+    deep = layers.Input((4, 4, 3))
+    skip = layers.Input((8, 8, 2))
+    x = layers.concatenate([layers.UpSampling2D()(deep), skip])
+    output = layers.Conv2D(1, (1, 1), activation='sigmoid')(x)
+    model = Model(inputs=[deep, skip], outputs=output)
+    model.compile(optimizer='adam', loss='binary_crossentropy')
+    return model
+
+class TimedBatchesTest(unittest.TestCase):
+
+    def test_list_inputs_are_sliced_per_sample(self):
+        with tempfile.TemporaryDirectory() as folder:
+            features, y = get_list_features(10, folder)
+            monitor = train_callbacks.ThroughputMonitor(4, len(y), verbose=False)
+            batches = monitor.get_batches(features, y, shuffle=False)
+            self.assertEqual(len(batches), 3)
+
+            x, yBatch = batches[2]
+            self.assertEqual([array.shape for array in x], [(2, 4, 4, 3), (2, 8, 8, 2)])
+            np.testing.assert_array_equal(x[1], features[1][8:10])
+            np.testing.assert_array_equal(yBatch, y[8:10])
+            self.assertEqual(len(monitor.fetchTimes), 1)
+            del features, x
+
+    def test_fit_tiny_decoder_on_list_features(self):
+        with tempfile.TemporaryDirectory() as folder:
+            features, y = get_list_features(10, folder)
+            model = get_tiny_decoder()
+            monitor = train_callbacks.ThroughputMonitor(4, len(y), verbose=False)
+            history = model.fit(monitor.get_batches(features, y), epochs=2, callbacks=[monitor], verbose=0)
+
+            self.assertEqual(len(history.history['loss']), 2)
+            self.assertEqual([x["steps"] for x in monitor.epochs], [3, 3])
+            self.assertIsNotNone(monitor.get_summary()["fetchFraction"])
+            del features
+
+if __name__ == '__main__':
+    unittest.main()
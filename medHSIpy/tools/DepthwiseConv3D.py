@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*
+
+import numpy as np
+import tensorflow as tf
+from keras import layers
+
+BLOCK_TYPES = ['full', 'factorized', 'separable']
+
+############################ LAYERS ###################################
+
+def get_same_padding(size, kernel, stride):
+    outSize = int(np.ceil(size / stride))
+    total = max((outSize - 1) * stride + kernel - size, 0)
+    return total // 2, total - total // 2
+
+class DepthwiseConv3D(layers.Layer):
+    """Depthwise 3D convolution (depth multiplier 1) on (batch, height, width, spectrum, channels) inputs.
+
+    Grouped Conv3D is not supported on CPU, so the spectral axis of the kernel is unrolled:
+    the output is the sum over spectral offsets of 2D depthwise convolutions on shifted slices.
+    """
+
+    def __init__(self, kernel_size, strides = (1, 1, 1), padding = 'same', use_bias = False, kernel_initializer = 'glorot_uniform', **kwargs):
+        super().__init__(**kwargs)
+        self.kernel_size = tuple(kernel_size)
+        self.strides = tuple(strides) if isinstance(strides, (list, tuple)) else (strides, strides, strides)
+        self.padding = padding.lower()
+        self.use_bias = use_bias
+        self.kernel_initializer = tf.keras.initializers.get(kernel_initializer)
+
+    def build(self, input_shape):
+        channels = int(input_shape[-1])
+        self.kernel = self.add_weight(name='depthwise_kernel', shape=self.kernel_size + (channels,), initializer=self.kernel_initializer)
+        self.bias = self.add_weight(name='bias', shape=(channels,), initializer='zeros') if self.use_bias else None
+        super().build(input_shape)
+
+    def call(self, inputs):
+        kh, kw, kd = self.kernel_size
+        depth = inputs.shape[3]
+        channels = inputs.shape[4]
+
+        x = inputs
+        if self.padding == 'same':
+            front, back = get_same_padding(depth, kd, self.strides[2])
+            x = tf.pad(x, [[0, 0], [0, 0], [0, 0], [front, back], [0, 0]])
+            depth = depth + front + back
+        validDepth = depth - kd + 1
+
+        outputs = None
+        for k in range(kd):
+            # (B, H, W, D, C) -> (B, H, W, D*C), the kernel slice is repeated for every spectral position
+            slice_ = tf.reshape(x[:, :, :, k:k + validDepth, :], tf.concat([tf.shape(x)[0:3], [validDepth * channels]], 0))
+            kernel = tf.reshape(tf.tile(self.kernel[:, :, k:k + 1, :], [1, 1, validDepth, 1]), (kh, kw, validDepth * channels, 1))
+            y = tf.nn.depthwise_conv2d(slice_, kernel, strides=(1,) + self.strides[0:2] + (1,), padding=self.padding.upper())
+            outputs = y if outputs is None else outputs + y
+
+        outputs = tf.reshape(outputs, tf.concat([tf.shape(outputs)[0:3], [validDepth, channels]], 0))
+        outputs = outputs[:, :, :, ::self.strides[2], :]
+        if self.bias is not None:
+            outputs = outputs + self.bias
+        return outputs
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({
+            'kernel_size': self.kernel_size,
+            'strides': self.strides,
+            'padding': self.padding,
+            'use_bias': self.use_bias,
+            'kernel_initializer': tf.keras.initializers.serialize(self.kernel_initializer),
+        })
+        return config
+
+############################ BLOCKS ###################################
+
+def conv3d_block(x, n_filters, kernel_size, blockType = 'full', name = None, strides = (1, 1, 1), padding = "same",
+    activation = None, use_bias = True, kernel_initializer = "glorot_uniform"):
+    # 'full': dense Conv3D
+    # 'factorized': (2+1)D, spatial kh x kw x 1 followed by spectral 1 x 1 x kd
+    # 'separable': depthwise kh x kw x kd followed by pointwise 1 x 1 x 1
+    strides = tuple(strides) if isinstance(strides, (list, tuple)) else (strides, strides, strides)
+    prefix = '' if name is None else name
+
+    if blockType == 'factorized':
+        x = layers.Conv3D(n_filters, tuple(kernel_size[0:2]) + (1,), strides=strides[0:2] + (1,), padding=padding, activation=activation,
+            use_bias=use_bias, kernel_initializer=kernel_initializer, name=None if name is None else prefix + '_spatial')(x)
+        x = layers.Conv3D(n_filters, (1, 1, kernel_size[2]), strides=(1, 1, strides[2]), padding=padding, activation=activation,
+            use_bias=use_bias, kernel_initializer=kernel_initializer, name=None if name is None else prefix + '_spectral')(x)
+
+    elif blockType == 'separable':
+        x = DepthwiseConv3D(kernel_size, strides=strides, padding=padding, use_bias=False, kernel_initializer=kernel_initializer,
+            name=None if name is None else prefix + '_depthwise')(x)
+        x = layers.Conv3D(n_filters, (1, 1, 1), padding=padding, activation=activation, use_bias=use_bias,
+            kernel_initializer=kernel_initializer, name=None if name is None else prefix + '_pointwise')(x)
+
+    else:
+        x = layers.Conv3D(n_filters, kernel_size, strides=strides, padding=padding, activation=activation, use_bias=use_bias,
+            kernel_initializer=kernel_initializer, name=name)(x)
+
+    return x
+
+############################ COST ###################################
+
+def get_conv3d_block_cost(inputShape, n_filters, kernel_size, blockType = 'full', use_bias = True):
+    # Parameters and multiply-accumulates of one block for an input of (height, width, spectrum, channels),
+    # with stride 1 and 'same' padding
+    height, width, depth, channels = inputShape
+    kh, kw, kd = kernel_size
+    positions = height * width * depth
+    biasParams = n_filters if use_bias else 0
+
+    if blockType == 'factorized':
+        params = kh * kw * channels * n_filters + kd * n_filters * n_filters + 2 * biasParams
+    elif blockType == 'separable':
+        params = kh * kw * kd * channels + channels * n_filters + biasParams
+    else:
+        params = kh * kw * kd * channels * n_filters + biasParams
+
+    macs = positions * (params - (2 * biasParams if blockType == 'factorized' else biasParams))
+    return {"blockType": blockType, "params": params, "macs": macs}
+
+def print_conv3d_block_costs(inputShape, n_filters, kernel_size):
+    full = get_conv3d_block_cost(inputShape, n_filters, kernel_size, 'full')
+    for blockType in BLOCK_TYPES:
+        cost = get_conv3d_block_cost(inputShape, n_filters, kernel_size, blockType)
+        print("{:<12} params {:>12,} MACs {:>16,} ({:.1f}x fewer MACs than full)".format(blockType, cost["params"], cost["macs"],
+            full["macs"] / max(cost["macs"], 1)))
+
+def get_model_conv_cost(model):
+    # Parameters and MACs of the Conv3D and DepthwiseConv3D layers of a built model, for one sample
+    params, macs = 0, 0
+    for layer in model.layers:
+        # grouped Conv3D kernels already hold input_channels / groups
+        if not isinstance(layer, (DepthwiseConv3D, layers.Conv3D)):
+            continue
+        kernelMacs = int(np.prod(layer.kernel.shape))
+        params += layer.count_params()
+        macs += int(np.prod(layer.output.shape[1:-1])) * kernelMacs
+    return {"params": params, "macs": macs, "totalParams": model.count_params()}
+
+def compare_block_types(builder, height, width, numChannels, numClasses = 1, blockTypes = BLOCK_TYPES):
+    # builder is any of the cnn3d/xception3d builders that takes a blockType argument
+    costs = {}
+    for blockType in blockTypes:
+        tf.keras.backend.clear_session()
+        costs[blockType] = get_model_conv_cost(builder(height, width, numChannels, numClasses, blockType=blockType))
+
+    full = costs.get('full')
+    print("{:<12} {:>14} {:>14} {:>18} {:>10}".format("block", "params", "conv params", "conv MACs", "speedup"))
+    for blockType, cost in costs.items():
+        speedup = "-" if full is None else "{:.1f}x".format(full["macs"] / max(cost["macs"], 1))
+        print("{:<12} {:>14,} {:>14,} {:>18,} {:>10}".format(blockType, cost["totalParams"], cost["params"], cost["macs"], speedup))
+    return costs
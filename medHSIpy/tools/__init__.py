@@ -5,7 +5,30 @@ from . import hsi_segment_from_sm as segsm
 from . import train_utils as train_utils
 from . import xception_models as xmdl 
 from . import cnn_models as cmdl
+from . import DepthwiseConv3D as dc3d
+from . import eval_utils as eval_utils
+from . import metrics_utils as metrics_utils
+from . import artifact_writer as artifact_writer
+from . import plot_utils as plot_utils
+from . import results_store as results_store
+from . import profiling as profiling
+from . import train_callbacks as train_callbacks
+from . import batch_tuner as batch_tuner
+from . import benchmark_utils as benchmark_utils
+from . import cost_utils as cost_utils
+from . import model_registry as model_registry
+from . import tflite_utils as tflite_utils
+from . import inference_server as inference_server
+from . import experiment_utils as experiment_utils
+from . import experiment_worker as experiment_worker
+from . import experiment_scheduler as experiment_scheduler
+from . import sm_preprocessing as smp
+from . import sm_feature_cache as sfc
+from . import distributed_utils as distributed_utils
+from . import gradient_accumulation as gradient_accumulation
+from . import checkpointing as ckpt
+from . import ensemble_utils as ensemble_utils
+from . import tta_utils as tta_utils
 
 #from . import hsi_decompositions
-#from . import DepthwiseConv3D as dc3d
 
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*
+
+import atexit
+import queue
+import threading
+
+DEFAULT_NUM_WORKERS = 2
+DEFAULT_QUEUE_SIZE = 64
+
+############################### Background Writer ##############
+
+class ArtifactWriter:
+    """Renders and writes run artifacts (figures, .mat, text) on background threads.
+
+    Jobs are plain callables. The queue is bounded, so submit() blocks when the workers
+    fall behind instead of holding an unbounded number of arrays in memory.
+    Jobs must not use pyplot or redirect_stdout, which are process-global.
+    """
+
+    def __init__(self, numWorkers = DEFAULT_NUM_WORKERS, maxQueueSize = DEFAULT_QUEUE_SIZE):
+        self.queue = queue.Queue(maxsize=maxQueueSize)
+        self.errors = []
+        self.workers = [threading.Thread(target=self._work, name='artifact_writer_' + str(i), daemon=True) for i in range(numWorkers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                func, args, kwargs = job
+                func(*args, **kwargs)
+            except Exception as error:
+                print("Failed to write artifact: ", error)
+                self.errors.append(error)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, *args, **kwargs):
+        self.queue.put((func, args, kwargs))
+
+    def flush(self):
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+_writer = None
+_writerLock = threading.Lock()
+
+def get_writer():
+    global _writer
+    with _writerLock:
+        if _writer is None:
+            _writer = ArtifactWriter()
+            atexit.register(close_writer)
+    return _writer
+
+def flush_writer():
+    if _writer is not None:
+        _writer.flush()
+
+def close_writer():
+    global _writer
+    with _writerLock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
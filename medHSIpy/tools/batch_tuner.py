@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*
+
+import gc
+import json
+import os
+import platform
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+import segmentation_models as sm
+from tensorflow.keras.optimizers import RMSprop
+
+if __name__ == "__main__":
+    import profiling
+    import checkpointing as ckpt
+else:
+    from . import profiling
+    from . import checkpointing as ckpt
+
+DEFAULT_CANDIDATES = [1, 2, 4, 8, 16, 32, 64]
+DEFAULT_MEMORY_FRACTION = 0.8
+CACHE_FILENAME = os.path.join(os.path.expanduser('~'), '.medhsi', 'batch_size_cache.json')
+
+############################### Memory ##############
+
+def get_total_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, AttributeError, OSError):
+        return None
+
+def get_default_budget():
+    totalMemory = get_total_memory()
+    return None if totalMemory is None else totalMemory * DEFAULT_MEMORY_FRACTION
+
+class RssSampler:
+    # Polls the process RSS in the background to catch the peak inside a training step
+
+    def __init__(self, interval = 0.01):
+        self.interval = interval
+        self.peak = 0
+        self.running = False
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, profiling.get_current_rss() or 0)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.running = False
+        self.thread.join()
+
+############################### Cache ##############
+
+def get_execution_mode(executionMode = None):
+    # The mode of train_utils.set_execution_mode, without it the global precision policy ('float32' or 'mixed_bfloat16')
+    return tf.keras.mixed_precision.global_policy().name if executionMode is None else executionMode
+
+def get_cache_key(model, inputShape, executionMode = None):
+    # max/mean variants share name and parameter count, and have the same cost. Recomputed blocks, mixed precision
+    # and XLA change the memory.
+    numRecomputed = ckpt.count_recompute_blocks(model)
+    return '|'.join([model.name, str(model.count_params()), 'x'.join(str(x) for x in inputShape), platform.node(),
+        get_execution_mode(executionMode)] + (['recompute' + str(numRecomputed)] if numRecomputed else []))
+
+def load_cache(filename = CACHE_FILENAME):
+    try:
+        with open(filename, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(cache, filename = CACHE_FILENAME):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, indent=1)
+
+############################### Tuner ##############
+
+def probe_batch_size(model, inputShape, batchSize, numSteps = 3, executionMode = None):
+    # Trains a fresh copy of the model on random data, the original weights are not touched
+    probeModel = tf.keras.models.clone_model(model)
+    probeModel.compile(optimizer=RMSprop(learning_rate=0.0001), loss=sm.losses.bce_jaccard_loss,
+        jit_compile='xla' in get_execution_mode(executionMode))
+
+    x = np.random.random((batchSize,) + tuple(inputShape)).astype(np.float32)
+    y = (np.random.random((batchSize,) + tuple(inputShape[0:2])) > 0.5).astype(np.float32)
+
+    try:
+        with RssSampler() as sampler:
+            # the first step traces the graph
+            probeModel.train_on_batch(x, y)
+            start = time.perf_counter()
+            for _ in range(numSteps):
+                probeModel.train_on_batch(x, y)
+            stepTime = (time.perf_counter() - start) / numSteps
+    finally:
+        del probeModel
+        gc.collect()
+
+    return {"batchSize": batchSize, "stepTime": stepTime, "samplesPerSec": batchSize / stepTime, "peakRss": sampler.peak}
+
+def tune_batch_size(model, inputShape, memoryBudgetMB = None, candidates = DEFAULT_CANDIDATES, numSteps = 3, useCache = True,
+    executionMode = None):
+    """Returns the candidate batch size with the highest training throughput whose peak RSS stays under the budget.
+
+    Candidates are probed in increasing order and probing stops at the first one that exceeds
+    the budget or fails to allocate. Results are cached per (architecture, input shape, host, execution mode).
+    executionMode is the mode the model was built under, see train_utils.set_execution_mode.
+    """
+
+    key = get_cache_key(model, inputShape, executionMode)
+    cache = load_cache() if useCache else {}
+    if key in cache:
+        print("Using cached batch size", cache[key]["batchSize"], "for", key)
+        return cache[key]["batchSize"]
+
+    budget = get_default_budget() if memoryBudgetMB is None else memoryBudgetMB * 2**20
+    probes = []
+    for batchSize in sorted(candidates):
+        try:
+            probe = probe_batch_size(model, inputShape, batchSize, numSteps, executionMode)
+        except (tf.errors.ResourceExhaustedError, MemoryError) as error:
+            print("Batch size", batchSize, "does not fit:", type(error).__name__)
+            break
+
+        print("Batch size {}: {:.1f} samples/s, peak RSS {:.0f} MB".format(batchSize, probe["samplesPerSec"], probe["peakRss"] / 2**20))
+        if budget is not None and probe["peakRss"] > budget:
+            break
+        probes.append(probe)
+
+    if not probes:
+        batchSize = min(candidates)
+        print("No batch size fits the memory budget, using", batchSize)
+        return batchSize
+
+    best = max(probes, key=lambda x: x["samplesPerSec"])
+    print("Selected batch size", best["batchSize"], "for", model.name)
+
+    if useCache:
+        cache = load_cache()
+        cache[key] = dict(best, probes=probes, memoryBudget=budget)
+        save_cache(cache)
+    return best["batchSize"]
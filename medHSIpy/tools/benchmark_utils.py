@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*
+
+import json
+import os
+import platform
+import time
+
+import h5py
+import numpy as np
+import segmentation_models as sm
+from keras import backend
+from sklearn.decomposition import PCA
+from tensorflow.keras.optimizers import RMSprop
+
+if __name__ == "__main__":
+    import hsi_utils
+    import profiling
+    import model_registry
+else:
+    from . import hsi_utils
+    from . import profiling
+    from . import model_registry
+
+DEFAULT_MODELS = ['cnn3d', 'cnn3d2', 'xception3d_max', 'xception3d2_max', 'xception3d3_max', 'xception3d4_max',
+    'xception3d5_max', 'xception3d_10n', 'xception3d_20n', 'xception3d_30n']
+
+######################### Synthetic data #########################
+
+def make_synthetic_cube(height, width, numBands, rng):
+    # Smooth spectra with a random per-pixel scale, values in [0, 1] as the normalized dataset
+    wavelengths = np.linspace(0, 1, numBands, dtype=np.float32)
+    spectrum = 0.5 + 0.4 * np.sin(2 * np.pi * (wavelengths + rng.random()))
+    scale = rng.uniform(0.5, 1, size=(height, width, 1)).astype(np.float32)
+    return np.clip(scale * spectrum[np.newaxis, np.newaxis, :], 0, 1)
+
+def make_synthetic_label(height, width, rng):
+    yy, xx = np.mgrid[0:height, 0:width]
+    cy, cx = rng.uniform(0.3, 0.7) * height, rng.uniform(0.3, 0.7) * width
+    radius = rng.uniform(0.2, 0.4) * min(height, width)
+    return (((yy - cy) ** 2 + (xx - cx) ** 2) < radius ** 2).astype(np.uint8)
+
+def write_synthetic_dataset(fpath, numImages = 8, height = 64, width = 64, numBands = 311, seed = 0):
+    # Same layout as the MATLAB exported datasets read by hsi_utils.load_dataset
+    rng = np.random.default_rng(seed)
+    with h5py.File(fpath, 'w') as f:
+        for i in range(numImages):
+            group = f.create_group('sample' + str(i))
+            group.create_dataset('hsi', data=np.transpose(make_synthetic_cube(height, width, numBands, rng), [2, 0, 1]))
+            group.create_dataset('label', data=make_synthetic_label(height, width, rng))
+    return fpath
+
+######################### Timing #########################
+
+def time_call(func, repeats = 3):
+    # peakRssIncrease is the sampled RSS peak of the calls above the RSS before them,
+    # so that it does not include the memory left by earlier benchmarks
+    times = []
+    result = None
+    with profiling.RssPeak() as rss:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+    timing = {"min": min(times), "median": float(np.median(times)), "repeats": repeats, "peakRssIncrease": rss.get_increase()}
+    return timing, result
+
+def run_benchmark(results, name, func, repeats = 3):
+    print("Benchmark:", name)
+    try:
+        timing, result = time_call(func, repeats)
+    except Exception as error:
+        print("Failed benchmark", name, ":", error)
+        results[name] = {"error": str(error)}
+        return None
+    results[name] = timing
+    return result
+
+######################### Models #########################
+
+def get_model_builder(name):
+    return model_registry.get_builder(name)
+
+def benchmark_model(results, name, x, y, batchSize = 4, repeats = 2):
+    backend.clear_session()
+    model = run_benchmark(results, name + '/build', lambda: get_model_builder(name)(x.shape[1], x.shape[2], x.shape[3], 1), 1)
+    if model is None:
+        return
+    model.compile(optimizer=RMSprop(learning_rate=0.0001), loss=sm.losses.bce_jaccard_loss)
+
+    # the first call traces the graph, keep it out of the timed epochs
+    model.train_on_batch(x[:batchSize], y[:batchSize])
+    run_benchmark(results, name + '/epoch', lambda: model.fit(x, y, batch_size=batchSize, epochs=1, verbose=0), repeats)
+    model.predict(x[:batchSize], verbose=0)
+    run_benchmark(results, name + '/predict', lambda: model.predict(x, batch_size=batchSize, verbose=0), repeats)
+
+    for stage in ['/epoch', '/predict']:
+        if 'min' in results.get(name + stage, {}):
+            results[name + stage]["samplesPerSec"] = len(x) / results[name + stage]["min"]
+
+######################### Suite #########################
+
+def run_suite(dataDir, numImages = 8, height = 64, width = 64, numBands = 311, cropSize = 32, models = DEFAULT_MODELS, repeats = 3):
+    results = {}
+    fpath = write_synthetic_dataset(os.path.join(dataDir, 'hsi_synthetic_full.h5'), numImages, height, width, numBands)
+
+    loaded = run_benchmark(results, 'h5_load', lambda: hsi_utils.load_dataset(fpath, 'image'), repeats)
+    if loaded is None:
+        return results
+    dataList, keyList, labelList = loaded
+
+    cropped = run_benchmark(results, 'center_crop', lambda: hsi_utils.center_crop_list(dataList, cropSize, cropSize), repeats)
+    croppedLabels = hsi_utils.center_crop_list(labelList, cropSize, cropSize)
+    stacked = run_benchmark(results, 'flatten', lambda: hsi_utils.flatten_hsis(dataList), repeats)
+    run_benchmark(results, 'display_image', lambda: [hsi_utils.get_display_image(hsi) for hsi in dataList], repeats)
+
+    run_benchmark(results, 'pca', lambda: PCA(n_components=10).fit(stacked), repeats)
+
+    x = np.array(cropped, dtype=np.float32)
+    y = np.array(croppedLabels, dtype=np.float32)
+    for name in models:
+        benchmark_model(results, name, x, y, repeats=max(repeats - 1, 1))
+
+    return results
+
+def get_environment():
+    return {"host": platform.node(), "platform": platform.platform(), "python": platform.python_version(),
+        "numpy": np.__version__, "cpuCount": os.cpu_count()}
+
+def save_results(filename, results, settings = None):
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump({"environment": get_environment(), "settings": settings, "results": results}, f, indent=1)
+    print("Saved benchmark results at: ", filename)
+
+def load_results(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return json.load(f)["results"]
+
+def compare_results(results, baseline, tolerance = 0.1):
+    # Returns the benchmarks that are slower or use more memory than baseline by more than tolerance
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None or 'min' not in current or 'min' not in previous:
+            continue
+        ratio = current["min"] / max(previous["min"], 1e-12)
+        status = "REGRESSION" if ratio > 1 + tolerance else ("improved" if ratio < 1 - tolerance else "ok")
+        print("{:<32} {:>10.4f}s {:>10.4f}s {:>7.2f}x  {}".format(name, previous["min"], current["min"], ratio, status))
+        if status == "REGRESSION":
+            regressions.append(name)
+
+        # baselines with the process-wide peakRss of earlier versions are not comparable and are skipped
+        currentRss, previousRss = current.get("peakRssIncrease"), previous.get("peakRssIncrease")
+        if currentRss and previousRss and currentRss > previousRss * (1 + tolerance):
+            print("{:<32} RSS increase {:.1f} MB -> {:.1f} MB  REGRESSION".format(name, previousRss / 2**20, currentRss / 2**20))
+            regressions.append(name + '/memory')
+    return regressions
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*
+
+import re
+
+import tensorflow as tf
+from keras import layers, backend
+from keras.models import Model
+
+if __name__ == "__main__":
+    import DepthwiseConv3D as dc3d
+else:
+    from . import DepthwiseConv3D as dc3d
+
+RECOMPUTE_SUFFIX = '_recompute'
+
+######################### Policy #########################
+
+def get_checkpoint_interval(checkpointPolicy):
+    # None or 'none': no recomputation, 'all' or 'every': every block, N or 'everyN': every N-th block
+    if checkpointPolicy is None or checkpointPolicy is False:
+        return 0
+    if checkpointPolicy is True:
+        return 1
+    if isinstance(checkpointPolicy, int):
+        return max(checkpointPolicy, 0)
+    policy = str(checkpointPolicy).strip().lower()
+    if policy in ('', 'none', 'off'):
+        return 0
+    if policy in ('all', 'every'):
+        return 1
+    match = re.fullmatch(r'(every_?)?(\d+)', policy)
+    if match is None:
+        raise ValueError("Unknown checkpointing policy: " + str(checkpointPolicy))
+    return int(match.group(2))
+
+def is_checkpointed(checkpointPolicy, blockIndex):
+    # Blocks are counted from 0 along the encoder, 'every2' recomputes blocks 0, 2, 4...
+    interval = get_checkpoint_interval(checkpointPolicy)
+    return interval > 0 and blockIndex % interval == 0
+
+######################### Recomputation #########################
+
+class RecomputeBlock(layers.Layer):
+    """Runs a block sub-model without keeping its inner activations for the backward pass.
+
+    Only the block input and output are stored, the gradient recomputes the block forward pass.
+    The block must be deterministic, so dropout layers stay outside of it.
+    """
+
+    def __init__(self, block, **kwargs):
+        # the inner layers cast their own inputs under mixed precision
+        kwargs.setdefault('autocast', False)
+        super().__init__(**kwargs)
+        self.block = block
+
+    def call(self, inputs, training = None):
+        if training is None:
+            training = backend.learning_phase()
+        if isinstance(training, (bool, int)) and not training:
+            return self.block(inputs, training=False)
+
+        block = self.block
+        @tf.recompute_grad
+        def forward(x):
+            return block(x, training=training)
+        return forward(inputs)
+
+    def compute_output_shape(self, input_shape):
+        return self.block.compute_output_shape(input_shape)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"block": layers.serialize(self.block)})
+        return config
+
+    @classmethod
+    def from_config(cls, config):
+        config = dict(config)
+        config["block"] = layers.deserialize(config["block"], custom_objects={'DepthwiseConv3D': dc3d.DepthwiseConv3D})
+        return cls(**config)
+
+def set_recompute_momentum(block):
+    # The recomputation runs the BatchNorm layers a second time on the same batch, so the moving
+    # statistics are updated twice per step. momentum**0.5 keeps the moving averages of a single update.
+    for layer in block.submodules:
+        if isinstance(layer, layers.BatchNormalization):
+            layer.momentum = layer.momentum ** 0.5
+
+def checkpoint_block(blockFn, x, checkpointed = True, name = None):
+    """Returns blockFn(x), computed by a RecomputeBlock when checkpointed.
+
+    blockFn builds the layers of the block on a tensor. Without checkpointing the layers are applied to x
+    directly, so the model and its weights are the same as without this function.
+    """
+
+    if not checkpointed:
+        return blockFn(x)
+    inputs = layers.Input(x.shape[1:], dtype=x.dtype)
+    block = Model(inputs, blockFn(inputs), name=None if name is None else name + '_block')
+    set_recompute_momentum(block)
+    return RecomputeBlock(block, name=name)(x)
+
+def count_recompute_blocks(model):
+    return sum(1 for layer in model.submodules if isinstance(layer, RecomputeBlock))
@@ -4,19 +4,28 @@ from keras.models import Model
 
 if __name__ == "__main__":
     import train_utils
+    import profiling
+    import batch_tuner
+    import checkpointing as ckpt
+    import DepthwiseConv3D as dc3d
 else:
     from . import train_utils
+    from . import profiling
+    from . import batch_tuner
+    from . import checkpointing as ckpt
+    from . import DepthwiseConv3D as dc3d
 
 ############################ BLOCKS ###################################
-def double_conv_block(x, n_filters, kernel_size):
-   # Conv2D then ReLU activation
-   x = layers.Conv3D(filters=n_filters, kernel_size=kernel_size, padding = "same", activation = "relu", kernel_initializer = "he_normal")(x)
-   # Conv2D then ReLU activation
-   x = layers.Conv3D(filters=n_filters, kernel_size=kernel_size, padding = "same", activation = "relu", kernel_initializer = "he_normal")(x)
+def double_conv_block(x, n_filters, kernel_size, blockType = 'full'):
+   # Conv3D then ReLU activation, blockType selects a full, factorized (2+1)D or depthwise-separable kernel
+   x = dc3d.conv3d_block(x, n_filters, kernel_size, blockType, activation = "relu", kernel_initializer = "he_normal")
+   # Conv3D then ReLU activation
+   x = dc3d.conv3d_block(x, n_filters, kernel_size, blockType, activation = "relu", kernel_initializer = "he_normal")
    return x
 
-def downsample_block(x, n_filters, kernel_size):
-   f = double_conv_block(x, n_filters, kernel_size)
+def downsample_block(x, n_filters, kernel_size, blockType = 'full', checkpointed = False):
+   # with checkpointed, the activations of the convolutions are recomputed in the backward pass
+   f = ckpt.checkpoint_block(lambda y: double_conv_block(y, n_filters, kernel_size, blockType), x, checkpointed)
    f = layers.Dropout(0.4)(f)
    p = layers.MaxPool3D(2)(f)
    return f, p
@@ -43,7 +52,7 @@ def upsample_block(x, conv_features, n_filters):
 
 ############################ CNN ###################################
 
-def cnn3d( width, height, numChannels, numClasses): 
+def cnn3d( width, height, numChannels, numClasses, blockType = 'full', checkpointPolicy = None): 
 
     depth = numChannels
     channel_axis = -1
@@ -53,18 +62,19 @@ def cnn3d( width, height, numChannels, numClasses):
     input_layer = layers.Input((width, height, depth, 1), name='entry')
     # encoder: contracting path - downsample
     # 1 - downsample
-    f1, p1 = downsample_block(input_layer, 4, (3, 3, 50))
+    f1, p1 = downsample_block(input_layer, 4, (3, 3, 50), blockType, ckpt.is_checkpointed(checkpointPolicy, 0))
     # 2 - downsample
-    f2, p2 = downsample_block(p1, 8, (3, 3, 50))
+    f2, p2 = downsample_block(p1, 8, (3, 3, 50), blockType, ckpt.is_checkpointed(checkpointPolicy, 1))
     # 3 - downsample
-    f3, p3 = downsample_block(p2, 8, (3, 3, 30))
+    f3, p3 = downsample_block(p2, 8, (3, 3, 30), blockType, ckpt.is_checkpointed(checkpointPolicy, 2))
     # 4 - downsample
-    f4, p4 = downsample_block(p3, 16, (3, 3, 20))
+    f4, p4 = downsample_block(p3, 16, (3, 3, 20), blockType, ckpt.is_checkpointed(checkpointPolicy, 3))
     # 5 - downsample
-    f5, p5 = downsample_block(p4, 16, (3, 3, 20))
+    f5, p5 = downsample_block(p4, 16, (3, 3, 20), blockType, ckpt.is_checkpointed(checkpointPolicy, 4))
 
     # 6 - bottleneck
-    bottleneck = double_conv_block(p5, 32, (1, 1, 19))
+    bottleneck = ckpt.checkpoint_block(lambda y: double_conv_block(y, 32, (1, 1, 19), blockType), p5,
+        ckpt.is_checkpointed(checkpointPolicy, 5))
     bottleneck = layers.Lambda(lambda y: backend.mean(y, axis=3), name='drop_thrid_dim')(bottleneck)
     
     # decoder: expanding path - upsample
@@ -84,7 +94,7 @@ def cnn3d( width, height, numChannels, numClasses):
 
     return model 
 
-def cnn3d2( width, height, numChannels, numClasses): 
+def cnn3d2( width, height, numChannels, numClasses, blockType = 'full', checkpointPolicy = None): 
 
     depth = numChannels
     channel_axis = -1
@@ -94,22 +104,23 @@ def cnn3d2( width, height, numChannels, numClasses):
     input_layer = layers.Input((width, height, depth, 1), name='entry')
     # encoder: contracting path - downsample
     # 1 - downsample
-    f1, p1 = downsample_block(input_layer, 4, (3, 3, 20))
+    f1, p1 = downsample_block(input_layer, 4, (3, 3, 20), blockType, ckpt.is_checkpointed(checkpointPolicy, 0))
     # 2 - downsample
-    f2, p2 = downsample_block(p1, 8, (3, 3, 20))
+    f2, p2 = downsample_block(p1, 8, (3, 3, 20), blockType, ckpt.is_checkpointed(checkpointPolicy, 1))
     # 3 - downsample
-    f3, p3 = downsample_block(p2, 8, (3, 3, 20))
+    f3, p3 = downsample_block(p2, 8, (3, 3, 20), blockType, ckpt.is_checkpointed(checkpointPolicy, 2))
     # 4 - downsample
-    f4, p4 = downsample_block(p3, 16, (3, 3, 20))
+    f4, p4 = downsample_block(p3, 16, (3, 3, 20), blockType, ckpt.is_checkpointed(checkpointPolicy, 3))
     # 5 - downsample
-    f5, p5 = downsample_block(p4, 16, (1, 1, 5))
+    f5, p5 = downsample_block(p4, 16, (1, 1, 5), blockType, ckpt.is_checkpointed(checkpointPolicy, 4))
     # 6 - downsample
-    f6, p6 = downsample_block(p5, 16, (1, 1, 5))
+    f6, p6 = downsample_block(p5, 16, (1, 1, 5), blockType, ckpt.is_checkpointed(checkpointPolicy, 5))
     # 7 - downsample
-    f7, p7 = downsample_block(p6, 16, (1, 1, 5))
+    f7, p7 = downsample_block(p6, 16, (1, 1, 5), blockType, ckpt.is_checkpointed(checkpointPolicy, 6))
 
     # 6 - bottleneck
-    bottleneck = double_conv_block(p7, 32, (1, 1, 5))
+    bottleneck = ckpt.checkpoint_block(lambda y: double_conv_block(y, 32, (1, 1, 5), blockType), p7,
+        ckpt.is_checkpointed(checkpointPolicy, 7))
     bottleneck = layers.Lambda(lambda y: backend.mean(y, axis=3), name='drop_thrid_dim')(bottleneck)
     
     # decoder: expanding path - upsample
@@ -134,21 +145,27 @@ def cnn3d2( width, height, numChannels, numClasses):
 ############################ TRAIN ###################################
 
 def get_cnn_model(framework, x_train_raw, ytrain, x_test_raw, ytest, height, width, numChannels, numClasses, numEpochs=200, batchSize=64,
-   optimizerName = "RMSProp", learning_rate = 0.0001, decay = 0, lossFunction = "BCE+JC"):
+   optimizerName = "RMSProp", learning_rate = 0.0001, decay = 0, lossFunction = "BCE+JC", tuneBatchSize = False, memoryBudgetMB = None, executionMode = None,
+   blockType = 'full', accumulationSteps = 1, checkpointPolicy = None):
 
    backend.clear_session()
+   executionMode = train_utils.set_execution_mode(executionMode)
 
    # x_train_preproc, x_test_preproc = preproc_data(x_train_raw, x_test_raw)
    x_train_preproc = x_train_raw
    x_test_preproc = x_test_raw
    
-   if 'cnn3d2' in framework:
-      model = cnn3d2(height, width, numChannels, numClasses)
+   with profiling.stage('build_model'):
+      if 'cnn3d2' in framework:
+         model = cnn3d2(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+
+      elif 'cnn3d' in framework:
+         model = cnn3d(height, width, numChannels, numClasses, blockType, checkpointPolicy)
 
-   elif 'cnn3d' in framework:
-      model = cnn3d(height, width, numChannels, numClasses)
+   if tuneBatchSize:
+      batchSize = batch_tuner.tune_batch_size(model, x_train_preproc.shape[1:], memoryBudgetMB, executionMode=executionMode)
 
-   model = train_utils.compile_custom(framework, model, optimizerName, learning_rate, decay, lossFunction)
+   model = train_utils.compile_custom(framework, model, optimizerName, learning_rate, decay, lossFunction, executionMode, accumulationSteps)
 
    model, history = train_utils.fit_model(framework, model, x_train_preproc, ytrain, x_test_preproc, ytest, numEpochs, batchSize)
 
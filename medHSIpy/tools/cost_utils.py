@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*
+
+import copy
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+from keras import layers
+
+if __name__ == "__main__":
+    import DepthwiseConv3D as dc3d
+    import checkpointing as ckpt
+else:
+    from . import DepthwiseConv3D as dc3d
+    from . import checkpointing as ckpt
+
+CONV_LAYERS = (layers.Conv1D, layers.Conv2D, layers.Conv3D)
+TRANSPOSE_LAYERS = (layers.Conv2DTranspose, layers.Conv3DTranspose)
+POOLING_LAYERS = (layers.MaxPooling2D, layers.MaxPooling3D, layers.AveragePooling2D, layers.AveragePooling3D)
+ELEMENTWISE_LAYERS = (layers.BatchNormalization, layers.Activation, layers.ReLU, layers.Add, layers.Multiply,
+    layers.Average, layers.Maximum, layers.UpSampling2D, layers.Lambda)
+
+######################### Shapes #########################
+
+def has_dynamic_shape(model):
+    return any(None in tuple(shape)[1:] for shape in [tuple(x.shape) for x in model.inputs])
+
+def set_input_shapes(config, inputShape):
+    # Replaces unknown dimensions of every InputLayer, including nested models, with the given spatial size
+    for layerConfig in config.get('layers', []):
+        if layerConfig['class_name'] == 'InputLayer':
+            shape = list(layerConfig['config']['batch_input_shape'])
+            for i in range(1, len(shape)):
+                if shape[i] is None and i - 1 < len(inputShape):
+                    shape[i] = inputShape[i - 1]
+            layerConfig['config']['batch_input_shape'] = tuple(shape)
+        elif 'layers' in layerConfig.get('config', {}):
+            set_input_shapes(layerConfig['config'], inputShape)
+
+def get_static_model(model, inputShape):
+    # Rebuilds a model with dynamic input dimensions (e.g. the sm Unets) with a concrete input shape,
+    # so that every layer has a known output shape. Weights are not needed for the cost.
+    if not has_dynamic_shape(model):
+        return model
+    config = copy.deepcopy(model.get_config())
+    set_input_shapes(config, inputShape)
+    try:
+        return tf.keras.Model.from_config(config, custom_objects={'DepthwiseConv3D': dc3d.DepthwiseConv3D,
+            'RecomputeBlock': ckpt.RecomputeBlock})
+    except Exception as error:
+        print("Could not rebuild", model.name, "with a static input shape:", error)
+        return model
+
+def get_shape(tensor):
+    return tuple(0 if x is None else int(x) for x in tensor.shape[1:])
+
+def get_dtype_size(layer):
+    try:
+        return tf.as_dtype(layer.compute_dtype).size
+    except (TypeError, AttributeError):
+        return 4
+
+######################### Layers #########################
+
+def get_layer_macs(layer):
+    # Multiply-accumulates of one sample
+    if isinstance(layer, dc3d.DepthwiseConv3D):
+        return int(np.prod(get_shape(layer.output)[:-1])) * int(np.prod(layer.kernel.shape))
+    if isinstance(layer, layers.SeparableConv2D):
+        positions = int(np.prod(get_shape(layer.output)[:-1]))
+        return positions * (int(np.prod(layer.depthwise_kernel.shape)) + int(np.prod(layer.pointwise_kernel.shape)))
+    if isinstance(layer, layers.DepthwiseConv2D):
+        return int(np.prod(get_shape(layer.output)[:-1])) * int(np.prod(layer.depthwise_kernel.shape))
+    if isinstance(layer, TRANSPOSE_LAYERS):
+        return int(np.prod(get_shape(layer.input)[:-1])) * int(np.prod(layer.kernel.shape))
+    if isinstance(layer, CONV_LAYERS):
+        # grouped kernels already hold input_channels / groups
+        return int(np.prod(get_shape(layer.output)[:-1])) * int(np.prod(layer.kernel.shape))
+    if isinstance(layer, layers.Dense):
+        return int(np.prod(get_shape(layer.output)[:-1])) * int(np.prod(layer.kernel.shape))
+    return 0
+
+def get_layer_flops(layer, macs, outputElements):
+    if macs:
+        return 2 * macs
+    if isinstance(layer, POOLING_LAYERS):
+        return outputElements * int(np.prod(layer.pool_size))
+    if isinstance(layer, ELEMENTWISE_LAYERS):
+        return outputElements
+    return 0
+
+def get_layer_outputs(layer):
+    outputs = layer.output if isinstance(layer.output, (list, tuple)) else [layer.output]
+    return [get_shape(x) for x in outputs]
+
+def get_layer_rows(model, batchSize = 1, prefix = '', segment = None):
+    # One row per layer, nested models are expanded. Rows of a recomputed block carry its name as segment.
+    rows = []
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.Model):
+            rows += get_layer_rows(layer, batchSize, prefix + layer.name + '/', segment)
+            continue
+        if isinstance(layer, ckpt.RecomputeBlock):
+            # the block input is the output of the previous layer, already counted
+            rows += [x for x in get_layer_rows(layer.block, batchSize, prefix + layer.name + '/', layer.name) if x["type"] != 'InputLayer']
+            continue
+
+        outputShapes = get_layer_outputs(layer)
+        outputElements = sum(int(np.prod(x)) for x in outputShapes)
+        macs = get_layer_macs(layer)
+        rows.append({
+            "name": prefix + layer.name,
+            "type": type(layer).__name__,
+            "outputShape": outputShapes[0] if len(outputShapes) == 1 else outputShapes,
+            "params": layer.count_params(),
+            "macs": macs * batchSize,
+            "flops": get_layer_flops(layer, macs, outputElements) * batchSize,
+            "activationBytes": outputElements * get_dtype_size(layer) * batchSize,
+            "segment": segment,
+        })
+    return rows
+
+def get_recompute_activation_bytes(rows):
+    # Training activation memory when the segments are recomputed: a segment keeps only its output,
+    # and the backward pass holds the inner activations of one segment at a time
+    kept = 0
+    segments = {}
+    for row in rows:
+        if row.get("segment") is None:
+            kept += row["activationBytes"]
+        else:
+            segments.setdefault(row["segment"], []).append(row["activationBytes"])
+    kept += sum(x[-1] for x in segments.values())
+    return kept + max([sum(x) - x[-1] for x in segments.values()] or [0])
+
+######################### Memory #########################
+
+def get_inbound_layers(layer):
+    inbound = []
+    for node in getattr(layer, '_inbound_nodes', []):
+        nodeLayers = node.inbound_layers
+        inbound += nodeLayers if isinstance(nodeLayers, (list, tuple)) else [nodeLayers]
+    return inbound
+
+def get_peak_activation_bytes(model, batchSize = 1):
+    # Peak of simultaneously live layer outputs during inference, in layer order. An output stays live
+    # until its last consumer has run, which keeps the U-Net skip connections alive across the decoder.
+    order = {layer.name: i for i, layer in enumerate(model.layers)}
+    lastUse = {layer.name: i for i, layer in enumerate(model.layers)}
+    for i, layer in enumerate(model.layers):
+        for inbound in get_inbound_layers(layer):
+            if inbound.name in order:
+                lastUse[inbound.name] = max(lastUse[inbound.name], i)
+
+    sizes = {}
+    for layer in model.layers:
+        sizes[layer.name] = sum(int(np.prod(x)) for x in get_layer_outputs(layer)) * get_dtype_size(layer) * batchSize
+
+    peak = 0
+    for i, layer in enumerate(model.layers):
+        live = sum(sizes[name] for name, j in order.items() if j <= i and lastUse[name] >= i)
+        # nested models hold their own intermediate activations while they run
+        nested = layer.block if isinstance(layer, ckpt.RecomputeBlock) else layer if isinstance(layer, tf.keras.Model) else None
+        if nested is not None:
+            live += get_peak_activation_bytes(nested, batchSize) - sizes[layer.name]
+        peak = max(peak, live)
+    return peak
+
+######################### Latency #########################
+
+def measure_latency(model, batchSize, inputShape, numRuns = 10, numWarmup = 2):
+    # CPU latency of predict_on_batch, the first calls trace the graph and are not timed
+    x = np.random.random((batchSize,) + tuple(inputShape)).astype(np.float32)
+    with tf.device('/CPU:0'):
+        for _ in range(numWarmup):
+            model.predict_on_batch(x)
+        times = []
+        for _ in range(numRuns):
+            start = time.perf_counter()
+            model.predict_on_batch(x)
+            times.append(time.perf_counter() - start)
+    median = float(np.median(times))
+    return {"batchSize": batchSize, "median": median, "p90": float(np.percentile(times, 90)), "min": min(times),
+        "samplesPerSec": batchSize / max(median, 1e-12), "runs": numRuns}
+
+######################### Report #########################
+
+def get_cost_report(model, batchSize = 1, inputShape = None, measureLatency = True, numRuns = 10):
+    """Per-layer and total parameters, MACs/FLOPs and activation memory of a model for one batch.
+
+    inputShape excludes the batch dimension and defaults to the model input; it is required for
+    models with dynamic spatial dimensions, such as the sm backbones.
+    """
+
+    if inputShape is None:
+        inputShape = get_shape(model.inputs[0])
+    staticModel = get_static_model(model, inputShape)
+    rows = get_layer_rows(staticModel, batchSize)
+    recomputed = [x for x in rows if x["segment"] is not None]
+
+    report = {
+        "model": model.name,
+        "batchSize": batchSize,
+        "inputShape": list(inputShape),
+        "params": model.count_params(),
+        "trainableParams": int(sum(np.prod(x.shape) for x in model.trainable_weights)),
+        "macs": sum(x["macs"] for x in rows),
+        "flops": sum(x["flops"] for x in rows),
+        # every layer output is kept for the backward pass during training, except inside recomputed blocks
+        "trainActivationBytes": get_recompute_activation_bytes(rows),
+        "recompute": {
+            "segments": len(set(x["segment"] for x in recomputed)),
+            "trainActivationBytesWithout": sum(x["activationBytes"] for x in rows),
+            "flops": sum(x["flops"] for x in recomputed),
+        },
+        "inferencePeakActivationBytes": get_peak_activation_bytes(staticModel, batchSize),
+        "layers": rows,
+    }
+    if measureLatency:
+        report["latency"] = measure_latency(model, batchSize, inputShape, numRuns)
+    return report
+
+def format_cost_report(report):
+    lines = ["Model: {}, batch size {}, input {}".format(report["model"], report["batchSize"], tuple(report["inputShape"])), ""]
+    lines.append("{:<48} {:<20} {:<24} {:>12} {:>16} {:>14}".format("layer", "type", "output shape", "params", "MACs", "activ. (MB)"))
+    for row in report["layers"]:
+        lines.append("{:<48} {:<20} {:<24} {:>12,} {:>16,} {:>14.2f}".format(row["name"][:48], row["type"][:20],
+            str(row["outputShape"])[:24], row["params"], row["macs"], row["activationBytes"] / 2**20))
+    lines.append("")
+    lines.append("Total params: {:,} (trainable {:,})".format(report["params"], report["trainableParams"]))
+    lines.append("Total MACs: {:,} ({:.2f} GFLOPs)".format(report["macs"], report["flops"] / 1e9))
+    lines.append("Activation memory: training {:.1f} MB, inference peak {:.1f} MB".format(
+        report["trainActivationBytes"] / 2**20, report["inferencePeakActivationBytes"] / 2**20))
+    recompute = report.get("recompute", {})
+    if recompute.get("segments"):
+        without = recompute["trainActivationBytesWithout"]
+        lines.append("Recomputation: {} blocks, saves {:.1f} MB of {:.1f} MB training activations ({:.0%}) for {:.2f} extra GFLOPs".format(
+            recompute["segments"], (without - report["trainActivationBytes"]) / 2**20, without / 2**20,
+            1 - report["trainActivationBytes"] / max(without, 1), recompute["flops"] / 1e9))
+    if "latency" in report:
+        latency = report["latency"]
+        lines.append("CPU latency per batch: median {:.1f} ms, p90 {:.1f} ms, {:.1f} samples/s".format(
+            latency["median"] * 1000, latency["p90"] * 1000, latency["samplesPerSec"]))
+    return '\n'.join(lines) + '\n'
+
+def save_cost_report(report, txtFilename, jsonFilename = None):
+    with open(txtFilename, 'w', encoding='utf-8') as f:
+        f.write(format_cost_report(report))
+    if jsonFilename is not None:
+        with open(jsonFilename, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1, default=str)
+
+def format_cost_comparison(reports):
+    # One line per model, for choosing an architecture against a latency or memory budget
+    lines = ["{:<24} {:>14} {:>12} {:>16} {:>18} {:>16} {:>12} {:>12}".format("model", "params", "GFLOPs", "train act. (MB)",
+        "recomp. saved (MB)", "infer act. (MB)", "latency (ms)", "samples/s")]
+    for name, report in reports.items():
+        latency = report.get("latency", {})
+        saved = report.get("recompute", {}).get("trainActivationBytesWithout", report["trainActivationBytes"]) - report["trainActivationBytes"]
+        lines.append("{:<24} {:>14,} {:>12.2f} {:>16.1f} {:>18.1f} {:>16.1f} {:>12} {:>12}".format(name, report["params"], report["flops"] / 1e9,
+            report["trainActivationBytes"] / 2**20, saved / 2**20, report["inferencePeakActivationBytes"] / 2**20,
+            "{:.1f}".format(latency["median"] * 1000) if latency else "-", "{:.1f}".format(latency["samplesPerSec"]) if latency else "-"))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*
+
+import json
+import os
+import shutil
+import subprocess
+from os.path import join
+
+import tensorflow as tf
+from tensorflow.keras.callbacks import BackupAndRestore, Callback
+
+if __name__ == "__main__":
+    import hsi_io
+    import train_utils
+    import train_callbacks
+    import model_registry
+    import profiling
+else:
+    from . import hsi_io
+    from . import train_utils
+    from . import train_callbacks
+    from . import model_registry
+    from . import profiling
+
+DEFAULT_PORT = 23456
+WEIGHTS_NAME = 'weights'
+
+######################### Cluster #########################
+
+def parse_hosts(hosts, port = DEFAULT_PORT):
+    # 'node1,node2:2223' or a list of hosts, hosts without a port get the default one
+    if isinstance(hosts, str):
+        hosts = [x.strip() for x in hosts.split(',') if x.strip()]
+    return [x if ':' in x else x + ':' + str(port) for x in hosts]
+
+def get_local_hosts(numWorkers, port = DEFAULT_PORT):
+    return ['localhost:' + str(port + i) for i in range(numWorkers)]
+
+def get_tf_config(hosts, taskIndex):
+    return {"cluster": {"worker": parse_hosts(hosts)}, "task": {"type": "worker", "index": taskIndex}}
+
+def get_task():
+    # (taskIndex, numWorkers) of this process from TF_CONFIG, (0, 1) without it
+    config = json.loads(os.environ.get('TF_CONFIG') or '{}')
+    if not config:
+        return 0, 1
+    return config["task"]["index"], len(config["cluster"]["worker"])
+
+def is_chief(taskIndex = None):
+    # worker 0 writes the artifacts and the checkpoints that are kept
+    return (get_task()[0] if taskIndex is None else taskIndex) == 0
+
+def get_strategy(hosts = None, taskIndex = 0):
+    """Creates the MultiWorkerMirroredStrategy, with TF_CONFIG generated from hosts when given.
+
+    Must be called at startup, before any other TF op of the process.
+    """
+
+    if hosts is not None:
+        os.environ['TF_CONFIG'] = json.dumps(get_tf_config(hosts, taskIndex))
+    # ring all-reduce, the CPU-only nodes have no NCCL
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING)
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+def launch_local(numWorkers, command, port = DEFAULT_PORT, numThreads = None):
+    """Runs command once per worker on this machine, with --hosts and --index appended. Returns the worst exit code."""
+
+    hosts = ','.join(get_local_hosts(numWorkers, port))
+    numThreads = max(1, (os.cpu_count() or 1) // numWorkers) if numThreads is None else numThreads
+    # CPU workers, as on the nodes
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    env.pop('TF_CONFIG', None)
+    processes = [subprocess.Popen(list(command) + ['--hosts', hosts, '--index', str(i), '--threads', str(numThreads)], env=env)
+        for i in range(numWorkers)]
+    return max(abs(process.wait()) for process in processes)
+
+######################### Data #########################
+
+def load_shard(fold = None, taskIndex = 0, numWorkers = 1):
+    # Each worker reads only its own samples from the h5 files
+    x_train, y_train, _ = hsi_io.load_data('train', fold, (taskIndex, numWorkers))
+    x_test, y_test, _ = hsi_io.load_data('test', fold, (taskIndex, numWorkers))
+    return x_train, y_train, x_test, y_test
+
+def get_dataset_creator(x, y, globalBatchSize, shuffle = True, seed = 0):
+    # The arrays are already this worker's shard, so the input pipeline does no further sharding
+    def dataset_fn(inputContext):
+        dataset = tf.data.Dataset.from_tensor_slices((x, y))
+        if shuffle:
+            dataset = dataset.shuffle(len(x), seed=seed + inputContext.input_pipeline_id, reshuffle_each_iteration=True)
+        batchSize = inputContext.get_per_replica_batch_size(globalBatchSize)
+        return dataset.batch(batchSize, drop_remainder=True).repeat().prefetch(tf.data.AUTOTUNE)
+    return tf.keras.utils.experimental.DatasetCreator(dataset_fn)
+
+def get_steps(numSamples, batchSize):
+    # the shards have equal size, so all workers run the same number of steps
+    return max(numSamples // batchSize, 1)
+
+######################### Checkpoints #########################
+
+def get_worker_dir(path, taskIndex):
+    # All workers must take part in a save, the other workers write to a temporary directory that is removed
+    return path if is_chief(taskIndex) else join(path, 'worker' + str(taskIndex) + '_tmp')
+
+def get_worker_folder(framework, taskIndex):
+    # Output folder for the artifacts of one worker, only the chief's is the framework folder
+    return framework if is_chief(taskIndex) else framework + '_worker' + str(taskIndex)
+
+class WorkerCheckpoint(Callback):
+    # Saves the weights every period epochs and at the end of training, coordinated across the workers
+
+    def __init__(self, checkpointDir, taskIndex, period = 1):
+        super().__init__()
+        self.checkpointDir = checkpointDir
+        self.taskIndex = taskIndex
+        self.period = period
+
+    def save(self):
+        saveDir = get_worker_dir(self.checkpointDir, self.taskIndex)
+        self.model.save_weights(join(saveDir, WEIGHTS_NAME))
+        if not is_chief(self.taskIndex):
+            shutil.rmtree(saveDir, ignore_errors=True)
+
+    def on_epoch_end(self, epoch, logs = None):
+        if (epoch + 1) % self.period == 0:
+            self.save()
+
+    def on_train_end(self, logs = None):
+        self.save()
+
+def get_checkpoint_dir(framework):
+    return os.path.dirname(train_utils.get_model_filename('', 'txt', join(framework, 'checkpoints')))
+
+######################### Training #########################
+
+@profiling.profiled('fit_distributed')
+def fit_distributed(strategy, framework, height, width, numChannels, numClasses, numEpochs = 200, batchSize = 4, fold = None,
+    optimizerName = "RMSProp", learning_rate = 0.0001, decay = 0, lossFunction = "BCE+JC", builderArgs = None, checkpointPeriod = 1):
+    """Data-parallel training of a registry builder with the weights mirrored on every worker.
+
+    batchSize is per worker, gradients are all-reduced over the numWorkers * batchSize samples of a step.
+    Each worker loads its shard of the h5 data. BackupAndRestore resumes an interrupted run from the last epoch,
+    WorkerCheckpoint keeps the chief's weights under <framework>/checkpoints. Returns (model, history).
+    """
+
+    taskIndex, numWorkers = get_task()
+    folder = get_worker_folder(framework, taskIndex)
+    x_train, y_train, x_test, y_test = load_shard(fold, taskIndex, numWorkers)
+    globalBatchSize = batchSize * strategy.num_replicas_in_sync
+
+    with strategy.scope():
+        model = model_registry.build_model(framework, height, width, numChannels, numClasses, builderArgs)
+        model = train_utils.compile_custom(folder, model, optimizerName, learning_rate, decay, lossFunction)
+
+    checkpointDir = get_checkpoint_dir(framework)
+    callbacks = [
+        BackupAndRestore(backup_dir=join(checkpointDir, 'backup')),
+        WorkerCheckpoint(checkpointDir, taskIndex, checkpointPeriod),
+        train_callbacks.ThroughputMonitor(globalBatchSize, len(x_train) * numWorkers, train_utils.get_model_filename('throughput', 'json', folder)),
+    ]
+    history = model.fit(
+        x=get_dataset_creator(x_train, y_train, globalBatchSize, seed=taskIndex),
+        epochs=numEpochs,
+        steps_per_epoch=get_steps(len(x_train), batchSize),
+        validation_data=get_dataset_creator(x_test, y_test, globalBatchSize, shuffle=False),
+        validation_steps=get_steps(len(x_test), batchSize),
+        callbacks=callbacks,
+        )
+
+    if is_chief(taskIndex):
+        train_utils.plot_history(history, folder)
+    return model, history
+
+def get_local_model(model, framework, height, width, numChannels, numClasses, builderArgs = None):
+    # A copy outside the strategy, for evaluation and saving on the chief alone
+    localModel = model_registry.build_model(framework, height, width, numChannels, numClasses, builderArgs)
+    localModel.set_weights(model.get_weights())
+    return localModel
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*
+
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+if __name__ == "__main__":
+    import model_registry
+    import profiling
+    import tta_utils
+else:
+    from . import model_registry
+    from . import profiling
+    from . import tta_utils
+
+DEFAULT_THRESHOLD = 0.5
+ENSEMBLE_METHODS = ['mean', 'vote']
+
+######################### Models #########################
+
+def find_fold_models(framework, registry = None, runDate = None):
+    # Registry names of the cross-validation models framework_<fold>_<date>, the most recent entry of each fold
+    registry = model_registry.get_registry() if registry is None else registry
+    pattern = re.compile(re.escape(framework) + r'_(\d+)_(.+)$')
+    latest = {}
+    for entry in registry.list_entries():
+        match = pattern.match(entry["name"])
+        if match is None or (runDate is not None and match.group(2) != runDate):
+            continue
+        fold = int(match.group(1))
+        if fold not in latest or entry["created"] > latest[fold]["created"]:
+            latest[fold] = entry
+    return [latest[fold]["name"] for fold in sorted(latest)]
+
+def get_preprocessing_key(metadata):
+    # Models with the same band selection and preprocessing share one preprocessed copy of the input
+    return json.dumps([metadata.get("bands"), metadata.get("preprocessing")], sort_keys=True)
+
+def as_model_input(x, metadata):
+    # The 3D models take (H, W, bands, 1), a view with the extra axis avoids a copy
+    return x[..., np.newaxis] if len(metadata["inputShape"]) == x.ndim else x
+
+######################### Ensemble #########################
+
+class EnsemblePredictor:
+    """Runs several models on the same batches and combines their probability maps.
+
+    The input is read and preprocessed once per batch for each group of models with the same preprocessing.
+    method 'mean' averages the probabilities (weighted by weights), 'vote' returns the fraction of models
+    whose probability reaches threshold, so that 0.5 is the majority vote. With numThreads > 1 the models
+    of a batch run on a thread pool, TF releases the GIL in predict_on_batch. With transforms, every model
+    predicts its test-time variants in one call, see tta_utils.
+    Has the predict_on_batch of a model, so it can be passed to eval_utils.EvaluationSession.
+    """
+
+    def __init__(self, models, metadatas, method = 'mean', weights = None, threshold = DEFAULT_THRESHOLD, numThreads = None,
+        transforms = None):
+        if method not in ENSEMBLE_METHODS:
+            raise ValueError("Unknown ensemble method: " + str(method))
+        self.models = [tta_utils.with_tta(model, transforms) for model in models]
+        self.metadatas = list(metadatas)
+        self.method = method
+        self.threshold = threshold
+        weights = np.ones(len(self.models)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.weights = weights / weights.sum()
+        self.name = 'ensemble_' + method + '_' + str(len(self.models))
+
+        self.groups = {}
+        for i, metadata in enumerate(self.metadatas):
+            self.groups.setdefault(get_preprocessing_key(metadata), []).append(i)
+
+        numThreads = min(len(self.models), os.cpu_count() or 1) if numThreads is None else numThreads
+        self.pool = ThreadPoolExecutor(max_workers=numThreads) if numThreads > 1 else None
+
+    @classmethod
+    def from_registry(cls, names, registry = None, executionMode = None, **kwargs):
+        registry = model_registry.get_registry() if registry is None else registry
+        loaded = [registry.load(name, executionMode) for name in names]
+        predictor = cls([x[0] for x in loaded], [x[1] for x in loaded], **kwargs)
+        predictor.warm_up()
+        return predictor
+
+    def warm_up(self):
+        # Traces the predict function of every model before they are called from several threads
+        for model, metadata in zip(self.models, self.metadatas):
+            model.predict_on_batch(np.zeros([1] + list(metadata["inputShape"]), dtype=np.float32))
+
+    def predict_model(self, i, inputs):
+        metadata = self.metadatas[i]
+        x = as_model_input(inputs[get_preprocessing_key(metadata)], metadata)
+        return np.asarray(self.models[i].predict_on_batch(x), dtype=np.float32)
+
+    def predict_models(self, x):
+        # One output per model for a batch of raw cubes
+        inputs = {key: model_registry.preprocess(x, self.metadatas[indices[0]]) for key, indices in self.groups.items()}
+        if self.pool is None:
+            return [self.predict_model(i, inputs) for i in range(len(self.models))]
+        return list(self.pool.map(lambda i: self.predict_model(i, inputs), range(len(self.models))))
+
+    def combine(self, preds):
+        out = np.zeros(preds[0].shape, dtype=np.float32)
+        for pred, weight in zip(preds, self.weights):
+            out += weight * (pred >= self.threshold if self.method == 'vote' else pred)
+        return out
+
+    def predict_on_batch(self, x):
+        return self.combine(self.predict_models(x))
+
+    @profiling.profiled('ensemble_predict')
+    def predict(self, x, batchSize = 32):
+        return np.concatenate([self.predict_on_batch(x[i:i + batchSize]) for i in range(0, len(x), batchSize)], axis=0)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+def load_ensemble(framework, registry = None, runDate = None, **kwargs):
+    # All fold models of a cross-validation run of framework
+    names = find_fold_models(framework, registry, runDate)
+    if not names:
+        raise KeyError("No fold models of " + framework + " in the registry")
+    return EnsemblePredictor.from_registry(names, registry, **kwargs)
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*
+
+import numpy as np
+from scipy.io import savemat
+
+if __name__ == "__main__":
+    import train_utils
+    import metrics_utils
+    import artifact_writer
+    import profiling
+    import tta_utils
+else:
+    from . import train_utils
+    from . import metrics_utils
+    from . import artifact_writer
+    from . import profiling
+    from . import tta_utils
+
+############################### Evaluation Session ##############
+
+def freeze_array(x):
+    # Read-only copy, so that nothing downstream can modify the evaluation inputs
+    frozen = np.array(x, copy=True)
+    frozen.flags.writeable = False
+    return frozen
+
+class EvaluationSession:
+    """Predicts the test set once and serves ROC, metrics and visualization from the cached predictions.
+
+    The test inputs are copied and frozen when the session is created, so they can be
+    captured before training and reused afterwards without reloading from disk.
+    If cacheFile is given, predictions are written to a .npy file and served memory-mapped.
+    """
+
+    def __init__(self, x_test, y_test, names = None, cacheFile = None):
+        self.x_test = freeze_array(x_test)
+        self.y_test = freeze_array(y_test)
+        if names is None:
+            names = [str(i) for i in range(len(self.x_test))]
+        self.names = list(names)
+        self.cacheFile = cacheFile
+        self.model = None
+        self.transforms = None
+        self.preds = None
+
+    @profiling.profiled('predict')
+    def predict(self, model, batchSize = 32, transforms = None):
+        # transforms: test-time augmentation in tta_utils, each batch of batchSize cubes is predicted with its variants
+        if self.preds is not None and model is self.model and transforms == self.transforms:
+            return self.preds
+
+        predictor = tta_utils.with_tta(model, transforms)
+        numSamples = self.x_test.shape[0]
+        preds = None
+        for start in range(0, numSamples, batchSize):
+            batchPreds = np.asarray(predictor.predict_on_batch(self.x_test[start:start + batchSize]))
+            if preds is None:
+                predShape = (numSamples,) + batchPreds.shape[1:]
+                if self.cacheFile is None:
+                    preds = np.empty(predShape, dtype=batchPreds.dtype)
+                else:
+                    preds = np.lib.format.open_memmap(self.cacheFile, mode='w+', dtype=batchPreds.dtype, shape=predShape)
+            preds[start:start + batchPreds.shape[0]] = batchPreds
+
+        if self.cacheFile is not None:
+            preds.flush()
+            del preds
+            preds = np.load(self.cacheFile, mmap_mode='r')
+        else:
+            preds.flags.writeable = False
+
+        self.model = model
+        self.transforms = transforms
+        self.preds = preds
+        return self.preds
+
+    def get_predictions(self):
+        if self.preds is None:
+            raise RuntimeError("EvaluationSession.predict() must be called before using the predictions.")
+        return self.preds
+
+    def get_roc(self, numBins = metrics_utils.DEFAULT_ROC_BINS):
+        return metrics_utils.get_binned_roc(self.y_test, self.get_predictions(), numBins)
+
+    def calc_plot_roc(self, modelName, folder):
+        return train_utils.calc_plot_roc(self.model, self.x_test, self.y_test, modelName, folder, self.get_predictions())
+
+    def evaluate(self, history, framework, folder):
+        return train_utils.evaluate_model(self.model, history, framework, folder, self.x_test, self.y_test, self.get_predictions())
+
+    def save_evaluate(self, history, framework, folder):
+        return train_utils.save_evaluate_model(self.model, history, framework, folder, self.x_test, self.y_test, self.get_predictions())
+
+    def get_iou_scores(self):
+        iouScores = metrics_utils.get_soft_iou(self.y_test, self.get_predictions())
+        return [round(x * 100, 2) for x in iouScores]
+
+    def get_metrics(self, thresholds = metrics_utils.DEFAULT_THRESHOLDS):
+        return metrics_utils.get_segmentation_metrics(self.y_test, self.get_predictions(), thresholds)
+
+    def save_metrics(self, folder, thresholds = metrics_utils.DEFAULT_THRESHOLDS):
+        metricsDict = self.get_metrics(thresholds)
+        metricsDict['names'] = self.names
+        filename = train_utils.get_model_filename('0_metrics', 'mat', folder)
+        savemat(filename, metricsDict)
+        return metricsDict
+
+    @profiling.profiled('visualize')
+    def visualize(self, folder, writer = None):
+        # Rendering runs on the background artifact writer unless another writer is given
+        if writer is None:
+            writer = artifact_writer.get_writer()
+        for (hsi, gt, id, pred, iou) in zip(self.x_test, self.y_test, self.names, self.get_predictions(), self.get_iou_scores()):
+            train_utils.visualize(hsi, gt, pred, folder, iou, id, writer)
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*
+
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import time
+import traceback
+from contextlib import contextmanager
+
+import tensorflow as tf
+
+if __name__ == "__main__":
+    import experiment_utils
+    import experiment_worker
+    import profiling
+    import results_store
+else:
+    from . import experiment_utils
+    from . import experiment_worker
+    from . import profiling
+    from . import results_store
+
+DEFAULT_POLL_INTERVAL = 1.0
+
+######################### Jobs #########################
+
+def expand_jobs(spec, runDate = None):
+    """Expands a declarative spec into a list of jobs.
+
+    spec = {"frameworks": ["cnn3d", "xception3d_10n"], "folds": [1, 2, 3],
+            "settings": {"learning_rate": [0.001, 0.0001], "numEpochs": 100},
+            "jobs": [{"framework": "sm_resnet", "fold": 1}], "runDate": "2024-05-02"}
+    Every framework is combined with every fold and every combination of list-valued settings;
+    explicit "jobs" are appended as they are. The run date, runDate or the spec's "runDate", is part of
+    the job names, so a schedule resumed on another day needs the date of its first run.
+    """
+
+    runDate = spec.get("runDate") if runDate is None else runDate
+
+    settings = spec.get("settings", {})
+    keys = sorted(settings)
+    values = [settings[k] if isinstance(settings[k], list) else [settings[k]] for k in keys]
+
+    jobs = []
+    for framework in spec.get("frameworks", []):
+        for fold in spec.get("folds", [None]):
+            for combination in itertools.product(*values):
+                job = {"framework": framework, "fold": fold}
+                job.update(dict(zip(keys, combination)))
+                jobs.append(job)
+    jobs += [dict(x) for x in spec.get("jobs", [])]
+    if runDate is not None:
+        for job in jobs:
+            job.setdefault("runDate", runDate)
+    return jobs
+
+def load_spec(filename):
+    with open(filename, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+######################### Job process #########################
+
+def get_process_rss(pid):
+    try:
+        with open('/proc/' + str(pid) + '/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+THREAD_LIMIT_VARIABLES = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+@contextmanager
+def thread_limit_environment(numThreads):
+    # The BLAS and OpenMP pools read these when numpy and TF are imported, which the spawned child does
+    # before running the job, so they are set in the parent while it starts the child and then restored
+    if numThreads is None:
+        yield
+        return
+    previous = {name: os.environ.get(name) for name in THREAD_LIMIT_VARIABLES}
+    os.environ.update({name: str(numThreads) for name in THREAD_LIMIT_VARIABLES})
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def set_thread_limit(numThreads):
+    # Must run in the job process before its first TF op
+    tf.config.threading.set_intra_op_parallelism_threads(numThreads)
+    tf.config.threading.set_inter_op_parallelism_threads(min(2, numThreads))
+
+def run_job_process(job, name, numThreads, cacheDir, resultQueue):
+    # name is the one of the scheduler, a name computed here could have another date
+    if numThreads is not None:
+        set_thread_limit(numThreads)
+    try:
+        result = experiment_utils.run_experiment(job, experiment_utils.DatasetCache(cacheDir), name=name)
+        resultQueue.put((name, 'done', {k: result[k] for k in ["folder", "metrics", "timings"]}))
+    except Exception as error:
+        resultQueue.put((name, 'failed', {"error": repr(error), "traceback": traceback.format_exc()}))
+
+######################### Scheduler #########################
+
+class ExperimentScheduler:
+    """Runs jobs in a pool of worker processes, one fresh process per job.
+
+    Each job gets numThreads CPU threads and is killed when its RSS exceeds memoryLimitMB.
+    Failed jobs are retried up to maxRetries times. Jobs whose 0_result.json already exists are
+    skipped, so a crashed schedule can simply be restarted. Datasets are shared between the job
+    processes through the memory-mapped cache of experiment_utils.DatasetCache.
+    """
+
+    def __init__(self, jobs, numWorkers = 1, numThreads = None, memoryLimitMB = None, maxRetries = 1, skipCompleted = True,
+        cacheDir = None, pollInterval = DEFAULT_POLL_INTERVAL, statusFile = None):
+        self.numWorkers = numWorkers
+        self.numThreads = max(1, (os.cpu_count() or 1) // numWorkers) if numThreads is None else numThreads
+        self.memoryLimit = None if memoryLimitMB is None else memoryLimitMB * 2**20
+        self.maxRetries = maxRetries
+        self.skipCompleted = skipCompleted
+        self.cacheDir = experiment_worker.get_default_cache_dir() if cacheDir is None else cacheDir
+        self.pollInterval = pollInterval
+        self.statusFile = statusFile
+        self.context = multiprocessing.get_context('spawn')
+        self.resultQueue = self.context.Queue()
+
+        self.entries = {}
+        for job in jobs:
+            name = experiment_utils.get_job_name(job)
+            if name in self.entries:
+                print("Skipping duplicate job", name)
+                continue
+            self.entries[name] = {"name": name, "job": job, "status": 'pending', "attempts": 0, "result": None}
+
+    def start_job(self, entry):
+        entry["attempts"] += 1
+        entry["status"] = 'running'
+        entry["started"] = time.time()
+        entry.pop("exited", None)
+        entry["process"] = self.context.Process(target=run_job_process,
+            args=(entry["job"], entry["name"], self.numThreads, self.cacheDir, self.resultQueue), daemon=True)
+        with thread_limit_environment(self.numThreads):
+            entry["process"].start()
+
+    def finish_job(self, entry, status, result):
+        process = entry.pop("process", None)
+        if process is not None:
+            process.join(timeout=10)
+        entry["finished"] = time.time()
+        entry["result"] = result
+        if status == 'failed' and entry["attempts"] <= self.maxRetries:
+            print("Job", entry["name"], "failed, retrying:", result.get("error"))
+            entry["status"] = 'pending'
+        else:
+            entry["status"] = status
+
+    def check_running(self, running):
+        # Results reported by the job processes
+        while True:
+            try:
+                name, status, result = self.resultQueue.get_nowait()
+            except queue.Empty:
+                break
+            if name in self.entries and self.entries[name]["status"] == 'running':
+                self.finish_job(self.entries[name], status, result)
+
+        for entry in running:
+            if entry["status"] != 'running':
+                continue
+            process = entry["process"]
+            if self.memoryLimit is not None:
+                rss = get_process_rss(process.pid)
+                if rss is not None and rss > self.memoryLimit:
+                    process.kill()
+                    self.finish_job(entry, 'failed', {"error": "memory limit exceeded ({:.0f} MB)".format(rss / 2**20)})
+                    continue
+            if not process.is_alive():
+                # give a result that is still in the queue one more poll
+                if entry.get("exited") is None:
+                    entry["exited"] = time.time()
+                elif time.time() - entry["exited"] > self.pollInterval:
+                    self.finish_job(entry, 'failed', {"error": "process exited with code " + str(process.exitcode)})
+
+    def get_counts(self):
+        counts = {}
+        for entry in self.entries.values():
+            counts[entry["status"]] = counts.get(entry["status"], 0) + 1
+        return counts
+
+    def report_progress(self, startTime):
+        counts = self.get_counts()
+        total = len(self.entries)
+        finished = counts.get('done', 0) + counts.get('failed', 0) + counts.get('skipped', 0)
+        elapsed = time.time() - startTime
+        ran = counts.get('done', 0) + counts.get('failed', 0)
+        eta = elapsed / ran * (total - finished) if ran else None
+        print("[{}/{}] running {}, done {}, failed {}, skipped {}, elapsed {:.0f} s, ETA {}".format(finished, total,
+            counts.get('running', 0), counts.get('done', 0), counts.get('failed', 0), counts.get('skipped', 0), elapsed,
+            "-" if eta is None else "{:.0f} s".format(eta)))
+        if self.statusFile is not None:
+            entries = [{k: v for k, v in x.items() if k != "process"} for x in self.entries.values()]
+            with open(self.statusFile, 'w', encoding='utf-8') as f:
+                json.dump(results_store.to_jsonable({"counts": counts, "jobs": entries}), f, indent=1, default=str)
+
+    @profiling.profiled('schedule')
+    def run(self):
+        startTime = time.time()
+        if self.skipCompleted:
+            for entry in self.entries.values():
+                if experiment_utils.load_result(entry["name"]) is not None:
+                    entry["status"] = 'skipped'
+
+        lastCounts = None
+        while True:
+            running = [x for x in self.entries.values() if x["status"] == 'running']
+            self.check_running(running)
+
+            running = [x for x in self.entries.values() if x["status"] == 'running']
+            pending = [x for x in self.entries.values() if x["status"] == 'pending']
+            for entry in pending[:max(self.numWorkers - len(running), 0)]:
+                print("Starting job", entry["name"], "attempt", entry["attempts"] + 1)
+                self.start_job(entry)
+
+            counts = self.get_counts()
+            if counts != lastCounts:
+                self.report_progress(startTime)
+                lastCounts = counts
+            if not counts.get('running') and not counts.get('pending'):
+                break
+            time.sleep(self.pollInterval)
+
+        return {name: {k: v for k, v in x.items() if k != "process"} for name, x in self.entries.items()}
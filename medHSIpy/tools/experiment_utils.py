@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*
+
+import json
+import os
+import time
+from datetime import date
+from os.path import join
+
+import numpy as np
+from keras import backend
+
+if __name__ == "__main__":
+    import hsi_io
+    import train_utils
+    import eval_utils
+    import results_store
+    import artifact_writer
+    import model_registry
+    import cnn_models as cmdl
+    import xception_models as xmdl
+    import hsi_segment_from_sm as segsm
+else:
+    from . import hsi_io
+    from . import train_utils
+    from . import eval_utils
+    from . import results_store
+    from . import artifact_writer
+    from . import model_registry
+    from . import cnn_models as cmdl
+    from . import xception_models as xmdl
+    from . import hsi_segment_from_sm as segsm
+
+RESULT_FILENAME = '0_result'
+
+# Same settings as the segment*.py drivers
+DEFAULT_SETTINGS = {
+    "height": 32,
+    "width": 32,
+    "numChannels": 311,
+    "numClasses": 1,
+    "numEpochs": 200,
+    "batchSize": None,
+    "optimizerName": "RMSProp",
+    "learning_rate": 0.0001,
+    "decay": 0,
+    "lossFunction": "BCE+JC",
+    "executionMode": None,
+    "blockType": 'full',
+    "accumulationSteps": 1,
+    "checkpointPolicy": None,
+}
+
+# Settings that are part of the run name when they differ from the defaults
+NAMED_SETTINGS = ['optimizerName', 'learning_rate', 'decay', 'lossFunction', 'numEpochs', 'batchSize', 'executionMode', 'blockType', 'accumulationSteps',
+    'checkpointPolicy']
+
+######################### Jobs #########################
+
+def get_job_settings(job):
+    # A job is a dict with 'framework', optional 'fold' and 'name', and any of DEFAULT_SETTINGS
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({k: v for k, v in job.items() if k in DEFAULT_SETTINGS})
+    return settings
+
+def get_job_name(job, runDate = None):
+    # Deterministic for a run date, so that a rerun of the same job writes to the same folder.
+    # The date is runDate, else the job's 'runDate', else today.
+    if job.get("name") is not None:
+        return job["name"]
+    runDate = job.get("runDate") if runDate is None else runDate
+    settings = get_job_settings(job)
+    parts = [job["framework"]]
+    if job.get("fold") is not None:
+        parts.append(str(job["fold"]))
+    parts += [k + str(settings[k]) for k in NAMED_SETTINGS if settings[k] != DEFAULT_SETTINGS[k]]
+    parts.append(str(date.today()) if runDate is None else runDate)
+    return '_'.join(parts).replace(os.sep, '-')
+
+def get_result_folder(name):
+    return os.path.dirname(train_utils.get_model_filename(RESULT_FILENAME, 'json', name))
+
+def get_result_filename(name):
+    return train_utils.get_model_filename(RESULT_FILENAME, 'json', name)
+
+def load_result(name):
+    # The saved result of a finished job, or None
+    try:
+        with open(get_result_filename(name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+######################### Data #########################
+
+class DatasetCache:
+    """Train/test splits per fold, loaded once and kept read-only in memory.
+
+    With cacheDir, loaded arrays are also written as .npy files and later opened memory-mapped,
+    so several processes share one copy through the page cache.
+    """
+
+    def __init__(self, cacheDir = None):
+        self.cacheDir = cacheDir
+        self.datasets = {}
+
+    def get_cache_prefix(self, fold):
+        return join(self.cacheDir, 'fold_' + ('full' if fold is None else str(fold)))
+
+    def load_cached(self, fold):
+        prefix = self.get_cache_prefix(fold)
+        if not os.path.isfile(prefix + '_names.json'):
+            return None
+        arrays = [np.load(prefix + '_' + x + '.npy', mmap_mode='r') for x in ['x_train', 'x_test', 'y_train', 'y_test']]
+        with open(prefix + '_names.json', 'r', encoding='utf-8') as f:
+            names = json.load(f)
+        return tuple(arrays) + (names["train"], names["test"])
+
+    def save_cached(self, fold, data):
+        os.makedirs(self.cacheDir, exist_ok=True)
+        prefix = self.get_cache_prefix(fold)
+        for x, array in zip(['x_train', 'x_test', 'y_train', 'y_test'], data[0:4]):
+            tmpFilename = prefix + '_' + x + '.' + str(os.getpid()) + '.tmp.npy'
+            np.save(tmpFilename, array)
+            os.replace(tmpFilename, prefix + '_' + x + '.npy')
+        # the names file is written last and marks a complete cache
+        tmpFilename = prefix + '_names.' + str(os.getpid()) + '.tmp.json'
+        with open(tmpFilename, 'w', encoding='utf-8') as f:
+            json.dump({"train": list(data[4]), "test": list(data[5])}, f)
+        os.replace(tmpFilename, prefix + '_names.json')
+
+    def get(self, fold = None):
+        if fold in self.datasets:
+            return self.datasets[fold]
+
+        data = self.load_cached(fold) if self.cacheDir is not None else None
+        if data is None:
+            data = hsi_io.get_train_test(fold)
+            if self.cacheDir is not None:
+                self.save_cached(fold, data)
+                data = self.load_cached(fold)
+            else:
+                data = tuple(eval_utils.freeze_array(x) for x in data[0:4]) + tuple(data[4:6])
+        self.datasets[fold] = data
+        return data
+
+    def clear(self):
+        self.datasets.clear()
+
+######################### Run #########################
+
+def get_builder_args(settings):
+    # the recomputed blocks change the layer structure, so the registry rebuilds the model with the same policy
+    builderArgs = {"blockType": settings["blockType"]}
+    if settings["checkpointPolicy"] is not None:
+        builderArgs["checkpointPolicy"] = settings["checkpointPolicy"]
+    return builderArgs
+
+def train_framework(framework, name, xtrain, ytrain, xtest, ytest, settings):
+    # the builders take the run name as framework, it also names the output folder
+    s = settings
+    batchSize = {} if s["batchSize"] is None else {"batchSize": s["batchSize"]}
+    if 'sm' in framework:
+        return segsm.fit_sm_model(name, xtrain, ytrain, xtest, ytest, s["height"], s["width"], s["numChannels"], s["numClasses"],
+            s["numEpochs"], s["optimizerName"], s["learning_rate"], s["decay"], s["lossFunction"], executionMode=s["executionMode"])
+    elif 'cnn3d' in framework:
+        return cmdl.get_cnn_model(name, xtrain, ytrain, xtest, ytest, s["height"], s["width"], s["numChannels"], s["numClasses"],
+            s["numEpochs"], optimizerName=s["optimizerName"], learning_rate=s["learning_rate"], decay=s["decay"],
+            lossFunction=s["lossFunction"], executionMode=s["executionMode"], blockType=s["blockType"],
+            accumulationSteps=s["accumulationSteps"], checkpointPolicy=s["checkpointPolicy"], **batchSize)
+    else:
+        return xmdl.get_xception_model(name, xtrain, ytrain, xtest, ytest, s["height"], s["width"], s["numChannels"], s["numClasses"],
+            s["numEpochs"], optimizerName=s["optimizerName"], learning_rate=s["learning_rate"], decay=s["decay"],
+            lossFunction=s["lossFunction"], executionMode=s["executionMode"], blockType=s["blockType"],
+            accumulationSteps=s["accumulationSteps"], checkpointPolicy=s["checkpointPolicy"], **batchSize)
+
+def run_experiment(job, datasets = None, registry = None, saveModel = True, name = None):
+    """Trains and evaluates one job, saves its artifacts and a 0_result.json, and returns the result."""
+
+    datasets = DatasetCache() if datasets is None else datasets
+    # a scheduler passes the name it computed, so that a job running past midnight keeps it
+    name = get_job_name(job) if name is None else name
+    settings = get_job_settings(job)
+    timings = {}
+
+    startTime = time.time()
+    X_train, X_test, y_train, y_test, names_train, names_test = datasets.get(job.get("fold"))
+    timings["data"] = time.time() - startTime
+
+    backend.clear_session()
+    startTime = time.time()
+    model, history = train_framework(job["framework"], name, X_train, y_train, X_test, y_test, settings)
+    timings["fit"] = time.time() - startTime
+
+    startTime = time.time()
+    session = eval_utils.EvaluationSession(X_test, y_test, names_test)
+    session.predict(model)
+    [fpr, tpr, auc, trainEval, testEval] = session.evaluate(history, name, name)
+    session.save_metrics(name, [0.3, 0.5, 0.7])
+    session.visualize(name)
+    timings["evaluate"] = time.time() - startTime
+
+    if saveModel:
+        (model_registry.get_registry() if registry is None else registry).save(model, name, settings["height"], settings["width"],
+            settings["numChannels"], settings["numClasses"], None if 'sm' in job["framework"] else get_builder_args(settings),
+            executionMode=settings["executionMode"], metrics=dict(testEval, auc=auc))
+
+    result = {
+        "name": name,
+        "job": job,
+        "settings": settings,
+        "folder": get_result_folder(name),
+        "metrics": dict(testEval, auc=auc),
+        "history": history.history,
+        "timings": timings,
+        "finished": time.time(),
+    }
+    # the result file marks a finished job, write it after the background artifacts
+    artifact_writer.flush_writer()
+    with open(get_result_filename(name), 'w', encoding='utf-8') as f:
+        json.dump(results_store.to_jsonable(result), f, indent=1, default=str)
+    return result
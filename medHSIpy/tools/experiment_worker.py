@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*
+
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+from os.path import join
+
+if __name__ == "__main__":
+    import experiment_utils
+    import train_utils
+else:
+    from . import experiment_utils
+    from . import train_utils
+
+DEFAULT_ADDRESS = ('localhost', 6001)
+LOCAL_HOSTS = ['localhost', '127.0.0.1', '::1']
+AUTHKEY_ENV = 'MEDHSI_DAEMON_KEY'
+AUTHKEY_FILE = join(os.path.expanduser('~'), '.medhsi_daemon_key')
+DEFAULT_POLL_INTERVAL = 1.0
+
+######################### Authentication #########################
+
+def get_authkey(create = False):
+    # The connection unpickles messages, so the key is a secret: MEDHSI_DAEMON_KEY, or else a random
+    # key in a file only readable by the user, written by the daemon when it is missing
+    key = os.environ.get(AUTHKEY_ENV)
+    if key:
+        return key.encode()
+    if create and not os.path.exists(AUTHKEY_FILE):
+        fd = os.open(AUTHKEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(os.urandom(32).hex())
+    try:
+        with open(AUTHKEY_FILE, 'r') as f:
+            return f.read().strip().encode()
+    except FileNotFoundError:
+        raise RuntimeError("No daemon key, set " + AUTHKEY_ENV + " or start the daemon first") from None
+
+def is_local_address(address):
+    return isinstance(address, str) or address[0] in LOCAL_HOSTS
+
+######################### Workers #########################
+
+def get_default_cache_dir():
+    return join(os.path.dirname(train_utils.get_model_filename()), 'dataset_cache')
+
+def worker_loop(jobQueue, resultQueue, cacheDir = None, workerId = 0):
+    # Runs jobs one after the other, TF, the models and the datasets stay loaded between jobs
+    datasets = experiment_utils.DatasetCache(cacheDir)
+    while True:
+        item = jobQueue.get()
+        if item is None:
+            return
+        jobId, job = item
+        resultQueue.put((jobId, 'running', {"worker": workerId, "started": time.time()}))
+        try:
+            if "preload" in job:
+                for fold in job["preload"]:
+                    datasets.get(fold)
+                result = {"preloaded": job["preload"]}
+            else:
+                result = experiment_utils.run_experiment(job, datasets)
+                result = {k: result[k] for k in ["name", "folder", "metrics", "timings"]}
+            resultQueue.put((jobId, 'done', result))
+        except Exception as error:
+            resultQueue.put((jobId, 'failed', {"error": repr(error), "traceback": traceback.format_exc()}))
+
+######################### Daemon #########################
+
+class ExperimentDaemon:
+    """Long-lived process that accepts experiment jobs over a multiprocessing connection.
+
+    With numWorkers = 0 jobs run sequentially inside the daemon, which keeps the datasets in memory.
+    With numWorkers > 0 jobs run concurrently in that many spawned worker processes, which share
+    the datasets through memory-mapped .npy files in cacheDir. A worker process that dies, e.g. killed
+    for memory, fails its running job and is replaced.
+    Anyone with the key can run code in the daemon, so it only listens on a non-local address
+    when the key is given, either as authkey or in MEDHSI_DAEMON_KEY.
+    """
+
+    def __init__(self, address = DEFAULT_ADDRESS, authkey = None, numWorkers = 0, cacheDir = None):
+        if authkey is None and not is_local_address(address) and not os.environ.get(AUTHKEY_ENV):
+            raise ValueError("The daemon listens on " + str(address[0]) + " only with a key from " + AUTHKEY_ENV)
+        self.address = address
+        self.authkey = get_authkey(create=True) if authkey is None else authkey
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.condition = threading.Condition()
+        self.running = True
+        self.closing = False
+        self.exited = {}
+
+        if numWorkers == 0:
+            self.jobQueue = queue.Queue()
+            self.resultQueue = queue.Queue()
+            self.workers = [threading.Thread(target=worker_loop, args=(self.jobQueue, self.resultQueue, cacheDir), daemon=True)]
+        else:
+            self.cacheDir = get_default_cache_dir() if cacheDir is None else cacheDir
+            self.context = multiprocessing.get_context('spawn')
+            self.jobQueue = self.context.Queue()
+            self.resultQueue = self.context.Queue()
+            self.workers = [self.new_worker_process(i) for i in range(numWorkers)]
+        for worker in self.workers:
+            worker.start()
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+
+    def new_worker_process(self, workerId):
+        return self.context.Process(target=worker_loop, args=(self.jobQueue, self.resultQueue, self.cacheDir, workerId), daemon=True)
+
+    def check_workers(self):
+        # A dead worker process fails its running job and is replaced. Results it sent before exiting
+        # get one more poll to arrive, like in experiment_scheduler.
+        for i, worker in enumerate(self.workers):
+            if self.closing or isinstance(worker, threading.Thread) or worker.is_alive():
+                continue
+            if i not in self.exited:
+                self.exited[i] = time.time()
+                continue
+            del self.exited[i]
+            with self.condition:
+                for entry in self.jobs.values():
+                    if entry["status"] == 'running' and entry.get("worker") == i:
+                        entry["status"] = 'failed'
+                        entry["result"] = {"error": "worker process exited with code " + str(worker.exitcode)}
+                        entry["finished"] = time.time()
+                self.condition.notify_all()
+            print("Worker", i, "exited with code", worker.exitcode, "- starting a new one")
+            self.workers[i] = self.new_worker_process(i)
+            self.workers[i].start()
+
+    def _collect(self):
+        while True:
+            try:
+                item = self.resultQueue.get(timeout=DEFAULT_POLL_INTERVAL)
+            except queue.Empty:
+                self.check_workers()
+                continue
+            if item is None:
+                return
+            jobId, status, info = item
+            with self.condition:
+                entry = self.jobs[jobId]
+                entry["status"] = status
+                if status == 'running':
+                    entry.update(info)
+                else:
+                    entry["result"] = info
+                    entry["finished"] = time.time()
+                self.condition.notify_all()
+
+    def submit(self, job):
+        with self.condition:
+            jobId = next(self.ids)
+            self.jobs[jobId] = {"id": jobId, "job": job, "status": 'queued', "submitted": time.time(), "result": None}
+        self.jobQueue.put((jobId, job))
+        return jobId
+
+    def get_status(self, jobId = None):
+        with self.condition:
+            if jobId is not None:
+                return dict(self.jobs[jobId])
+            return [dict(x) for x in self.jobs.values()]
+
+    def wait(self, jobId, timeout = None):
+        with self.condition:
+            self.condition.wait_for(lambda: self.jobs[jobId]["status"] in ('done', 'failed'), timeout)
+            return dict(self.jobs[jobId])
+
+    def handle_message(self, message):
+        cmd = message.get("cmd")
+        if cmd == 'submit':
+            return {"id": self.submit(message["job"])}
+        if cmd == 'preload':
+            return {"id": self.submit({"preload": message.get("folds", [None])})}
+        if cmd == 'status':
+            return {"status": self.get_status(message.get("id"))}
+        if cmd == 'wait':
+            return {"status": self.wait(message["id"], message.get("timeout"))}
+        if cmd == 'shutdown':
+            self.running = False
+            return {"status": 'stopping'}
+        return {"error": "unknown command " + str(cmd)}
+
+    def handle_connection(self, connection):
+        try:
+            while self.running:
+                try:
+                    message = connection.recv()
+                except EOFError:
+                    return
+                try:
+                    reply = self.handle_message(message)
+                except Exception as error:
+                    reply = {"error": repr(error)}
+                connection.send(reply)
+                if not self.running:
+                    # wake up the accept loop
+                    Client(self.address, authkey=self.authkey).close()
+        finally:
+            connection.close()
+
+    def serve_forever(self):
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print("Experiment daemon listening on", listener.address)
+            while self.running:
+                connection = listener.accept()
+                threading.Thread(target=self.handle_connection, args=(connection,), daemon=True).start()
+        self.close()
+
+    def close(self):
+        # queued jobs still run to completion before the workers exit
+        self.closing = True
+        for _ in self.workers:
+            self.jobQueue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.resultQueue.put(None)
+        self.collector.join()
+
+######################### Client #########################
+
+class ExperimentClient:
+
+    def __init__(self, address = DEFAULT_ADDRESS, authkey = None):
+        self.connection = Client(address, authkey=get_authkey() if authkey is None else authkey)
+
+    def request(self, cmd, **kwargs):
+        self.connection.send(dict(kwargs, cmd=cmd))
+        reply = self.connection.recv()
+        if "error" in reply:
+            raise RuntimeError(reply["error"])
+        return reply
+
+    def submit(self, job):
+        return self.request('submit', job=job)["id"]
+
+    def preload(self, folds = None):
+        return self.request('preload', folds=[None] if folds is None else list(folds))["id"]
+
+    def status(self, jobId = None):
+        return self.request('status', id=jobId)["status"]
+
+    def wait(self, jobId, timeout = None):
+        return self.request('wait', id=jobId, timeout=timeout)["status"]
+
+    def shutdown(self):
+        return self.request('shutdown')
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*
+
+import tensorflow as tf
+from keras import layers
+from keras.models import Model
+
+######################### Accumulation #########################
+
+class GradientAccumulator:
+    # Sums of the gradients of the last micro-batches. A plain object, so Keras does not track its
+    # variables as model weights and the saved weights stay those of the wrapped model.
+
+    def __init__(self, variables, numSteps):
+        self.numSteps = numSteps
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False, name='accumulation_step')
+        self.gradients = [tf.Variable(tf.zeros(v.shape, dtype=v.dtype), trainable=False, name='accumulated_gradient')
+            for v in variables]
+
+    def apply(self, optimizer, variables):
+        optimizer.apply_gradients(zip([g.read_value() for g in self.gradients], variables))
+        for g in self.gradients:
+            g.assign(tf.zeros_like(g))
+        return tf.constant(True)
+
+    def accumulate(self, gradients, optimizer, variables):
+        # The optimizer sees the mean gradient of numSteps micro-batches, so its iterations count effective steps
+        for accumulated, gradient in zip(self.gradients, gradients):
+            if gradient is not None:
+                accumulated.assign_add(tf.cast(tf.convert_to_tensor(gradient), accumulated.dtype) / self.numSteps)
+        self.step.assign_add(1)
+        return tf.cond(self.step % self.numSteps == 0, lambda: self.apply(optimizer, variables), lambda: tf.constant(False))
+
+class GradientAccumulationModel(Model):
+    """Functional model whose train step applies the optimizer once every accumulationSteps batches.
+
+    Build with with_gradient_accumulation, the layers and weights are those of the original model.
+    """
+
+    accumulationSteps = 1
+    accumulator = None
+
+    def train_step(self, data):
+        x, y, sampleWeight = tf.keras.utils.unpack_x_y_sample_weight(data)
+        with tf.GradientTape() as tape:
+            yPred = self(x, training=True)
+            loss = self.compiled_loss(y, yPred, sampleWeight, regularization_losses=self.losses)
+        gradients = tape.gradient(loss, self.trainable_variables)
+        self.accumulator.accumulate(gradients, self.optimizer, self.trainable_variables)
+        self.compiled_metrics.update_state(y, yPred, sampleWeight)
+        return {m.name: m.result() for m in self.metrics}
+
+def set_batchnorm_momentum(model, accumulationSteps):
+    # BatchNorm statistics are still computed per micro-batch, but the moving averages are updated
+    # accumulationSteps times per optimizer step. momentum**(1 / N) keeps their decay per effective step.
+    for layer in model.submodules:
+        if isinstance(layer, layers.BatchNormalization):
+            layer.momentum = layer.momentum ** (1.0 / accumulationSteps)
+
+def with_gradient_accumulation(model, accumulationSteps):
+    """Returns an uncompiled model that averages the gradients of accumulationSteps micro-batches
+    before each optimizer update. The effective batch size is accumulationSteps * batchSize.
+    """
+
+    if accumulationSteps is None or accumulationSteps <= 1:
+        return model
+    set_batchnorm_momentum(model, accumulationSteps)
+    wrapped = GradientAccumulationModel(inputs=model.inputs, outputs=model.outputs, name=model.name)
+    wrapped.accumulationSteps = accumulationSteps
+    wrapped.accumulator = GradientAccumulator(wrapped.trainable_variables, accumulationSteps)
+    return wrapped
+
+def get_accumulation_steps(model):
+    return getattr(model, 'accumulationSteps', 1)
@@ -5,26 +5,26 @@ Created on Tue Jun 15 20:02:11 2021
 @author: foxel
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
 import math  
 from hsi_io import makedir, flatten_hsi, flatten_hsis, get_savedir, simple_plot, show_image
+from plot_utils import get_figure, finish_figure
 
 def plot_eigenvectors(pcComp, xVals, pcNum, fpath, xlims = [380,780]):
+    fig, ax = get_figure('eigenvectors')
     for i, eigenvector in zip(np.arange(pcNum), pcComp):
         if i < max(math.floor(pcNum/2), 5) :  
-            plt.plot(xVals, eigenvector, label='eigv'+str(i+1))
+            ax.plot(xVals, eigenvector, label='eigv'+str(i+1))
         else:
-            plt.plot(xVals, eigenvector, '--', label='eigv'+str(i+1))
+            ax.plot(xVals, eigenvector, '--', label='eigv'+str(i+1))
             
-    plt.legend(loc='upper right')
-    plt.title('Eigenvectors')
-    plt.xlabel('wavelength')
-    plt.ylabel('coefficient')
-    plt.xlim(xlims)
-    #plt.ylim([-0.1, 0.1]) #
-    plt.savefig(fpath + 'eigenvectors' + str(pcNum) +'.jpg')
-    plt.show() 
+    ax.legend(loc='upper right')
+    ax.set_title('Eigenvectors')
+    ax.set_xlabel('wavelength')
+    ax.set_ylabel('coefficient')
+    ax.set_xlim(xlims)
+    #ax.set_ylim([-0.1, 0.1]) #
+    finish_figure(fig, fpath + 'eigenvectors' + str(pcNum) +'.jpg')
 
 def show_reduced_subimages(hsiList, decom, fpath='', numSub = 4):
     for i in range(len(hsiList)):
@@ -63,16 +63,11 @@ def prep_decomp_figures(decom, hsiList, method = 'pca', savefolder='', rangeLimi
         print("Explained variance:", explained_vals)
         print("Singular values:", singular_vals)
         
-        plt.figure(0)
         simple_plot(explained_vals, "Explained variance", "pc number", "explained percentage", curSavedir)
-        plt.figure(1)
         simple_plot(singular_vals, "Singular Values", "pc number", "value", curSavedir)
         
         w = np.arange(rangeLimits[0], rangeLimits[1]+1)
-        plt.figure(2)
         plot_eigenvectors(decom.components_, w, 10, curSavedir)
-        plt.figure(3)
         plot_eigenvectors(decom.components_, w, 3, curSavedir)
         
-        plt.figure(4)
         show_reduced_subimages(hsiList, decom, curSavedir, numSub = 4)
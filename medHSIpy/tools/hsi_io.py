@@ -4,14 +4,18 @@ import numpy as np
 
 if __name__ == "__main__":
     import hsi_utils
+    import profiling
 else:
     from . import hsi_utils
+    from . import profiling
 
 # Image size should be multiple of 32
 DEFAULT_HEIGHT = 32 #64
 
-def load_data(name = None, fold = None):
+@profiling.profiled()
+def load_data(name = None, fold = None, shard = None):
     # name options: 'full', 'test', 'train'
+    # shard = (index, count) reads only every count-th sample, e.g. one worker's part of the data
     if name == None:
         name = 'full'
 
@@ -28,7 +32,7 @@ def load_data(name = None, fold = None):
         fpath = os.path.join(outputDir, datasetName, folderName, str(fold),  fileName)
 
     print("Read from ", fpath)
-    dataList, keyList, labelImages = hsi_utils.load_dataset(fpath, 'image')
+    dataList, keyList, labelImages = hsi_utils.load_dataset(fpath, 'image', shard)
 
     # Prepare input data
     croppedData = hsi_utils.center_crop_list(dataList, DEFAULT_HEIGHT, DEFAULT_HEIGHT, True)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*
 
 ######### From Segment Models #########
+import numpy as np
 import segmentation_models as sm
 from keras.layers import Input, Conv2D
 from tensorflow.keras.optimizers import Adam, RMSprop
@@ -8,8 +9,16 @@ from keras.models import Model
 
 if __name__ == "__main__":
     import train_utils
+    import profiling
+    import hsi_utils
+    import sm_feature_cache as sfc
+    import sm_preprocessing as smp
 else:
     from . import train_utils
+    from . import profiling
+    from . import hsi_utils
+    from . import sm_feature_cache as sfc
+    from . import sm_preprocessing as smp
 
 RESNET_BACKBONE = 'resnet34'
 INCEPTION_BACKBONE = 'inceptionv3'
@@ -21,12 +30,13 @@ sm.set_framework('tf.keras')
 sm.framework()
 
 ###################################################################################
-def get_sm_preproc_data(x_train_raw, x_test_raw, backbone):
-    preprocess_input = sm.get_preprocessing(backbone)
-
-    # preprocess input
-    xtrain = preprocess_input(x_train_raw)
-    xtest = preprocess_input(x_test_raw)
+@profiling.profiled()
+def get_sm_preproc_data(x_train_raw, x_test_raw, backbone, datasetKey = None, inPlace = False):
+    # Read-only results, cached per backbone and dataset (datasetKey, or the read-only arrays themselves).
+    # inPlace overwrites writeable raw arrays instead of copying them, only for callers that drop the raw data.
+    cache = smp.get_cache()
+    xtrain = cache.get(x_train_raw, backbone, None if datasetKey is None else datasetKey + '_train', inPlace)
+    xtest = cache.get(x_test_raw, backbone, None if datasetKey is None else datasetKey + '_test', inPlace)
     return xtrain, xtest
 
 def add_input_layer(backbone, numChannels): 
@@ -52,30 +62,102 @@ def get_target_backbone(backbone):
         target_backbone = VGG_BACKBONE
     return target_backbone
 
-def get_sm_model(backbone, height, width, numChannels, numClasses):
+def get_sm_model(backbone, height, width, numChannels, numClasses, foldPreprocessing = False):
+    # foldPreprocessing puts the backbone preprocessing in front of the model, which then takes raw cubes
     target_backbone = get_target_backbone(backbone)
-    if 'pretrained' in backbone: 
+    if 'frozen' in backbone:
+        # the preprocessing is already part of the channel mapping
+        model, _, _ = sfc.build_frozen_model(target_backbone, numChannels, numClasses)
+        return model
+    elif 'pretrained' in backbone: 
         model = add_input_layer(target_backbone, numChannels) 
     else: 
         model = sm.Unet(target_backbone, input_shape=(None, None, numChannels), encoder_weights=None, classes=numClasses)
+    if foldPreprocessing:
+        model = smp.add_preprocessing_layer(model, target_backbone, numChannels)
     return model
 
 def build_sm_model(framework, x_train_raw, x_test_raw, height, width, numChannels, numClasses, 
-        optimizerName = "Adam", learning_rate =  0.0001, decay = 0, lossFunction = "BCE+JC"):
+        optimizerName = "Adam", learning_rate =  0.0001, decay = 0, lossFunction = "BCE+JC", executionMode = None, foldPreprocessing = True):
 
+    executionMode = train_utils.set_execution_mode(executionMode)
     target_backbone = get_target_backbone(framework)
-    x_train_preproc, x_test_preproc = get_sm_preproc_data(x_train_raw, x_test_raw, target_backbone)
-    model = get_sm_model(framework, height, width, numChannels, numClasses)
-    model = train_utils.compile_custom(framework, model, optimizerName, learning_rate, decay, lossFunction)
+    if foldPreprocessing:
+        x_train_preproc, x_test_preproc = x_train_raw, x_test_raw
+    else:
+        x_train_preproc, x_test_preproc = get_sm_preproc_data(x_train_raw, x_test_raw, target_backbone)
+    with profiling.stage('build_model'):
+        model = get_sm_model(framework, height, width, numChannels, numClasses, foldPreprocessing)
+    model = train_utils.compile_custom(framework, model, optimizerName, learning_rate, decay, lossFunction, executionMode)
 
     return model, x_train_preproc, x_test_preproc
 
 def fit_sm_model(framework, x_train_raw, ytrain, x_test_raw, ytest, height, width, numChannels, numClasses, numEpochs, 
-    optimizerName = "Adam", learning_rate =  0.0001, decay = 0, lossFunction = "BCE+JC"):
+    optimizerName = "Adam", learning_rate =  0.0001, decay = 0, lossFunction = "BCE+JC", executionMode = None, foldPreprocessing = True):
+
+    if 'frozen' in framework:
+        return fit_frozen_sm_model(framework, x_train_raw, ytrain, x_test_raw, ytest, height, width, numChannels, numClasses, numEpochs,
+            optimizerName, learning_rate, decay, lossFunction, executionMode)
 
     model, x_train_prep, x_test_prep = build_sm_model(framework, x_train_raw, x_test_raw, height, width, numChannels, 
-        numClasses,  optimizerName, learning_rate, decay, lossFunction)
+        numClasses,  optimizerName, learning_rate, decay, lossFunction, executionMode, foldPreprocessing)
         
     model, history = train_utils.fit_model(framework, model, x_train_prep, ytrain, x_test_prep, ytest, numEpochs, batchSize = 64)
 
     return model, history
+
+######################### Frozen encoder #########################
+
+def learn_channel_mapping(x_train_raw, ytrain, target_backbone, numChannels, numEpochs = 2, batchSize = 64):
+    # A short end-to-end run of the add_input_layer model, only its 1x1 conv is kept afterwards
+    xtrain = smp.get_cache().get(x_train_raw, target_backbone)
+    model = add_input_layer(target_backbone, numChannels)
+    model.compile(optimizer=Adam(learning_rate=0.0001), loss=sm.losses.bce_jaccard_loss)
+    model.fit(xtrain, ytrain, batch_size=batchSize, epochs=numEpochs)
+    return model
+
+def get_channel_mapping(mapping, x_train_raw, ytrain, target_backbone, numChannels, mappingModel = None):
+    # kernel (C, 3) and bias (3,) that take raw cubes to the backbone input
+    if mapping == 'pca':
+        return sfc.get_pca_mapping(x_train_raw, target_backbone)
+    if mapping == 'learned':
+        if mappingModel is None:
+            mappingModel = learn_channel_mapping(x_train_raw, ytrain, target_backbone, numChannels)
+        # add_input_layer models are trained on preprocessed cubes
+        kernel, bias = sfc.get_learned_mapping(mappingModel)
+        return sfc.fold_input_preprocessing(kernel, bias, target_backbone)
+    hsi_utils.not_supported(mapping)
+    return sfc.get_pca_mapping(x_train_raw, target_backbone)
+
+def fit_frozen_sm_model(framework, x_train_raw, ytrain, x_test_raw, ytest, height, width, numChannels, numClasses, numEpochs,
+    optimizerName = "Adam", learning_rate = 0.0001, decay = 0, lossFunction = "BCE+JC", executionMode = None,
+    mapping = None, mappingModel = None, batchSize = 64, cacheDir = None):
+    """Trains only the decoder of a pretrained sm Unet, on encoder features cached on disk.
+
+    The channel mapping is fixed before training: PCA to 3 components, or with mapping = 'learned' the
+    1x1 conv of mappingModel (an add_input_layer model, trained briefly when not given). Frameworks
+    containing 'learned' select the learned mapping. The returned model takes raw cubes.
+    """
+
+    executionMode = train_utils.set_execution_mode(executionMode)
+    target_backbone = get_target_backbone(framework)
+    mapping = ('learned' if 'learned' in framework else 'pca') if mapping is None else mapping
+
+    with profiling.stage('channel_mapping'):
+        kernel, bias = get_channel_mapping(mapping, x_train_raw, ytrain, target_backbone, numChannels, mappingModel)
+    with profiling.stage('build_model'):
+        model, featureModel, decoder = sfc.build_frozen_model(target_backbone, numChannels, numClasses)
+        sfc.set_channel_mapping(model, kernel, bias)
+
+    cache = sfc.FeatureCache(cacheDir)
+    features_train = cache.get(featureModel, target_backbone, kernel, bias, x_train_raw)
+    features_test = cache.get(featureModel, target_backbone, kernel, bias, x_test_raw)
+
+    decoder = train_utils.compile_custom(framework, decoder, optimizerName, learning_rate, decay, lossFunction, executionMode)
+    decoder, history = train_utils.fit_model(framework, decoder, features_train, ytrain, features_test, ytest, numEpochs,
+        batchSize = batchSize)
+
+    # the decoder shares its layers with the full model
+    if train_utils.uses_mixed_precision(executionMode):
+        model = train_utils.set_output_float32(model)
+    return model, history
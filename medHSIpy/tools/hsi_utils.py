@@ -1,9 +1,15 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 import os.path
 import cv2
 
+if __name__ == "__main__":
+    import plot_utils
+    import profiling
+else:
+    from . import plot_utils
+    from . import profiling
+
 
 ######################### Path #########################
 
@@ -103,12 +109,17 @@ def load_black_mat(fname, varname):
     hsi = load_from_mat73(fname + '_black.mat', varname) 
     return hsi
 
-def load_dataset(fpath, sampleType='pixel'):
+@profiling.profiled()
+def load_dataset(fpath, sampleType='pixel', shard=None):
     f = load_from_h5(fpath)
     hsiList = []
     labelList = []
 
     keyList = list(f.keys())
+    if shard is not None:
+        # shard = (index, count), shards have equal size and the last len(keyList) % count keys are left out
+        index, count = shard
+        keyList = keyList[:len(keyList) // count * count][index::count]
 
     for keyz in keyList:
         val = f[keyz]['hsi'][:]
@@ -186,6 +197,7 @@ def center_crop_hsi(hsi, targetHeight=None, targetWidth=None):
         
     return croppedImg
 
+@profiling.profiled()
 def center_crop_list(dataList, targetHeight = 64, targetWidth = 64, showImage = False):
     croppedData = []
     for x in range(len(dataList)):
@@ -204,6 +216,7 @@ def normalize_hsi(hsi, white, black):
 def flatten_hsi(hsi):
     return np.reshape(hsi, (hsi.shape[0] * hsi.shape[1], hsi.shape[2])).transpose() 
 
+@profiling.profiled()
 def flatten_hsis(imgList):
     X = [flatten_hsi(x) for x in imgList]
     stacked = np.concatenate(X, axis=1).transpose()
@@ -241,6 +254,7 @@ def xyz2rgb(imXYZ):
     sRGB = np.reshape(sRGB, d)
     return sRGB
 
+@profiling.profiled()
 def get_display_image(hsi, imgType = 'srgb', channel = 150):
     recon = []
     if imgType == 'srgb':        
@@ -290,29 +304,30 @@ import skimage.util
 import skimage.io
 
 def simple_plot(y, figTitle, xLabel, yLabel, fpath):
-    plt.plot(np.arange(len(y))+1, y)
-    plt.title(figTitle)
-    plt.xlabel(xLabel)
-    plt.ylabel(yLabel)
+    fig, ax = plot_utils.get_figure('simple_plot')
+    ax.plot(np.arange(len(y))+1, y)
+    ax.set_title(figTitle)
+    ax.set_xlabel(xLabel)
+    ax.set_ylabel(yLabel)
     pltFname = fpath + figTitle.replace(' ', '_') + '.jpg'
     print("Save figure at: ", pltFname) 
-    plt.savefig(pltFname)
-    plt.show()
+    plot_utils.finish_figure(fig, pltFname)
 
 def show_display_image(hsiIm, imgType = 'srgb', channel = 150): 
     show_image(get_display_image(hsiIm, imgType, channel))
 
 def show_image(x, figTitle = None, hasGreyScale = False, fpath = ""):
+    fig, ax = plot_utils.get_figure('show_image')
     if hasGreyScale:
-        plt.imshow(x, cmap='gray')
+        ax.imshow(x, cmap='gray')
     else:
-        plt.imshow(x)
+        ax.imshow(x)
+    pltFname = None
     if figTitle is not None:
-        plt.title(figTitle)
+        ax.set_title(figTitle)
         pltFname = os.path.join(fpath, figTitle.replace(' ', '_') + '.jpg')
-        plt.savefig(pltFname)
         print("Save figure at:"+ pltFname)
-    plt.show()
+    plot_utils.finish_figure(fig, pltFname)
     
 def show_montage(dataList, filename = None, imgType = 'srgb', channel = 150):
     #Needs to have same number of dimensions for each image, type float single
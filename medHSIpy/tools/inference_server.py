@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*
+
+import http.client
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import h5py
+import numpy as np
+
+if __name__ == "__main__":
+    import hsi_utils
+    import model_registry
+    import tta_utils
+else:
+    from . import hsi_utils
+    from . import model_registry
+    from . import tta_utils
+
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_MAX_LATENCY = 0.01
+DEFAULT_THRESHOLD = 0.5
+LATENCY_WINDOW = 1000
+
+######################### Batching #########################
+
+class ServerStats:
+    # Request, image and batch counters with the latencies of the last LATENCY_WINDOW images
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.requests = 0
+        self.images = 0
+        self.batches = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.inferenceTimes = deque(maxlen=LATENCY_WINDOW)
+
+    def add_batch(self, batchSize, inferenceTime, latencies):
+        with self.lock:
+            self.batches += 1
+            self.images += batchSize
+            self.inferenceTimes.append(inferenceTime)
+            self.latencies.extend(latencies)
+
+    def add_request(self, isError = False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(isError)
+
+    def get_summary(self):
+        with self.lock:
+            uptime = time.perf_counter() - self.start
+            latencies = list(self.latencies)
+            summary = {
+                "uptime": uptime,
+                "requests": self.requests,
+                "errors": self.errors,
+                "images": self.images,
+                "batches": self.batches,
+                "meanBatchSize": self.images / max(self.batches, 1),
+                "imagesPerSec": self.images / max(uptime, 1e-12),
+                "meanInferenceTime": float(np.mean(self.inferenceTimes)) if self.inferenceTimes else 0.0,
+            }
+        for p in [50, 90, 99]:
+            summary["latencyP" + str(p)] = float(np.percentile(latencies, p)) if latencies else 0.0
+        return summary
+
+class MicroBatcher:
+    """Groups images of concurrent requests into batches for one model.
+
+    A batch is run when it reaches maxBatchSize or when the oldest queued image has waited maxLatency seconds.
+    All model calls happen on the batcher thread.
+    """
+
+    def __init__(self, model, metadata, maxBatchSize = DEFAULT_MAX_BATCH_SIZE, maxLatency = DEFAULT_MAX_LATENCY):
+        self.model = model
+        self.metadata = metadata
+        self.maxBatchSize = maxBatchSize
+        self.maxLatency = maxLatency
+        self.inputShape = tuple(metadata["inputShape"])
+        self.stats = ServerStats()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def check_image(self, image):
+        # The image in the model input shape, a wrong size raises here instead of failing the whole batch
+        image = np.asarray(image, dtype=np.float32)
+        if image.size != np.prod(self.inputShape):
+            raise ValueError("Image of shape " + str(image.shape) + " does not match the model input " + str(self.inputShape))
+        return image.reshape(self.inputShape)
+
+    def submit(self, image):
+        # image is a preprocessed (H, W, bands) cube, returns a Future of the probability map
+        image = self.check_image(image)
+        future = Future()
+        self.queue.put((image, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        items = [self.queue.get()]
+        if items[0] is None:
+            return None
+        deadline = items[0][2] + self.maxLatency
+        while len(items) < self.maxBatchSize:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)
+                break
+            items.append(item)
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            if items is None:
+                return
+            futures = [x[1] for x in items]
+            try:
+                x = np.stack([x[0] for x in items])
+                start = time.perf_counter()
+                preds = np.asarray(self.model.predict_on_batch(x))
+                end = time.perf_counter()
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+                continue
+            self.stats.add_batch(len(items), end - start, [end - x[2] for x in items])
+            for future, pred in zip(futures, preds):
+                future.set_result(pred)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+######################### Models #########################
+
+def prepare_image(hsi, metadata):
+    # Same preparation as training: center crop to the model size, then the recorded band selection and preprocessing
+    hsi = hsi_utils.center_crop_hsi(np.asarray(hsi, dtype=np.float32), metadata["height"], metadata["width"])
+    return model_registry.preprocess(hsi[np.newaxis], metadata)[0]
+
+def read_h5_images(fpath, keys = None):
+    # Same layout as hsi_utils.load_dataset, one group per sample with an 'hsi' dataset
+    images = []
+    with h5py.File(fpath, 'r') as f:
+        for key in (list(f.keys()) if keys is None else keys):
+            hsi = f[key]['hsi'][:]
+            if hsi.shape[2] != 311 and hsi.shape[2] != 3:
+                hsi = np.transpose(hsi, [1, 2, 0])
+            images.append(hsi)
+    return images
+
+class InferenceService:
+    # Loads registered models once and serves them through one MicroBatcher each,
+    # with transforms every batch is predicted with its test-time variants
+
+    def __init__(self, modelNames, registry = None, maxBatchSize = DEFAULT_MAX_BATCH_SIZE, maxLatency = DEFAULT_MAX_LATENCY, transforms = None):
+        registry = model_registry.get_registry() if registry is None else registry
+        self.batchers = {}
+        for name in modelNames:
+            model, metadata = registry.load(name)
+            batcher = MicroBatcher(tta_utils.with_tta(model, transforms), metadata, maxBatchSize, maxLatency)
+            # warm up, the first call traces the graph
+            batcher.submit(np.zeros(batcher.inputShape, dtype=np.float32)).result()
+            self.batchers[name] = batcher
+            print("Serving model", metadata["name"], "as", name)
+
+    def predict(self, name, images, threshold = DEFAULT_THRESHOLD):
+        batcher = self.batchers[name]
+        # all images of the request are checked before any is queued
+        images = [batcher.check_image(prepare_image(hsi, batcher.metadata)) for hsi in images]
+        futures = [batcher.submit(image) for image in images]
+        probabilities = np.stack([future.result() for future in futures])
+        return probabilities, (probabilities >= threshold).astype(np.uint8)
+
+    def get_stats(self):
+        return {name: batcher.stats.get_summary() for name, batcher in self.batchers.items()}
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+
+######################### HTTP #########################
+
+def to_npz_bytes(**arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """API:
+        GET  /models                   registered names being served
+        GET  /stats                    latency and throughput counters per model
+        POST /predict/<model>          body: .npy of one (H, W, bands) cube or a (N, H, W, bands) batch,
+                                       or JSON {"h5": path, "keys": [...]}; returns .npz with probabilities and masks
+    The mask threshold is set with ?threshold=0.5.
+    """
+
+    service = None
+
+    def send_body(self, code, body, contentType):
+        self.send_response(code)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, value):
+        self.send_body(code, json.dumps(value).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/models':
+            self.send_json(200, sorted(self.service.batchers))
+        elif path == '/stats':
+            self.send_json(200, self.service.get_stats())
+        else:
+            self.send_json(404, {"error": "unknown path " + path})
+
+    def read_images(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            request = json.loads(body)
+            return read_h5_images(request["h5"], request.get("keys"))
+        x = np.load(io.BytesIO(body), allow_pickle=False)
+        return [x] if x.ndim == 3 else list(x)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        name = url.path[len('/predict/'):] if url.path.startswith('/predict/') else None
+        if name not in self.service.batchers:
+            self.send_json(404, {"error": "unknown model " + str(name)})
+            return
+
+        batcher = self.service.batchers[name]
+        try:
+            threshold = float(parse_qs(url.query).get('threshold', [DEFAULT_THRESHOLD])[0])
+            probabilities, masks = self.service.predict(name, self.read_images(), threshold)
+        except Exception as error:
+            batcher.stats.add_request(True)
+            self.send_json(400, {"error": str(error)})
+            return
+        batcher.stats.add_request()
+        self.send_body(200, to_npz_bytes(probabilities=probabilities, masks=masks), 'application/x-npz')
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+def get_server(service, host = '127.0.0.1', port = 8765, socketPath = None):
+    handler = type('BoundInferenceRequestHandler', (InferenceRequestHandler,), {"service": service})
+    if socketPath is not None:
+        return ThreadingUnixHTTPServer(socketPath, handler)
+    return ThreadingHTTPServer((host, port), handler)
+
+######################### Client #########################
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socketPath, timeout = 60):
+        super().__init__('localhost', timeout=timeout)
+        self.socketPath = socketPath
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socketPath)
+
+def request_prediction(name, x, host = '127.0.0.1', port = 8765, socketPath = None, threshold = DEFAULT_THRESHOLD):
+    # x is one cube or a batch of cubes, returns (probabilities, masks)
+    buffer = io.BytesIO()
+    np.save(buffer, np.asarray(x, dtype=np.float32))
+    connection = UnixHTTPConnection(socketPath) if socketPath is not None else http.client.HTTPConnection(host, port, timeout=60)
+    try:
+        connection.request('POST', '/predict/' + name + '?threshold=' + str(threshold), buffer.getvalue(),
+            {'Content-Type': 'application/x-npy'})
+        response = connection.getresponse()
+        body = response.read()
+    finally:
+        connection.close()
+    if response.status != 200:
+        raise RuntimeError(json.loads(body).get("error", "request failed"))
+    result = np.load(io.BytesIO(body))
+    return result["probabilities"], result["masks"]
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*
+
+import numpy as np
+
+DEFAULT_THRESHOLDS = [0.5]
+SMOOTH = 1e-5
+
+METRIC_NAMES = ['iou', 'dice', 'precision', 'recall']
+COUNT_NAMES = ['tp', 'fp', 'fn', 'tn']
+
+############################### Helpers ##############
+
+def flatten_masks(x):
+    # (N, H, W) or (N, H, W, 1) -> (N, H*W)
+    x = np.asarray(x)
+    if x.ndim == 4 and x.shape[-1] == 1:
+        x = x[..., 0]
+    return np.reshape(x, (x.shape[0], -1))
+
+def get_ratio(numerator, denominator, smooth = SMOOTH):
+    return (numerator + smooth) / (denominator + smooth)
+
+############################### Metrics ##############
+
+def get_confusion_counts(gt, pred, thresholds = DEFAULT_THRESHOLDS):
+    # Counts have shape (numThresholds, numImages)
+    gtFlat = flatten_masks(gt) > 0
+    predFlat = flatten_masks(pred)
+    thresholds = np.asarray(thresholds, dtype=predFlat.dtype).reshape(-1, 1, 1)
+
+    predBin = predFlat[np.newaxis] >= thresholds
+    tp = np.count_nonzero(predBin & gtFlat[np.newaxis], axis=2)
+    predPositives = np.count_nonzero(predBin, axis=2)
+    positives = np.count_nonzero(gtFlat, axis=1)[np.newaxis]
+
+    fp = predPositives - tp
+    fn = positives - tp
+    tn = gtFlat.shape[1] - tp - fp - fn
+    return {'tp': tp, 'fp': fp, 'fn': fn, 'tn': tn}
+
+def get_metrics_from_counts(counts, smooth = SMOOTH):
+    tp = counts['tp'].astype(np.float64)
+    fp = counts['fp'].astype(np.float64)
+    fn = counts['fn'].astype(np.float64)
+
+    metrics = {
+        'iou': get_ratio(tp, tp + fp + fn, smooth),
+        'dice': get_ratio(2 * tp, 2 * tp + fp + fn, smooth),
+        'precision': get_ratio(tp, tp + fp, smooth),
+        'recall': get_ratio(tp, tp + fn, smooth),
+    }
+    return metrics
+
+def get_soft_iou(gt, pred, smooth = SMOOTH):
+    # Per image IoU on the raw probabilities, as sm.metrics.iou_score without threshold
+    gtFlat = flatten_masks(gt).astype(np.float64)
+    predFlat = flatten_masks(pred).astype(np.float64)
+    intersection = np.sum(gtFlat * predFlat, axis=1)
+    union = np.sum(gtFlat, axis=1) + np.sum(predFlat, axis=1) - intersection
+    return get_ratio(intersection, union, smooth)
+
+def get_segmentation_metrics(gt, pred, thresholds = DEFAULT_THRESHOLDS):
+    counts = get_confusion_counts(gt, pred, thresholds)
+    globalCounts = {x: np.sum(counts[x], axis=1) for x in COUNT_NAMES}
+
+    perImage = get_metrics_from_counts(counts)
+    perImage.update(counts)
+    overall = get_metrics_from_counts(globalCounts)
+    overall.update(globalCounts)
+
+    metricsDict = {
+        'thresholds': np.asarray(thresholds),
+        'perImage': perImage,
+        'global': overall,
+        'softIou': get_soft_iou(gt, pred),
+    }
+    return metricsDict
+
+############################### Streaming ROC ##############
+
+DEFAULT_ROC_BINS = 1000
+
+class BinnedRoc:
+    """Histogram based ROC accumulator for scores in [0, 1].
+
+    Predictions are ingested batch by batch and accumulators of the same size can be merged
+    (e.g. across folds). Memory and curve length are fixed by numBins, and the AUC error
+    against the exact pixel-level curve is bounded by get_auc_error_bound().
+    """
+
+    def __init__(self, numBins = DEFAULT_ROC_BINS):
+        self.numBins = numBins
+        self.positives = np.zeros(numBins, dtype=np.int64)
+        self.negatives = np.zeros(numBins, dtype=np.int64)
+
+    def update(self, yTrue, yScore):
+        yTrue = np.ravel(yTrue) > 0
+        yScore = np.ravel(yScore)
+        bins = np.clip((yScore * self.numBins).astype(np.int64), 0, self.numBins - 1)
+        self.positives += np.bincount(bins[yTrue], minlength=self.numBins)
+        self.negatives += np.bincount(bins[~yTrue], minlength=self.numBins)
+        return self
+
+    def merge(self, other):
+        if other.numBins != self.numBins:
+            raise ValueError("Cannot merge BinnedRoc with " + str(other.numBins) + " bins into " + str(self.numBins) + " bins.")
+        self.positives += other.positives
+        self.negatives += other.negatives
+        return self
+
+    def get_curve(self):
+        # Sweep thresholds from high to low, over the lower bin edges
+        tps = np.concatenate([[0], np.cumsum(self.positives[::-1])])
+        fps = np.concatenate([[0], np.cumsum(self.negatives[::-1])])
+        fpr = fps / max(fps[-1], 1)
+        tpr = tps / max(tps[-1], 1)
+        thresholds = np.arange(self.numBins, -1, -1) / self.numBins
+        thresholds[0] = np.inf
+        return fpr, tpr, thresholds
+
+    def get_auc(self):
+        fpr, tpr, _ = self.get_curve()
+        return np.sum(np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2)
+
+    def get_auc_error_bound(self):
+        # Pairs sharing a bin are counted as ties, each contributes at most 1/2 to the error
+        totalPairs = max(np.sum(self.positives) * np.sum(self.negatives), 1)
+        return 0.5 * np.sum(self.positives * self.negatives) / totalPairs
+
+def get_binned_roc(yTrue, yScore, numBins = DEFAULT_ROC_BINS, batchSize = 16):
+    # Ingests stacked images in batches along the first axis, works with memory-mapped arrays
+    roc = BinnedRoc(numBins)
+    for start in range(0, len(yScore), batchSize):
+        roc.update(yTrue[start:start + batchSize], yScore[start:start + batchSize])
+    return roc
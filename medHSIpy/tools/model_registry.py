@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*
+
+import json
+import os
+import time
+from os.path import join
+
+import numpy as np
+from keras import backend
+
+if __name__ == "__main__":
+    import train_utils
+    import profiling
+    import results_store
+    import cnn_models as cmdl
+    import xception_models as xmdl
+    import hsi_segment_from_sm as segsm
+    import sm_preprocessing as smp
+    import tta_utils
+else:
+    from . import train_utils
+    from . import profiling
+    from . import results_store
+    from . import cnn_models as cmdl
+    from . import xception_models as xmdl
+    from . import hsi_segment_from_sm as segsm
+    from . import sm_preprocessing as smp
+    from . import tta_utils
+
+WEIGHTS_FILENAME = 'weights.h5'
+METADATA_FILENAME = 'metadata.json'
+
+# Builders take (height, width, numChannels, numClasses, **builderArgs)
+MODEL_BUILDERS = {
+    'cnn3d': cmdl.cnn3d,
+    'cnn3d2': cmdl.cnn3d2,
+    'xception3d_max': xmdl.get_xception3d_max,
+    'xception3d_mean': xmdl.get_xception3d_mean,
+    'xception3d2_max': xmdl.get_xception3d2_max,
+    'xception3d2_mean': xmdl.get_xception3d2_mean,
+    'xception3d3_max': xmdl.get_xception3d3_max,
+    'xception3d3_mean': xmdl.get_xception3d3_mean,
+    'xception3d4_max': xmdl.get_xception3d4_max,
+    'xception3d4_mean': xmdl.get_xception3d4_mean,
+    'xception3d5_max': xmdl.get_xception3d5_max,
+    'xception3d5_mean': xmdl.get_xception3d5_mean,
+    'xception3d_10n': lambda h, w, c, n, **kwargs: xmdl.get_xception3d_10('max', w, h, c, n, **kwargs),
+    'xception3d_20n': lambda h, w, c, n, **kwargs: xmdl.get_xception3d_20('max', w, h, c, n, **kwargs),
+    'xception3d_30n': lambda h, w, c, n, **kwargs: xmdl.get_xception3d_30('max', w, h, c, n, **kwargs),
+}
+
+######################### Builders #########################
+
+def get_builder(framework):
+    # Frameworks carry suffixes such as the run date, so match the longest known prefix
+    if 'sm' in framework:
+        return lambda h, w, c, n, **kwargs: segsm.get_sm_model(framework, h, w, c, n, **kwargs)
+    for name in sorted(MODEL_BUILDERS, key=len, reverse=True):
+        if framework.startswith(name):
+            return MODEL_BUILDERS[name]
+    raise ValueError("Model:" + framework + " is not supported")
+
+def get_default_preprocessing(framework):
+    # The sm backbones normalize their input, the 3D models take the [0, 1] cubes of hsi_io.load_data.
+    # The frozen-encoder sm models have the preprocessing folded into their channel mapping.
+    if 'sm' in framework and 'frozen' not in framework:
+        return {"type": "sm", "backbone": segsm.get_target_backbone(framework)}
+    return None
+
+def get_input_shape(framework, height, width, numChannels):
+    if 'sm' in framework:
+        return [height, width, numChannels]
+    return [height, width, numChannels, 1]
+
+def build_model(framework, height, width, numChannels, numClasses, builderArgs = None):
+    return get_builder(framework)(height, width, numChannels, numClasses, **(builderArgs or {}))
+
+######################### Registry #########################
+
+def get_default_root():
+    return join(os.path.dirname(train_utils.get_model_filename()), 'registry')
+
+class ModelRegistry:
+    """Trained weights with the metadata needed to rebuild them: framework, builder arguments,
+    input shape, band selection and preprocessing. Each entry is a folder under root.
+    """
+
+    def __init__(self, root = None):
+        self.root = get_default_root() if root is None else root
+        os.makedirs(self.root, exist_ok=True)
+        self._cache = {}
+
+    def get_entry_dir(self, name):
+        return join(self.root, name)
+
+    @profiling.profiled('registry_save')
+    def save(self, model, framework, height, width, numChannels, numClasses, builderArgs = None, bands = None,
+        preprocessing = 'default', executionMode = None, metrics = None, name = None):
+        name = framework if name is None else name
+        entryDir = self.get_entry_dir(name)
+        os.makedirs(entryDir, exist_ok=True)
+        if 'sm' in framework and smp.has_preprocessing_layer(model):
+            # the model takes raw cubes and is rebuilt with the same layer
+            builderArgs = dict(builderArgs or {}, foldPreprocessing=True)
+            preprocessing = None if preprocessing == 'default' else preprocessing
+
+        # weights only, without the optimizer state
+        model.save_weights(join(entryDir, WEIGHTS_FILENAME), save_format='h5')
+        metadata = {
+            "name": name,
+            "framework": framework,
+            "builderArgs": builderArgs or {},
+            "height": height,
+            "width": width,
+            "numChannels": numChannels,
+            "numClasses": numClasses,
+            "inputShape": get_input_shape(framework, height, width, numChannels),
+            "bands": None if bands is None else [int(x) for x in bands],
+            "preprocessing": get_default_preprocessing(framework) if preprocessing == 'default' else preprocessing,
+            "executionMode": executionMode,
+            "params": model.count_params(),
+            "metrics": metrics,
+            "created": time.time(),
+            "weights": WEIGHTS_FILENAME,
+        }
+        with open(join(entryDir, METADATA_FILENAME), 'w', encoding='utf-8') as f:
+            json.dump(results_store.to_jsonable(metadata), f, indent=1, default=str)
+        for key in [x for x in self._cache if x[0] == name]:
+            del self._cache[key]
+        print("Registered model at: ", entryDir)
+        return metadata
+
+    def list_entries(self):
+        entries = []
+        for name in sorted(os.listdir(self.root)):
+            metadataFile = join(self.root, name, METADATA_FILENAME)
+            if os.path.isfile(metadataFile):
+                with open(metadataFile, 'r', encoding='utf-8') as f:
+                    entries.append(json.load(f))
+        return entries
+
+    def resolve(self, name):
+        # An exact entry name, or the most recent entry whose name starts with it (e.g. 'cnn3d')
+        if os.path.isfile(join(self.get_entry_dir(name), METADATA_FILENAME)):
+            return name
+        candidates = [x for x in self.list_entries() if x["name"].startswith(name)]
+        if not candidates:
+            raise KeyError("No registered model matches " + name)
+        return max(candidates, key=lambda x: x["created"])["name"]
+
+    def get_metadata(self, name):
+        with open(join(self.get_entry_dir(self.resolve(name)), METADATA_FILENAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @profiling.profiled('registry_load')
+    def load(self, name, executionMode = None, useCache = True):
+        """Rebuilds a registered model and loads its weights, ready for inference. Returns (model, metadata).
+
+        executionMode None uses the mode the model was trained with, as recorded in its metadata.
+        """
+
+        name = self.resolve(name)
+        weightsFile = join(self.get_entry_dir(name), WEIGHTS_FILENAME)
+        metadata = self.get_metadata(name)
+        if executionMode is None:
+            executionMode = metadata.get("executionMode")
+        key = (name, os.path.getmtime(weightsFile), executionMode)
+        if useCache and key in self._cache:
+            return self._cache[key]
+
+        executionMode = train_utils.set_execution_mode(executionMode)
+        model = build_model(metadata["framework"], metadata["height"], metadata["width"], metadata["numChannels"],
+            metadata["numClasses"], metadata["builderArgs"])
+        if train_utils.uses_mixed_precision(executionMode):
+            model = train_utils.set_output_float32(model)
+        model.load_weights(weightsFile)
+
+        if useCache:
+            self._cache[key] = (model, metadata)
+        return model, metadata
+
+    def clear_cache(self):
+        self._cache.clear()
+        backend.clear_session()
+
+######################### Inference #########################
+
+def preprocess(x, metadata):
+    # Applies the band selection and preprocessing recorded with the model, on a copy of x
+    x = np.asarray(x, dtype=np.float32)
+    if metadata.get("bands") is not None:
+        x = x[..., metadata["bands"]]
+    preprocessing = metadata.get("preprocessing")
+    if preprocessing is not None and preprocessing.get("type") == 'sm':
+        x = smp.apply_preprocessing(x, preprocessing["backbone"])
+    return x
+
+def predict(model, metadata, x, batchSize = 32, transforms = None):
+    # transforms: test-time augmentation, see tta_utils
+    x = preprocess(x, metadata)
+    model = tta_utils.with_tta(model, transforms)
+    preds = [model.predict_on_batch(x[i:i + batchSize]) for i in range(0, len(x), batchSize)]
+    return np.concatenate(preds, axis=0)
+
+_registry = None
+
+def get_registry(root = None):
+    global _registry
+    if root is not None:
+        return ModelRegistry(root)
+    if _registry is None:
+        _registry = ModelRegistry()
+    return _registry
+
+def load_model(name, root = None, executionMode = None):
+    return get_registry(root).load(name, executionMode)
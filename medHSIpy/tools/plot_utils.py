@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*
+
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+NON_INTERACTIVE_BACKENDS = ['agg', 'pdf', 'ps', 'svg', 'pgf', 'cairo', 'template']
+
+_batchDepth = 0
+_figureCache = threading.local()
+
+######################### Backend #########################
+
+def has_display():
+    if sys.platform.startswith('linux'):
+        return bool(os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY'))
+    return True
+
+def is_headless():
+    # Worker threads never touch pyplot, which is not thread-safe
+    if _batchDepth > 0 or threading.current_thread() is not threading.main_thread():
+        return True
+    if not has_display():
+        return True
+    return matplotlib.get_backend().lower() in NON_INTERACTIVE_BACKENDS
+
+######################### Figures #########################
+
+def get_cached_figures():
+    if not hasattr(_figureCache, 'figures'):
+        _figureCache.figures = {}
+    return _figureCache.figures
+
+def get_figure(name, nrows = 1, ncols = 1):
+    # Returns (fig, axes) for a named figure. In headless mode the Agg figure and its axes
+    # are allocated once per name and thread, and cleared for every new plot.
+    if not is_headless():
+        import matplotlib.pyplot as plt
+        fig = plt.figure(name)
+        fig.clf()
+        return fig, fig.subplots(nrows, ncols)
+
+    figures = get_cached_figures()
+    cached = figures.get(name)
+    if cached is not None and cached[2] == (nrows, ncols):
+        fig, axes, _ = cached
+        for ax in fig.axes:
+            ax.cla()
+        return fig, axes
+
+    if cached is not None:
+        fig = cached[0]
+        fig.clear()
+    else:
+        fig = Figure()
+        FigureCanvasAgg(fig)
+    axes = fig.subplots(nrows, ncols)
+    figures[name] = (fig, axes, (nrows, ncols))
+    return fig, axes
+
+def finish_figure(fig, filename = None, **saveKwargs):
+    if filename is not None:
+        fig.savefig(filename, **saveKwargs)
+
+    if not is_headless():
+        import matplotlib.pyplot as plt
+        plt.show()
+        plt.close(fig)
+
+def close_figures():
+    figures = get_cached_figures()
+    for (fig, _, _) in figures.values():
+        fig.clear()
+    figures.clear()
+
+@contextmanager
+def batch_mode():
+    # Renders everything on reused Agg figures, e.g. for many plots in one process,
+    # and releases the figures on exit
+    global _batchDepth
+    _batchDepth += 1
+    try:
+        yield
+    finally:
+        _batchDepth -= 1
+        if _batchDepth == 0:
+            close_figures()
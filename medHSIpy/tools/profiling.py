@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+MAX_RECORDS = 100000
+# seconds between RSS samples while a stage is open, MEDHSI_RSS_INTERVAL overrides it
+RSS_SAMPLE_INTERVAL = float(os.environ.get('MEDHSI_RSS_INTERVAL', 0.1))
+
+_enabled = os.environ.get('MEDHSI_PROFILE', '1') != '0'
+_lock = threading.Lock()
+_origin = time.perf_counter()
+_records = []
+_summary = {}
+
+######################### Settings #########################
+
+def enable(isEnabled = True):
+    global _enabled
+    _enabled = isEnabled
+
+def is_enabled():
+    return _enabled
+
+def set_rss_interval(interval):
+    # applies from the next sample on
+    _monitor.interval = interval
+
+def reset():
+    global _origin
+    with _lock:
+        _origin = time.perf_counter()
+        _records.clear()
+        _summary.clear()
+
+######################### Measurements #########################
+
+def get_peak_rss():
+    # Lifetime peak resident set size of the process in bytes, or None if unavailable. It never decreases,
+    # use RssPeak for the peak during a section of the run
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def get_current_rss():
+    # Current resident set size in bytes, falls back to the peak where /proc is not available
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return get_peak_rss()
+
+class RssMonitor:
+    # One background thread samples the RSS while sections are open and keeps the peak of each open section.
+    # The thread stops when the last section closes.
+
+    def __init__(self, interval = RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.peaks = {}
+        self.nextToken = 0
+        self.thread = None
+
+    def open(self):
+        rss = get_current_rss() or 0
+        with self.lock:
+            token = self.nextToken
+            self.nextToken += 1
+            self.peaks[token] = rss
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+        return token
+
+    def close(self, token):
+        rss = get_current_rss() or 0
+        with self.lock:
+            return max(self.peaks.pop(token), rss)
+
+    def _run(self):
+        while True:
+            rss = get_current_rss() or 0
+            with self.lock:
+                if not self.peaks:
+                    self.thread = None
+                    return
+                for token in self.peaks:
+                    self.peaks[token] = max(self.peaks[token], rss)
+            time.sleep(self.interval)
+
+_monitor = RssMonitor()
+
+class RssPeak:
+    # Sampled RSS at the start of a section and its peak during the section, in bytes
+
+    def __enter__(self):
+        self.start = get_current_rss()
+        self.peak = None
+        self.token = _monitor.open()
+        return self
+
+    def __exit__(self, *args):
+        self.peak = _monitor.close(self.token)
+
+    def get_increase(self):
+        # memory allocated by the section itself, on top of what the process held before
+        return None if self.start is None or self.peak is None else max(self.peak - self.start, 0)
+
+def add_record(name, start, wall, cpu, threadCpu, peakRss):
+    with _lock:
+        if len(_records) < MAX_RECORDS:
+            _records.append({"name": name, "start": start - _origin, "wall": wall, "cpu": cpu, "threadCpu": threadCpu,
+                "peakRss": peakRss, "thread": threading.get_ident()})
+        entry = _summary.setdefault(name, {"count": 0, "wall": 0.0, "cpu": 0.0, "threadCpu": 0.0, "peakRss": None})
+        entry["count"] += 1
+        entry["wall"] += wall
+        entry["cpu"] += cpu
+        entry["threadCpu"] += threadCpu
+        if peakRss is not None:
+            entry["peakRss"] = max(entry["peakRss"] or 0, peakRss)
+
+@contextmanager
+def stage(name):
+    # Records wall time, CPU time and the RSS peak sampled during a named stage. cpu is the process CPU time,
+    # which includes the TF thread pools, threadCpu only that of the calling thread. Also usable as a decorator.
+    if not _enabled:
+        yield
+        return
+
+    start = time.perf_counter()
+    cpuStart = time.process_time()
+    threadCpuStart = time.thread_time()
+    rss = RssPeak()
+    try:
+        with rss:
+            yield
+    finally:
+        add_record(name, start, time.perf_counter() - start, time.process_time() - cpuStart, time.thread_time() - threadCpuStart,
+            rss.peak)
+
+def profiled(name = None):
+    def decorator(func):
+        stageName = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stageName):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+######################### Reports #########################
+
+def get_records():
+    with _lock:
+        return list(_records)
+
+def get_summary():
+    with _lock:
+        return {k: dict(v) for k, v in _summary.items()}
+
+def print_report():
+    summary = get_summary()
+    print("{:<32} {:>8} {:>12} {:>16} {:>15} {:>14}".format("stage", "count", "wall (s)", "process cpu (s)", "thread cpu (s)",
+        "peak RSS (MB)"))
+    for name, entry in sorted(summary.items(), key=lambda x: -x[1]["wall"]):
+        peakRss = "-" if entry["peakRss"] is None else "{:.1f}".format(entry["peakRss"] / 2**20)
+        print("{:<32} {:>8} {:>12.3f} {:>16.3f} {:>15.3f} {:>14}".format(name, entry["count"], entry["wall"], entry["cpu"],
+            entry["threadCpu"], peakRss))
+
+def save_report(filename):
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump({"summary": get_summary(), "records": get_records()}, f, indent=1)
+
+def save_chrome_trace(filename):
+    # Loadable in chrome://tracing or Perfetto
+    events = [{"name": r["name"], "ph": "X", "ts": r["start"] * 1e6, "dur": r["wall"] * 1e6, "pid": os.getpid(),
+        "tid": r["thread"], "args": {"cpu": r["cpu"], "peakRss": r["peakRss"]}} for r in get_records()]
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*
+
+import json
+import sqlite3
+import time
+
+import numpy as np
+
+if __name__ == "__main__":
+    import train_utils
+else:
+    from . import train_utils
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS trials (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    framework TEXT,
+    settings TEXT,
+    metrics TEXT,
+    timings TEXT,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS epochs (
+    trial_id INTEGER NOT NULL REFERENCES trials(id),
+    epoch INTEGER NOT NULL,
+    metrics TEXT
+);
+CREATE TABLE IF NOT EXISTS metric_values (
+    trial_id INTEGER NOT NULL REFERENCES trials(id),
+    name TEXT NOT NULL,
+    value REAL
+);
+CREATE INDEX IF NOT EXISTS trials_run ON trials(run_id);
+CREATE INDEX IF NOT EXISTS trials_framework ON trials(framework);
+CREATE INDEX IF NOT EXISTS epochs_trial ON epochs(trial_id);
+CREATE INDEX IF NOT EXISTS metric_values_name ON metric_values(name, value);
+"""
+
+############################### Helpers ##############
+
+def to_jsonable(value):
+    if isinstance(value, dict):
+        return {str(k): to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_jsonable(v) for v in value]
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def to_json(value):
+    return json.dumps(to_jsonable(value), default=str)
+
+def from_json(text):
+    return None if text is None else json.loads(text)
+
+############################### Results Store ##############
+
+class ResultsStore:
+    """Append-only SQLite store for per-trial settings, per-epoch history, metrics and timings.
+
+    Every trial is written once, as it finishes, so the cost of a trial does not grow with the
+    number of previous trials. Numeric metrics are also indexed by name for leaderboard queries.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def start_run(self, name):
+        with self.connection:
+            cursor = self.connection.execute("INSERT INTO runs (name, created) VALUES (?, ?)", (name, time.time()))
+        return cursor.lastrowid
+
+    def add_trial(self, runId, framework, settings = None, metrics = None, history = None, timings = None):
+        metrics = {} if metrics is None else to_jsonable(metrics)
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO trials (run_id, framework, settings, metrics, timings, created) VALUES (?, ?, ?, ?, ?, ?)",
+                (runId, framework, to_json(settings), to_json(metrics), to_json(timings), time.time()))
+            trialId = cursor.lastrowid
+
+            numericValues = [(trialId, k, float(v)) for k, v in metrics.items() if isinstance(v, (int, float)) and not isinstance(v, bool)]
+            self.connection.executemany("INSERT INTO metric_values (trial_id, name, value) VALUES (?, ?, ?)", numericValues)
+
+            if history is not None:
+                history = to_jsonable(history)
+                numEpochs = max([len(v) for v in history.values()], default=0)
+                epochRows = [(trialId, i + 1, to_json({k: v[i] for k, v in history.items() if i < len(v)})) for i in range(numEpochs)]
+                self.connection.executemany("INSERT INTO epochs (trial_id, epoch, metrics) VALUES (?, ?, ?)", epochRows)
+        return trialId
+
+    def get_trials(self, runId = None, framework = None):
+        query = "SELECT t.id, r.name, t.framework, t.settings, t.metrics, t.timings FROM trials t JOIN runs r ON t.run_id = r.id WHERE 1 = 1"
+        args = []
+        if runId is not None:
+            query += " AND t.run_id = ?"
+            args.append(runId)
+        if framework is not None:
+            query += " AND t.framework = ?"
+            args.append(framework)
+        rows = self.connection.execute(query + " ORDER BY t.id", args).fetchall()
+        return [{"trialId": row[0], "run": row[1], "framework": row[2], "settings": from_json(row[3]),
+            "metrics": from_json(row[4]), "timings": from_json(row[5])} for row in rows]
+
+    def get_history(self, trialId):
+        rows = self.connection.execute("SELECT epoch, metrics FROM epochs WHERE trial_id = ? ORDER BY epoch", (trialId,)).fetchall()
+        history = {}
+        for (epoch, metrics) in rows:
+            for k, v in from_json(metrics).items():
+                history.setdefault(k, []).append(v)
+        return history
+
+    def get_leaderboard(self, metric, limit = 10, ascending = False, runId = None):
+        query = ("SELECT t.id, r.name, t.framework, t.settings, m.value FROM metric_values m "
+            "JOIN trials t ON m.trial_id = t.id JOIN runs r ON t.run_id = r.id WHERE m.name = ?")
+        args = [metric]
+        if runId is not None:
+            query += " AND t.run_id = ?"
+            args.append(runId)
+        query += " ORDER BY m.value " + ("ASC" if ascending else "DESC") + " LIMIT ?"
+        args.append(limit)
+        rows = self.connection.execute(query, args).fetchall()
+        return [{"trialId": row[0], "run": row[1], "framework": row[2], "settings": from_json(row[3]), metric: row[4]} for row in rows]
+
+    def print_leaderboard(self, metric, limit = 10, ascending = False, runId = None):
+        print("Leaderboard by", metric)
+        for (i, entry) in enumerate(self.get_leaderboard(metric, limit, ascending, runId)):
+            print(i + 1, entry["framework"], entry["run"], round(entry[metric], 4), entry["settings"])
+
+    def close(self):
+        self.connection.close()
+
+def get_results_store(folder = None):
+    return ResultsStore(train_utils.get_model_filename('0_results', 'sqlite', folder))
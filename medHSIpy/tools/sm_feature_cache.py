@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*
+
+import hashlib
+import json
+import os
+from os.path import join
+
+import numpy as np
+import segmentation_models as sm
+from keras import layers
+from keras.models import Model
+from sklearn.decomposition import PCA
+
+if __name__ == "__main__":
+    import train_utils
+    import profiling
+    import sm_preprocessing as smp
+else:
+    from . import train_utils
+    from . import profiling
+    from . import sm_preprocessing as smp
+
+MAPPINGS = ['pca', 'learned']
+MAPPING_LAYER_NAME = 'channel_mapping'
+DECODER_FILTERS = (256, 128, 64, 32, 16)
+NUM_SKIPS = 4
+DEFAULT_PCA_PIXELS = 100000
+DEFAULT_FEATURE_BATCH = 32
+SHAPES_FILENAME = 'shapes.json'
+
+######################### Channel mapping #########################
+
+def fold_input_preprocessing(kernel, bias, backbone):
+    # kernel (C, 3), bias (3,) of a mapping trained on preprocessed cubes, returns the same mapping for raw cubes
+    scale, offset, reverse = smp.get_preprocessing_affine(backbone, kernel.shape[0])
+    foldedBias = bias + offset @ kernel
+    kernel = kernel * scale[:, np.newaxis]
+    return (kernel[::-1] if reverse else kernel), foldedBias
+
+def get_pca_mapping(x, backbone, numPixels = DEFAULT_PCA_PIXELS, seed = 0):
+    # PCA to 3 components on a sample of training pixels, stretched to the [0, 255] range of the ImageNet images
+    # between the 1st and 99th percentile, followed by the backbone preprocessing. Returns kernel (C, 3), bias (3,)
+    pixels = np.reshape(x, (-1, x.shape[-1]))
+    indexes = np.sort(np.random.default_rng(seed).integers(0, len(pixels), min(numPixels, len(pixels))))
+    pixels = np.asarray(pixels[indexes], dtype=np.float64)
+
+    pca = PCA(n_components=3).fit(pixels)
+    kernel = pca.components_.T
+    bias = -pca.mean_ @ kernel
+    low, high = np.percentile(pixels @ kernel + bias, [1, 99], axis=0)
+    factor = 255 / np.maximum(high - low, 1e-12)
+    kernel, bias = kernel * factor, (bias - low) * factor
+
+    scale, offset, reverse = smp.get_preprocessing_affine(backbone)
+    if reverse:
+        kernel, bias = kernel[:, ::-1], bias[::-1]
+    return kernel * scale, bias * scale + offset
+
+def get_mapping_layer(model):
+    # The 1x1 conv in front of the encoder, in add_input_layer and in the frozen models
+    for layer in model.layers:
+        if isinstance(layer, layers.Conv2D) and tuple(layer.kernel_size) == (1, 1) and layer.filters == 3:
+            return layer
+    raise ValueError("Model " + model.name + " has no channel mapping layer")
+
+def get_learned_mapping(model):
+    kernel, bias = get_mapping_layer(model).get_weights()
+    return kernel[0, 0], bias
+
+def set_channel_mapping(model, kernel, bias):
+    layer = model.get_layer(MAPPING_LAYER_NAME)
+    layer.set_weights([np.reshape(kernel, (1, 1) + kernel.shape).astype(np.float32), np.asarray(bias, dtype=np.float32)])
+
+######################### Encoder and decoder #########################
+
+def get_encoder(backbone, encoderWeights = 'imagenet'):
+    # The sm.Unet encoder with outputs [bottleneck, skips deepest first], non trainable
+    unet = sm.Unet(backbone_name=backbone, encoder_weights=encoderWeights)
+    skips = [unet.get_layer(name=i).output if isinstance(i, str) else unet.get_layer(index=i).output
+        for i in sm.Backbones.get_feature_layers(backbone, n=NUM_SKIPS)]
+    firstDecoderLayer = 'center_block1_conv' if any(x.name == 'center_block1_conv' for x in unet.layers) else 'decoder_stage0_upsampling'
+    encoder = Model(unet.input, [unet.get_layer(firstDecoderLayer).input] + skips, name=backbone + '_encoder')
+    encoder.trainable = False
+    return encoder
+
+def conv_bn_relu(x, filters, name):
+    # Conv3x3BnReLU of sm
+    x = layers.Conv2D(filters, 3, padding='same', use_bias=False, kernel_initializer='he_uniform', name=name + '_conv')(x)
+    x = layers.BatchNormalization(axis=-1, name=name + '_bn')(x)
+    return layers.Activation('relu', name=name + '_relu')(x)
+
+def build_decoder(encoder, numClasses, decoderFilters = DECODER_FILTERS):
+    # The sm.Unet decoder with upsampling blocks, taking the encoder outputs as inputs
+    inputs = [layers.Input(shape=(None, None, x.shape[-1]), name='encoder_feature' + str(i)) for i, x in enumerate(encoder.outputs)]
+    x, skips = inputs[0], inputs[1:]
+
+    # vgg ends with max pooling, sm adds a center block then
+    if any(isinstance(layer, layers.MaxPooling2D) and layer.output is encoder.outputs[0] for layer in encoder.layers):
+        x = conv_bn_relu(x, 512, 'center_block1')
+        x = conv_bn_relu(x, 512, 'center_block2')
+
+    for i, filters in enumerate(decoderFilters):
+        x = layers.UpSampling2D(size=2, name='decoder_stage{}_upsampling'.format(i))(x)
+        if i < len(skips):
+            x = layers.Concatenate(axis=-1, name='decoder_stage{}_concat'.format(i))([x, skips[i]])
+        x = conv_bn_relu(x, filters, 'decoder_stage{}a'.format(i))
+        x = conv_bn_relu(x, filters, 'decoder_stage{}b'.format(i))
+
+    x = layers.Conv2D(numClasses, (3, 3), padding='same', kernel_initializer='glorot_uniform', name='final_conv')(x)
+    x = layers.Activation('sigmoid', name='sigmoid')(x)
+    return Model(inputs, x, name=encoder.name.replace('_encoder', '') + '_decoder')
+
+def build_frozen_model(backbone, numChannels, numClasses, encoderWeights = 'imagenet'):
+    """Same network as add_input_layer, split into a fixed 1x1 channel mapping, a frozen encoder and a decoder.
+
+    Returns (model, featureModel, decoder). featureModel maps raw cubes to the encoder features,
+    the decoder is trained on those features and shares its layers with model.
+    """
+
+    encoder = get_encoder(backbone, encoderWeights)
+    decoder = build_decoder(encoder, numClasses)
+
+    input = layers.Input(shape=(None, None, numChannels))
+    mapping = layers.Conv2D(3, (1, 1), name=MAPPING_LAYER_NAME, trainable=False)
+    features = encoder(mapping(input))
+    model = Model(inputs=input, outputs=decoder(features), name='frozen_' + backbone)
+    featureModel = Model(inputs=input, outputs=features, name='frozen_' + backbone + '_features')
+    return model, featureModel, decoder
+
+######################### Feature cache #########################
+
+def get_default_cache_dir():
+    return join(os.path.dirname(train_utils.get_model_filename()), 'feature_cache')
+
+class FeatureCache:
+    """Encoder features of a dataset on disk, opened memory-mapped.
+
+    Entries are keyed by backbone, channel mapping and a digest of the data, so a changed
+    mapping or dataset never reuses stale features.
+    """
+
+    def __init__(self, cacheDir = None):
+        self.cacheDir = get_default_cache_dir() if cacheDir is None else cacheDir
+
+    def get_key(self, backbone, kernel, bias, x):
+        digest = hashlib.sha1()
+        for array in [kernel, bias]:
+            digest.update(np.ascontiguousarray(array, dtype=np.float32).tobytes())
+        digest.update(smp.get_data_digest(x).encode('utf-8'))
+        return backbone + '_' + digest.hexdigest()[:16]
+
+    def load(self, key):
+        entryDir = join(self.cacheDir, key)
+        if not os.path.isfile(join(entryDir, SHAPES_FILENAME)):
+            return None
+        with open(join(entryDir, SHAPES_FILENAME), 'r', encoding='utf-8') as f:
+            numFeatures = len(json.load(f))
+        return [np.load(join(entryDir, 'feature' + str(i) + '.npy'), mmap_mode='r') for i in range(numFeatures)]
+
+    @profiling.profiled('encoder_features')
+    def compute(self, key, featureModel, x, batchSize = DEFAULT_FEATURE_BATCH):
+        # Written batch by batch into memory-mapped files, the features never have to fit in memory at once
+        entryDir = join(self.cacheDir, key)
+        os.makedirs(entryDir, exist_ok=True)
+        tmpNames, outputs = [], None
+        for start in range(0, len(x), batchSize):
+            batch = featureModel.predict_on_batch(np.asarray(x[start:start + batchSize], dtype=np.float32))
+            batch = [np.asarray(f, dtype=np.float32) for f in batch]
+            if outputs is None:
+                tmpNames = [join(entryDir, 'feature' + str(i) + '.' + str(os.getpid()) + '.tmp.npy') for i in range(len(batch))]
+                outputs = [np.lib.format.open_memmap(name, mode='w+', dtype=np.float32, shape=(len(x),) + f.shape[1:])
+                    for name, f in zip(tmpNames, batch)]
+            for output, f in zip(outputs, batch):
+                output[start:start + len(f)] = f
+
+        shapes = [list(x.shape) for x in outputs]
+        for output in outputs:
+            output.flush()
+        outputs = None
+        for i, name in enumerate(tmpNames):
+            os.replace(name, join(entryDir, 'feature' + str(i) + '.npy'))
+        # the shapes file is written last and marks a complete entry
+        tmpFilename = join(entryDir, 'shapes.' + str(os.getpid()) + '.tmp.json')
+        with open(tmpFilename, 'w', encoding='utf-8') as f:
+            json.dump(shapes, f)
+        os.replace(tmpFilename, join(entryDir, SHAPES_FILENAME))
+
+    def get(self, featureModel, backbone, kernel, bias, x, batchSize = DEFAULT_FEATURE_BATCH):
+        # Features of x for the given mapping, computed on the first call only
+        key = self.get_key(backbone, kernel, bias, x)
+        features = self.load(key)
+        if features is None:
+            print("Computing encoder features for", key)
+            self.compute(key, featureModel, x, batchSize)
+            features = self.load(key)
+        else:
+            print("Using cached encoder features", key)
+        return features
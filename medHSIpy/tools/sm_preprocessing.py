@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*
+
+import functools
+import hashlib
+import weakref
+from collections import OrderedDict
+
+import numpy as np
+import segmentation_models as sm
+import tensorflow as tf
+from keras import layers
+from keras.models import Model
+
+PREPROCESSING_LAYER_NAME = 'backbone_preprocessing'
+DEFAULT_CACHE_ENTRIES = 2
+
+######################### Affine form #########################
+
+@functools.lru_cache(maxsize=None)
+def get_preprocessing_affine(backbone, numChannels = 3):
+    # The sm preprocessing functions are per-channel affine maps, caffe mode also reverses the channels.
+    # Returns (scale, offset, reverse) with preprocess(x) == scale * x[..., ::-1 if reverse] + offset
+    preprocess_input = sm.get_preprocessing(backbone)
+    apply = lambda x: np.asarray(preprocess_input(np.array(x, dtype=np.float32)), dtype=np.float64).reshape(-1)
+
+    zeros = np.zeros((1, 1, 1, numChannels))
+    offset = apply(zeros)
+    scale = apply(zeros + 1) - offset
+    probe = np.arange(1, numChannels + 1, dtype=np.float64)
+    response = apply(probe.reshape(zeros.shape)) - offset
+    if np.allclose(response, scale * probe, rtol=1e-4):
+        return scale, offset, False
+    if np.allclose(response, scale * probe[::-1], rtol=1e-4):
+        return scale, offset, True
+    raise ValueError("Preprocessing of " + backbone + " is not a per-channel affine map")
+
+def is_identity(backbone, numChannels):
+    scale, offset, reverse = get_preprocessing_affine(backbone, numChannels)
+    return not reverse and np.all(scale == 1) and np.all(offset == 0)
+
+def apply_preprocessing(x, backbone, inPlace = False):
+    """Same result as sm.get_preprocessing(backbone), with one float32 output array and no temporaries.
+
+    With inPlace, a writeable float32 x is overwritten and returned, otherwise a new array is returned.
+    """
+
+    scale, offset, reverse = get_preprocessing_affine(backbone, x.shape[-1])
+    canWrite = isinstance(x, np.ndarray) and x.dtype == np.float32 and x.flags.writeable
+    out = x if inPlace and canWrite else np.empty(np.shape(x), dtype=np.float32)
+    source = np.asarray(x)[..., ::-1] if reverse else x
+    # numpy buffers the overlapping reversed view when writing in place
+    np.multiply(source, scale.astype(np.float32), out=out)
+    out += offset.astype(np.float32)
+    return out
+
+def get_data_digest(x, chunkSize = 256):
+    digest = hashlib.sha1(str(np.shape(x)).encode('utf-8'))
+    for i in range(0, len(x), chunkSize):
+        digest.update(np.ascontiguousarray(x[i:i + chunkSize], dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+######################### Cache #########################
+
+class PreprocessingCache:
+    """Preprocessed datasets, keyed by backbone and dataset, kept read-only in memory.
+
+    datasetKey names the dataset (e.g. 'fold1_train'). Without it the entry belongs to the read-only
+    array x itself, such as the arrays of experiment_utils.DatasetCache, and is dropped when x is freed.
+    Writeable arrays without datasetKey may change, they are preprocessed but not cached.
+    Backbones without preprocessing (the resnets) return x itself.
+    """
+
+    def __init__(self, maxEntries = DEFAULT_CACHE_ENTRIES):
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+
+    def get(self, x, backbone, datasetKey = None, inPlace = False):
+        if is_identity(backbone, x.shape[-1]):
+            return x
+        source = None
+        if datasetKey is None:
+            if not isinstance(x, np.ndarray) or x.flags.writeable:
+                return apply_preprocessing(x, backbone, inPlace)
+            key = (backbone, id(x))
+            source = x
+        else:
+            key = (backbone, datasetKey)
+
+        entry = self.entries.get(key)
+        # an id can be reused by a new array once the old one is freed
+        if entry is not None and (entry[0] is None or entry[0]() is source):
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        preprocessed = apply_preprocessing(x, backbone, inPlace)
+        preprocessed.flags.writeable = False
+        ref = None if source is None else weakref.ref(source, lambda _, key=key: self.drop(key))
+        self.entries[key] = (ref, preprocessed)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+        return preprocessed
+
+    def drop(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0]() is None:
+            del self.entries[key]
+
+    def clear(self):
+        self.entries.clear()
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = PreprocessingCache()
+    return _cache
+
+######################### Layer #########################
+
+class BackbonePreprocessing(layers.Layer):
+    # The sm preprocessing of a backbone as the first layer of a model, so that the model takes raw cubes
+
+    def __init__(self, backbone, numChannels, **kwargs):
+        # float32 also under mixed precision, caffe mode subtracts means in the 100s
+        kwargs.setdefault('dtype', 'float32')
+        super().__init__(**kwargs)
+        self.backbone = backbone
+        self.numChannels = numChannels
+        scale, offset, self.reverse = get_preprocessing_affine(backbone, numChannels)
+        self.scale = scale.astype(np.float32)
+        self.offset = offset.astype(np.float32)
+
+    def call(self, inputs):
+        x = tf.reverse(inputs, axis=[-1]) if self.reverse else inputs
+        return x * tf.cast(self.scale, x.dtype) + tf.cast(self.offset, x.dtype)
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"backbone": self.backbone, "numChannels": self.numChannels})
+        return config
+
+def add_preprocessing_layer(model, backbone, numChannels):
+    input = layers.Input(shape=(None, None, numChannels))
+    x = BackbonePreprocessing(backbone, numChannels, name=PREPROCESSING_LAYER_NAME)(input)
+    return Model(inputs=input, outputs=model(x), name=model.name)
+
+def has_preprocessing_layer(model):
+    return any(isinstance(layer, BackbonePreprocessing) for layer in model.layers)
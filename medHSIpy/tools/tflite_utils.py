@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*
+
+import json
+import os
+import time
+from os.path import join
+
+import numpy as np
+import tensorflow as tf
+
+if __name__ == "__main__":
+    import hsi_io
+    import metrics_utils
+    import model_registry
+    import profiling
+else:
+    from . import hsi_io
+    from . import metrics_utils
+    from . import model_registry
+    from . import profiling
+
+QUANTIZATIONS = ['float32', 'float16', 'int8']
+DEFAULT_CALIBRATION_SAMPLES = 32
+
+######################### Calibration #########################
+
+def get_representative_data(metadata, numSamples = DEFAULT_CALIBRATION_SAMPLES, name = 'train', fold = None, seed = 0):
+    # A random subset of the training images, preprocessed as the model expects
+    x, _, _ = hsi_io.load_data(name, fold)
+    indexes = np.random.default_rng(seed).permutation(len(x))[:numSamples]
+    return model_registry.preprocess(x[indexes], metadata)
+
+def get_input_shape(model, metadata = None):
+    if metadata is not None:
+        return tuple(metadata["inputShape"])
+    return tuple(model.inputs[0].shape[1:])
+
+def to_model_input(x, inputShape):
+    # The 3D models take (H, W, bands, 1), the loaded cubes have no trailing channel axis
+    return np.reshape(np.asarray(x, dtype=np.float32), (len(x),) + tuple(inputShape))
+
+######################### Conversion #########################
+
+def get_converter(model, inputShape):
+    # A fixed batch of one and fixed spatial size, the sm models are built with dynamic dimensions
+    func = tf.function(lambda x: model(x, training=False))
+    concreteFunc = func.get_concrete_function(tf.TensorSpec((1,) + tuple(inputShape), tf.float32))
+    return tf.lite.TFLiteConverter.from_concrete_functions([concreteFunc], model)
+
+def set_int8_quantization(converter, representativeData, supportedOps):
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = lambda: ([representativeData[i:i + 1].astype(np.float32)] for i in range(len(representativeData)))
+    converter.target_spec.supported_ops = supportedOps
+
+@profiling.profiled('tflite_convert')
+def convert(model, inputShape, quantization = 'float32', representativeData = None):
+    """Converts a Keras model to a TFLite flatbuffer. Returns (bytes, info).
+
+    'float16' stores weights in float16, 'int8' is full-integer post-training quantization calibrated
+    on representativeData. Ops without an int8 kernel (e.g. CONV_3D) fall back to float kernels, which
+    is reported in info.
+    """
+
+    converter = get_converter(model, inputShape)
+    info = {"quantization": quantization, "fallback": False}
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+
+    elif quantization == 'int8':
+        if representativeData is None:
+            raise ValueError("int8 quantization needs representative data for calibration")
+        set_int8_quantization(converter, representativeData, [tf.lite.OpsSet.TFLITE_BUILTINS_INT8])
+        try:
+            return converter.convert(), info
+        except Exception as error:
+            print("Full integer conversion failed, allowing float kernels for unsupported ops:", error)
+            converter = get_converter(model, inputShape)
+            set_int8_quantization(converter, representativeData, [tf.lite.OpsSet.TFLITE_BUILTINS_INT8, tf.lite.OpsSet.TFLITE_BUILTINS])
+            info["fallback"] = True
+
+    elif quantization != 'float32':
+        raise ValueError("Quantization:" + quantization + " is not supported")
+
+    return converter.convert(), info
+
+######################### Inference #########################
+
+class TFLiteModel:
+    # Runs a converted model one image at a time, quantizing int8 inputs and outputs when needed
+
+    def __init__(self, modelContent, numThreads = None):
+        self.interpreter = tf.lite.Interpreter(model_content=modelContent, num_threads=numThreads or os.cpu_count())
+        self.interpreter.allocate_tensors()
+        self.inputDetails = self.interpreter.get_input_details()[0]
+        self.outputDetails = self.interpreter.get_output_details()[0]
+
+    def predict_one(self, x):
+        x = x[np.newaxis]
+        if self.inputDetails["dtype"] in (np.int8, np.uint8):
+            scale, zeroPoint = self.inputDetails["quantization"]
+            x = np.round(x / scale + zeroPoint).astype(self.inputDetails["dtype"])
+        self.interpreter.set_tensor(self.inputDetails["index"], x.astype(self.inputDetails["dtype"]))
+        self.interpreter.invoke()
+        y = self.interpreter.get_tensor(self.outputDetails["index"])
+        if self.outputDetails["dtype"] in (np.int8, np.uint8):
+            scale, zeroPoint = self.outputDetails["quantization"]
+            y = (y.astype(np.float32) - zeroPoint) * scale
+        return y[0]
+
+    def predict(self, x):
+        return np.stack([self.predict_one(xi) for xi in x])
+
+######################### Comparison #########################
+
+def time_per_image(predictOne, x, numRuns = 20, numWarmup = 2):
+    for i in range(numWarmup):
+        predictOne(x[i % len(x)])
+    times = []
+    for i in range(numRuns):
+        start = time.perf_counter()
+        predictOne(x[i % len(x)])
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+def get_mean_iou(gt, pred, threshold = 0.5):
+    counts = metrics_utils.get_confusion_counts(gt, pred, [threshold])
+    return float(np.mean(metrics_utils.get_metrics_from_counts(counts)['iou']))
+
+@profiling.profiled('tflite_compare')
+def compare_exports(model, exports, x, y, numRuns = 20):
+    # IoU against the ground truth and per-image CPU latency of the Keras model and every export.
+    # IoU delta is relative to the Keras model.
+    kerasPreds = np.concatenate([model.predict_on_batch(x[i:i + 1]) for i in range(len(x))], axis=0)
+    with tf.device('/CPU:0'):
+        kerasLatency = time_per_image(lambda xi: model.predict_on_batch(xi[np.newaxis]), x, numRuns)
+    kerasIou = get_mean_iou(y, kerasPreds)
+
+    rows = [{"name": "keras", "sizeBytes": None, "iou": kerasIou, "iouDelta": 0.0, "maxAbsDiff": 0.0,
+        "latency": kerasLatency, "speedup": 1.0}]
+    for quantization, (content, info) in exports.items():
+        tfliteModel = TFLiteModel(content)
+        preds = np.reshape(tfliteModel.predict(x), kerasPreds.shape)
+        latency = time_per_image(tfliteModel.predict_one, x, numRuns)
+        iou = get_mean_iou(y, preds)
+        rows.append({"name": quantization, "sizeBytes": len(content), "iou": iou, "iouDelta": iou - kerasIou,
+            "maxAbsDiff": float(np.max(np.abs(preds - kerasPreds))), "latency": latency,
+            "speedup": kerasLatency / max(latency, 1e-12), "fallback": info["fallback"]})
+    return rows
+
+def format_comparison(rows):
+    lines = ["{:<10} {:>10} {:>8} {:>10} {:>12} {:>14} {:>9}".format("model", "size (MB)", "IoU", "IoU delta", "max |diff|",
+        "latency (ms)", "speedup")]
+    for row in rows:
+        size = "-" if row["sizeBytes"] is None else "{:.2f}".format(row["sizeBytes"] / 2**20)
+        name = row["name"] + (" *" if row.get("fallback") else "")
+        lines.append("{:<10} {:>10} {:>8.4f} {:>+10.4f} {:>12.4f} {:>14.2f} {:>8.2f}x".format(name, size, row["iou"], row["iouDelta"],
+            row["maxAbsDiff"], row["latency"] * 1000, row["speedup"]))
+    if any(row.get("fallback") for row in rows):
+        lines.append("* some ops run with float kernels")
+    return '\n'.join(lines) + '\n'
+
+######################### Export #########################
+
+def export_model(name, quantizations = QUANTIZATIONS, numCalibration = DEFAULT_CALIBRATION_SAMPLES, fold = None,
+    numEvaluation = None, registry = None):
+    """Exports a registered model to TFLite next to its weights and compares the exports on the test set."""
+
+    registry = model_registry.get_registry() if registry is None else registry
+    # the float32 model is the reference of the quantized exports
+    model, metadata = registry.load(name, 'float32')
+    entryDir = registry.get_entry_dir(metadata["name"])
+    inputShape = get_input_shape(model, metadata)
+
+    representativeData = None
+    if 'int8' in quantizations:
+        representativeData = to_model_input(get_representative_data(metadata, numCalibration, 'train', fold), inputShape)
+
+    exports = {}
+    for quantization in quantizations:
+        content, info = convert(model, inputShape, quantization, representativeData)
+        filename = join(entryDir, 'model_' + quantization + '.tflite')
+        with open(filename, 'wb') as f:
+            f.write(content)
+        print("Saved at: ", filename)
+        exports[quantization] = (content, info)
+
+    x, y, _ = hsi_io.load_data('test', fold)
+    if numEvaluation is not None:
+        x, y = x[:numEvaluation], y[:numEvaluation]
+    x = to_model_input(model_registry.preprocess(x, metadata), inputShape)
+    rows = compare_exports(model, exports, x, y)
+
+    table = format_comparison(rows)
+    print(table)
+    with open(join(entryDir, 'tflite_comparison.txt'), 'w', encoding='utf-8') as f:
+        f.write(table)
+    with open(join(entryDir, 'tflite_comparison.json'), 'w', encoding='utf-8') as f:
+        json.dump(rows, f, indent=1)
+    return rows
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*
+
+import json
+import time
+
+import numpy as np
+from tensorflow.keras.callbacks import Callback
+from tensorflow.keras.utils import Sequence
+
+if __name__ == "__main__":
+    import profiling
+else:
+    from . import profiling
+
+INPUT_BOUND_FRACTION = 0.3
+
+############################### Throughput ##############
+
+class TimedBatches(Sequence):
+    # Training batches of in-memory arrays, reshuffled every epoch. x can also be a list or tuple of arrays,
+    # one per model input, such as the cached encoder features. The time spent slicing each batch
+    # is added to monitor.fetchTimes, Keras fetches the batches on a background thread.
+
+    def __init__(self, x, y, batchSize, monitor, shuffle = True, seed = 0):
+        self.x = x
+        self.y = y
+        self.batchSize = batchSize
+        self.monitor = monitor
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.indices = np.arange(len(y))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return int(np.ceil(len(self.y) / self.batchSize))
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        # sorted indices read the arrays, and h5 or memmap inputs, in order
+        indices = np.sort(self.indices[index * self.batchSize:(index + 1) * self.batchSize])
+        if isinstance(self.x, (list, tuple)):
+            x = [np.asarray(array[indices]) for array in self.x]
+        else:
+            x = np.asarray(self.x[indices])
+        batch = (x, np.asarray(self.y[indices]))
+        self.monitor.fetchTimes.append(time.perf_counter() - start)
+        return batch
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.indices)
+
+class ThroughputMonitor(Callback):
+    """Records samples/sec, step and epoch wall time, input fetch versus compute time and process memory.
+
+    Fetch time is only known when the training data is given as get_batches(x, y): it is the time spent
+    producing the batches, which Keras overlaps with the steps. A run is input-bound when fetching takes
+    more than INPUT_BOUND_FRACTION of the fetch and step time. Epoch time ends with the last training
+    step, without the validation pass.
+    """
+
+    def __init__(self, batchSize, numSamples = None, filename = None, verbose = True):
+        super().__init__()
+        self.batchSize = batchSize
+        self.numSamples = numSamples
+        self.filename = filename
+        self.verbose = verbose
+        self.epochs = []
+        self.fetchTimes = []
+        self.timesFetch = False
+
+    def get_batches(self, x, y, shuffle = True, seed = 0):
+        # Training data for model.fit whose batch fetch time is recorded
+        self.timesFetch = True
+        return TimedBatches(x, y, self.batchSize, self, shuffle, seed)
+
+    def on_train_begin(self, logs = None):
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs = None):
+        self.epochStart = time.perf_counter()
+        self.lastStepEnd = self.epochStart
+        self.stepTimes = []
+        # batches prefetched before the epoch starts are not counted
+        self.fetchTimes = []
+
+    def on_train_batch_begin(self, batch, logs = None):
+        self.stepStart = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs = None):
+        self.lastStepEnd = time.perf_counter()
+        self.stepTimes.append(self.lastStepEnd - self.stepStart)
+
+    def on_epoch_end(self, epoch, logs = None):
+        epochTime = self.lastStepEnd - self.epochStart
+        numSamples = self.numSamples if self.numSamples is not None else len(self.stepTimes) * self.batchSize
+        computeTime = float(np.sum(self.stepTimes))
+        fetchTime = float(np.sum(self.fetchTimes)) if self.timesFetch else None
+        self.epochs.append({
+            "epoch": epoch + 1,
+            "epochTime": epochTime,
+            "samplesPerSec": numSamples / max(epochTime, 1e-12),
+            "steps": len(self.stepTimes),
+            # the first step of the run includes graph tracing
+            "meanStepTime": float(np.mean(self.stepTimes)) if self.stepTimes else 0.0,
+            "medianStepTime": float(np.median(self.stepTimes)) if self.stepTimes else 0.0,
+            "computeTime": computeTime,
+            "fetchTime": fetchTime,
+            "rss": profiling.get_current_rss(),
+        })
+
+    def get_summary(self):
+        if not self.epochs:
+            return {}
+        # skip the first epoch, which includes graph tracing, when there are more
+        steady = self.epochs[1:] if len(self.epochs) > 1 else self.epochs
+        computeTime = sum(x["computeTime"] for x in steady)
+        fetchFraction = None
+        if self.timesFetch:
+            fetchTime = sum(x["fetchTime"] for x in steady)
+            fetchFraction = fetchTime / max(computeTime + fetchTime, 1e-12)
+        summary = {
+            "batchSize": self.batchSize,
+            "epochs": len(self.epochs),
+            "samplesPerSec": float(np.median([x["samplesPerSec"] for x in steady])),
+            "medianStepTime": float(np.median([x["medianStepTime"] for x in steady])),
+            "medianEpochTime": float(np.median([x["epochTime"] for x in steady])),
+            "fetchFraction": fetchFraction,
+            "bound": None if fetchFraction is None else ("input" if fetchFraction > INPUT_BOUND_FRACTION else "compute"),
+            "peakRss": profiling.get_peak_rss(),
+        }
+        return summary
+
+    def on_train_end(self, logs = None):
+        summary = self.get_summary()
+        if self.verbose and summary:
+            peakRss = "-" if summary["peakRss"] is None else "{:.0f} MB".format(summary["peakRss"] / 2**20)
+            fetch = "not timed" if summary["bound"] is None else "{:.0f}% ({}-bound)".format(summary["fetchFraction"] * 100, summary["bound"])
+            print("Throughput: {:.1f} samples/s, step {:.1f} ms, epoch {:.2f} s, input fetch {}, peak RSS {}".format(
+                summary["samplesPerSec"], summary["medianStepTime"] * 1000, summary["medianEpochTime"], fetch, peakRss))
+
+        if self.filename is not None:
+            with open(self.filename, 'w', encoding='utf-8') as f:
+                json.dump({"summary": summary, "epochs": self.epochs}, f, indent=1)
@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*
 
 import numpy as np
-import matplotlib.pyplot as plt
 import pickle
 import pathlib
 
 
 from contextlib import redirect_stdout
+import tensorflow as tf
+from keras import layers
+from keras.models import Model
+from tensorflow.keras import mixed_precision
 from tensorflow.keras.optimizers import Adam, RMSprop
 from tensorflow.keras.losses import categorical_crossentropy, binary_crossentropy
 from tensorflow.keras.metrics import Recall, Precision, FalseNegatives, FalsePositives, TrueNegatives, TruePositives
@@ -19,8 +22,22 @@ from os.path import join
 
 if __name__ == "__main__":
     import hsi_utils
+    import metrics_utils
+    import artifact_writer
+    import plot_utils
+    import profiling
+    import train_callbacks
+    import cost_utils
+    import gradient_accumulation
 else:
     from . import hsi_utils
+    from . import metrics_utils
+    from . import artifact_writer
+    from . import plot_utils
+    from . import profiling
+    from . import train_callbacks
+    from . import cost_utils
+    from . import gradient_accumulation
 
 ############################### Save Settings ############## 
 
@@ -65,19 +82,93 @@ def save_text(textstream, filename, folder = None):
             with redirect_stdout(f):
                 print(textstream)
     
-def save_model_info(model, folder = None, optSettings = None):
-    save_model_summary(model, folder)
-    save_model_graph(model, folder)
-    save_text(optSettings, 'optimizationSettings', folder)
+def write_text_file(filename, text):
+    with open(filename, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def write_pickle(filename, obj):
+    with open(filename, 'wb') as f:
+        pickle.dump(obj, f)
+
+@profiling.profiled()
+def save_model_info(model, folder = None, optSettings = None, writer = None):
+    if writer is None:
+        save_model_summary(model, folder)
+        save_model_graph(model, folder)
+        save_text(optSettings, 'optimizationSettings', folder)
+    else:
+        # Only the summary text is captured here, files are written in the background
+        summaryLines = []
+        model.summary(print_fn=lambda x: summaryLines.append(x))
+        writer.submit(write_text_file, get_model_filename('modelsummary', 'txt', folder), '\n'.join(summaryLines) + '\n')
+        writer.submit(plot_model, model, to_file=get_model_filename('modelgraph', 'png', folder), show_shapes=True, show_layer_names=True)
+        if optSettings != None:
+            writer.submit(write_text_file, get_model_filename('optimizationSettings', 'txt', folder), str(optSettings) + '\n')
 
     filename = get_model_filename('model', 'pkl', folder)
     abspath = pathlib.Path(filename).absolute()
-    with open(str(abspath), 'wb') as f:
-        pickle.dump(abspath, f)
+    if writer is None:
+        write_pickle(str(abspath), abspath)
+    else:
+        writer.submit(write_pickle, str(abspath), abspath)
         
 
+########################################## EXECUTION MODE
+EXECUTION_MODES = ['float32', 'mixed_bfloat16', 'xla', 'mixed_bfloat16+xla']
+
+# per framework execution mode of the drivers, e.g. {'xception3d_max': 'mixed_bfloat16+xla'}
+FRAMEWORK_EXECUTION_MODES = {}
+
+def get_execution_mode(framework):
+    return next((mode for (name, mode) in FRAMEWORK_EXECUTION_MODES.items() if framework.startswith(name)), None)
+
+def cpu_supports_bfloat16():
+    # Native bfloat16 needs AVX512-BF16 or AMX, otherwise it is emulated and slower than float32
+    try:
+        with open('/proc/cpuinfo', 'r') as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def uses_mixed_precision(executionMode):
+    return executionMode is not None and 'mixed_bfloat16' in executionMode
+
+def uses_xla(executionMode):
+    return executionMode is not None and 'xla' in executionMode
+
+def set_execution_mode(executionMode = None):
+    # Must be called before the model is built. Returns the mode that is actually used.
+    if executionMode is None:
+        executionMode = 'float32'
+    if executionMode not in EXECUTION_MODES:
+        hsi_utils.not_supported(executionMode)
+        executionMode = 'float32'
+
+    if uses_mixed_precision(executionMode) and not cpu_supports_bfloat16():
+        print("bfloat16 is not supported by this CPU, using float32.")
+        executionMode = executionMode.replace('mixed_bfloat16+', '').replace('mixed_bfloat16', 'float32')
+
+    mixed_precision.set_global_policy('mixed_bfloat16' if uses_mixed_precision(executionMode) else 'float32')
+    return executionMode
+
+def set_output_float32(model):
+    # Recreates the last layer with a float32 policy, so outputs and the loss stay in float32
+    if model.output.dtype == tf.float32:
+        return model
+
+    lastLayer = model.layers[-1]
+    if isinstance(lastLayer, Model):
+        outputs = layers.Activation('linear', dtype='float32', name='output_float32')(model.output)
+    else:
+        config = lastLayer.get_config()
+        config['dtype'] = 'float32'
+        config['name'] = lastLayer.name + '_float32'
+        outputs = lastLayer.__class__.from_config(config)(lastLayer.input)
+    return Model(inputs=model.inputs, outputs=outputs, name=model.name)
+
 ########################################## COMPILE 
-def get_compile_settings(learning_rate, optimizer, targetLoss, decay):
+def get_compile_settings(learning_rate, optimizer, targetLoss, decay, executionMode = 'float32', accumulationSteps = 1):
     
     lossFunName = "" 
     if type(targetLoss) == type(categorical_crossentropy):
@@ -87,27 +178,43 @@ def get_compile_settings(learning_rate, optimizer, targetLoss, decay):
     else:
         lossFunName = str(targetLoss._name)
         
-    optSettings = "Compiled with" + "\n" + "Optimizer" + str(optimizer._name) + "\n" + "Learning Rate" + str(learning_rate) + "\n" + "Decay" + str(decay) + "\n" +  "Loss Function" + lossFunName
+    optSettings = "Compiled with" + "\n" + "Optimizer" + str(optimizer._name) + "\n" + "Learning Rate" + str(learning_rate) + "\n" + "Decay" + str(decay) + "\n" +  "Loss Function" + lossFunName + "\n" + "Execution Mode" + str(executionMode) + "\n" + "Accumulation Steps" + str(accumulationSteps)
     return optSettings
 
-def compile_and_save_structure(framework, model, optimizer, learning_rate, targetLoss, decay = 0):
+@profiling.profiled()
+def save_cost_report(model, batchSize, inputShape = None, folder = None, measureLatency = True):
+    # Per-layer parameters, MACs and activation memory plus measured CPU latency, next to the model summary
+    report = cost_utils.get_cost_report(model, batchSize, inputShape, measureLatency)
+    cost_utils.save_cost_report(report, get_model_filename('cost', 'txt', folder), get_model_filename('cost', 'json', folder))
+    return report
+
+@profiling.profiled()
+def compile_and_save_structure(framework, model, optimizer, learning_rate, targetLoss, decay = 0, executionMode = None, accumulationSteps = 1):
      
-    optSettings = get_compile_settings(learning_rate, optimizer, targetLoss, decay)
+    executionMode = 'float32' if executionMode is None else executionMode
+    optSettings = get_compile_settings(learning_rate, optimizer, targetLoss, decay, executionMode, accumulationSteps)
     metrics = [sm.metrics.iou_score, 'accuracy', Recall(), Precision(), FalseNegatives(), FalsePositives(), TrueNegatives(), TruePositives()]
 
+    if uses_mixed_precision(executionMode):
+        model = set_output_float32(model)
+    # averages the gradients of accumulationSteps batches per optimizer step
+    model = gradient_accumulation.with_gradient_accumulation(model, accumulationSteps)
+
     model.compile(
         optimizer = optimizer,  #'rmsprop', 'SGD', 'Adam',
         loss=targetLoss,
-        metrics=metrics
+        metrics=metrics,
+        jit_compile=uses_xla(executionMode)
         )
 
     folder = framework 
 
-    save_model_info(model, folder, optSettings)
+    save_model_info(model, folder, optSettings, artifact_writer.get_writer())
 
     return model
 
-def compile_custom(framework, model, optimizerName = "Adam", learning_rate = 0.0001, decay=1e-06, lossFunction = "BCE+JC"):
+def compile_custom(framework, model, optimizerName = "Adam", learning_rate = 0.0001, decay=1e-06, lossFunction = "BCE+JC", executionMode = None,
+    accumulationSteps = 1):
     if optimizerName == "Adam":
         if decay == 0:
             optimizer = Adam(learning_rate=learning_rate, decay = decay)
@@ -128,131 +235,152 @@ def compile_custom(framework, model, optimizerName = "Adam", learning_rate = 0.0
     else: 
         targetLoss = sm.losses.bce_jaccard_loss
         
-    model = compile_and_save_structure(framework, model, optimizer, learning_rate, targetLoss, decay)
+    model = compile_and_save_structure(framework, model, optimizer, learning_rate, targetLoss, decay, executionMode, accumulationSteps)
 
     return model 
 
-def fit_model(framework, model, x_train, y_train, x_test, y_test, numEpochs = 200, batchSize = 64):
+@profiling.profiled()
+def fit_model(framework, model, x_train, y_train, x_test, y_test, numEpochs = 200, batchSize = 64, callbacks = None, monitorThroughput = True,
+    costReport = False):
+    # costReport writes the static cost of the model, without the latency measurement, see model_cost.py for the full report
+
+    folder = framework
+    if costReport:
+        save_cost_report(model, batchSize, x_train.shape[1:], folder, measureLatency=False)
+    # batchSize is the micro-batch when the model accumulates gradients
+    accumulationSteps = gradient_accumulation.get_accumulation_steps(model)
+    save_text({"batchSize": batchSize, "accumulationSteps": accumulationSteps, "effectiveBatchSize": batchSize * accumulationSteps},
+        'batchSettings', folder)
+    callbacks = [] if callbacks is None else list(callbacks)
+    trainData = {"x": x_train, "y": y_train, "batch_size": batchSize}
+    if monitorThroughput:
+        monitor = train_callbacks.ThroughputMonitor(batchSize, len(y_train), get_model_filename('throughput', 'json', folder))
+        callbacks.append(monitor)
+        # batches of the monitor record their fetch time and reshuffle the samples every epoch
+        trainData = {"x": monitor.get_batches(x_train, y_train)}
 
     history = model.fit(
-        x=x_train,
-        y=y_train,
-        batch_size=batchSize,
+        **trainData,
         epochs=numEpochs,
         validation_data=(x_test, y_test),
+        validation_batch_size=batchSize,
+        callbacks=callbacks,
         )
 
-
-    folder = framework
     plot_history(history, folder)
 
     return model, history
 
 ####################################### Evaluation ####################
+@profiling.profiled()
 def plot_history(history, folder = None):
-    fig = plt.figure(1)
-    plt.plot(history.history['loss'])
-    plt.plot(history.history['val_loss'])
-    plt.title('model loss')
-    plt.ylabel('loss')
-    plt.xlabel('epoch')
-    plt.legend(['train', 'test'], loc='upper left')
+    fig, ax = plot_utils.get_figure('loss')
+    ax.plot(history.history['loss'])
+    ax.plot(history.history['val_loss'])
+    ax.set_title('model loss')
+    ax.set_ylabel('loss')
+    ax.set_xlabel('epoch')
+    ax.legend(['train', 'test'], loc='upper left')
 
     filename = get_model_filename('loss', 'png', folder)
-    plt.savefig(filename)
-
-    plt.show()
-
+    plot_utils.finish_figure(fig, filename)
 
-    fig = plt.figure(2)
-    plt.plot(history.history['iou_score'])
-    plt.plot(history.history['val_iou_score'])
-    plt.title('IOU scores')
-    plt.ylabel('iou score')
-    plt.xlabel('epoch')
-    plt.legend(['train', 'test'], loc='upper left')
+    fig, ax = plot_utils.get_figure('iou_score')
+    ax.plot(history.history['iou_score'])
+    ax.plot(history.history['val_iou_score'])
+    ax.set_title('IOU scores')
+    ax.set_ylabel('iou score')
+    ax.set_xlabel('epoch')
+    ax.legend(['train', 'test'], loc='upper left')
 
     filename = get_model_filename('iou_score', 'png', folder)
-    plt.savefig(filename)
+    plot_utils.finish_figure(fig, filename)
 
-    plt.show()
+@profiling.profiled()
+def render_visualization(hsi, gt, pred, figTitle, filename):
+    # Called from the artifact writer threads, where plot_utils always renders with Agg
+    fig, axes = plot_utils.get_figure('visualize', 1, 3)
 
-def visualize(hsi, gt, pred, folder = None, iou = None, suffix = None):
-    fig = plt.figure(3)
-    plt.clf()
-    plt.subplot(1,3,1)
-    plt.title("Original")
-    plt.imshow(hsi_utils.get_display_image(hsi))
+    axes[0].set_title("Original")
+    axes[0].imshow(hsi_utils.get_display_image(hsi))
 
-    plt.subplot(1,3,2)
-    plt.title("Ground Truth")
-    plt.imshow(gt)
+    axes[1].set_title("Ground Truth")
+    axes[1].imshow(gt)
 
-    plt.subplot(1,3,3)
-    figTitle = "Prediction" if iou == None else "Prediction (" + str(iou) + "%)"
-    plt.title(figTitle)
-    plt.imshow(pred)
+    axes[2].set_title(figTitle)
+    axes[2].imshow(pred)
 
-    filename = get_model_filename('v_' + suffix, 'png', folder)
-    plt.savefig(filename)
-    #plt.show()
+    plot_utils.finish_figure(fig, filename)
 
-    # plt.figure(4)
-    # plt.clf()
-    # plt.imshow(pred)
-    # plt.axis('off')
-    # plt.savefig(filename)
+def visualize(hsi, gt, pred, folder = None, iou = None, suffix = None, writer = None):
+    figTitle = "Prediction" if iou == None else "Prediction (" + str(iou) + "%)"
+    pngFilename = get_model_filename('v_' + suffix, 'png', folder)
+    matFilename = get_model_filename('p_' + suffix, 'mat', folder)
 
-    filename = get_model_filename('p_' + suffix, 'mat', folder)
-    savemat(filename,{"prediction": pred })
+    if writer is None:
+        render_visualization(hsi, gt, pred, figTitle, pngFilename)
+        savemat(matFilename, {"prediction": pred })
+    else:
+        writer.submit(render_visualization, hsi, gt, pred, figTitle, pngFilename)
+        writer.submit(savemat, matFilename, {"prediction": pred })
 
 
+@profiling.profiled()
 def plot_roc(fpr, tpr, auc_val, model_name, folder):
 
-    fig = plt.figure(5)
-
-    plt.clf()
-    plt.plot([0, 1], [0, 1], 'k--')
+    fig, ax = plot_utils.get_figure('roc')
+    ax.plot([0, 1], [0, 1], 'k--')
     for (fpr_, tpr_, auc_val_, model_name_) in zip(fpr, tpr, auc_val, model_name):
-        plt.plot(fpr_, tpr_, label=model_name_ +' (area = {:.3f})'.format(auc_val_))
-    plt.xlabel('False positive rate')
-    plt.ylabel('True positive rate')
-    plt.title('ROC curve')
+        ax.plot(fpr_, tpr_, label=model_name_ +' (area = {:.3f})'.format(auc_val_))
+    ax.set_xlabel('False positive rate')
+    ax.set_ylabel('True positive rate')
+    ax.set_title('ROC curve')
 
     # legend
-    plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left')
-
+    ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left')
 
     filename = get_model_filename('auc', 'png', folder)
-    plt.savefig(filename, bbox_inches = 'tight')
-    plt.show()
+    plot_utils.finish_figure(fig, filename, bbox_inches = 'tight')
 
     # Zoom in view of the upper left corner.
-    fig = plt.figure(6)
-
-    plt.clf()
-    plt.xlim(0, 0.2)
-    plt.ylim(0.8, 1)
-    plt.plot([0, 1], [0, 1], 'k--')
+    fig, ax = plot_utils.get_figure('roc_zoom')
+    ax.set_xlim(0, 0.2)
+    ax.set_ylim(0.8, 1)
+    ax.plot([0, 1], [0, 1], 'k--')
     for (fpr_, tpr_, auc_val_, model_name_) in zip(fpr, tpr, auc_val, model_name):
-         plt.plot(fpr_, tpr_, label=model_name_ +' (area = {:.3f})'.format(auc_val_))
-    # plt.plot(fpr_rf, tpr_rf, label='RF (area = {:.3f})'.format(auc_rf))
-    plt.xlabel('False positive rate')
-    plt.ylabel('True positive rate')
-    plt.title('ROC curve (zoomed in at top left)')
-    plt.legend(bbox_to_anchor=(1.02, 1), loc='upper left')
+         ax.plot(fpr_, tpr_, label=model_name_ +' (area = {:.3f})'.format(auc_val_))
+    ax.set_xlabel('False positive rate')
+    ax.set_ylabel('True positive rate')
+    ax.set_title('ROC curve (zoomed in at top left)')
+    ax.legend(bbox_to_anchor=(1.02, 1), loc='upper left')
 
     filename = get_model_filename('auc-zoom', 'png', folder)
-    plt.savefig(filename, bbox_inches = 'tight')
-    plt.show()
+    plot_utils.finish_figure(fig, filename, bbox_inches = 'tight')
 
 
-def calc_plot_roc(model, X_test, y_test, model_name, folder):
-    y_scores = model.predict(X_test).ravel()
-    y_test = np.reshape(y_test.astype(int), (y_scores.shape[0],  1))
+@profiling.profiled()
+def calc_roc(y_scores, y_test, numBins = metrics_utils.DEFAULT_ROC_BINS):
+    # numBins = None computes the exact curve over all pixels
+    if numBins is None:
+        y_scores = np.ravel(y_scores)
+        y_test = np.reshape(y_test.astype(int), (y_scores.shape[0],  1))
 
-    fpr, tpr, thresholds_keras = roc_curve(y_test, y_scores)
-    auc_val = auc(fpr, tpr)
+        fpr, tpr, thresholds_keras = roc_curve(y_test, y_scores)
+        auc_val = auc(fpr, tpr)
+    else:
+        y_scores = np.reshape(y_scores, (len(y_test), -1))
+        roc = metrics_utils.get_binned_roc(y_test, y_scores, numBins)
+        fpr, tpr, thresholds = roc.get_curve()
+        auc_val = roc.get_auc()
+
+    return fpr, tpr, auc_val
+
+def calc_plot_roc(model, X_test, y_test, model_name, folder, preds = None):
+    # preds: optional cached predictions, skips the model.predict pass
+    if preds is None:
+        preds = model.predict(X_test)
+
+    fpr, tpr, auc_val = calc_roc(preds, y_test)
 
     plot_roc([fpr], [tpr], [auc_val], [model_name], folder)
 
@@ -281,18 +409,18 @@ def get_eval_metrics_and_settings(history, isValidation, optz, lr, ed, lossFun):
 
     return evalDict 
 
-def evaluate_model(model, history, framework, folder, x_test, y_test):
+def evaluate_model(model, history, framework, folder, x_test, y_test, preds = None):
     trainEval = get_eval_metrics(history)
     testEval = get_eval_metrics(history, True)
 
-    [fpr_, tpr_, auc_val_] = calc_plot_roc(model, x_test, y_test, framework, folder)
+    [fpr_, tpr_, auc_val_] = calc_plot_roc(model, x_test, y_test, framework, folder, preds)
 
     return fpr_, tpr_, auc_val_, trainEval, testEval
 
 from scipy.io import savemat
 
-def save_evaluate_model(model, history, framework, folder, x_test, y_test):
-    fpr_, tpr_, auc_val_, trainEval, testEval = evaluate_model(model, history, framework, folder, x_test, y_test)
+def save_evaluate_model(model, history, framework, folder, x_test, y_test, preds = None):
+    fpr_, tpr_, auc_val_, trainEval, testEval = evaluate_model(model, history, framework, folder, x_test, y_test, preds)
 
     save_text(trainEval, 'results_train', folder)
     save_text(testEval, 'results_test', folder)
@@ -313,6 +441,14 @@ def save_evaluate_model_folds(folder, fpr_, tpr_, auc_val_, trainEval, testEval,
 
     return
 
+def save_profile(folder = None, withTrace = True):
+    profiling.print_report()
+    filename = get_model_filename('0_profile', 'json', folder)
+    profiling.save_report(filename)
+    print("Saved profile at: ", filename)
+    if withTrace:
+        profiling.save_chrome_trace(get_model_filename('0_profile_trace', 'json', folder))
+
 def save_performance(folder, testEval):   
     filename = get_model_filename('0_performance', 'mat', folder)
     mdic = { "testEval": testEval}
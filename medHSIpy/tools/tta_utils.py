@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*
+
+import numpy as np
+
+# Transforms of the spatial axes 1 and 2 of a batch, (N, H, W, bands) or (N, H, W, bands, 1),
+# as (forward on the inputs, inverse on the (N, H, W, classes) outputs)
+flip_h = lambda x: x[:, ::-1]
+flip_w = lambda x: x[:, :, ::-1]
+swap_hw = lambda x: np.swapaxes(x, 1, 2)
+rotate = lambda k: lambda x: np.rot90(x, k, axes=(1, 2))
+
+TRANSFORMS = {
+    'identity': (lambda x: x, lambda y: y),
+    'hflip': (flip_w, flip_w),
+    'vflip': (flip_h, flip_h),
+    'rot90': (rotate(1), rotate(-1)),
+    'rot180': (rotate(2), rotate(2)),
+    'rot270': (rotate(3), rotate(-3)),
+    'transpose': (swap_hw, swap_hw),
+    'antitranspose': (lambda x: swap_hw(x)[:, ::-1, ::-1], lambda y: swap_hw(y)[:, ::-1, ::-1]),
+}
+
+# Named transform sets, 'flips' and 'flips+rot180' keep the spatial size of non-square inputs
+TRANSFORM_SETS = {
+    'none': ['identity'],
+    'flips': ['identity', 'hflip', 'vflip'],
+    'flips+rot180': ['identity', 'hflip', 'vflip', 'rot180'],
+    'rotations': ['identity', 'rot90', 'rot180', 'rot270'],
+    'd4': list(TRANSFORMS),
+}
+DEFAULT_TRANSFORMS = 'flips+rot180'
+
+def get_transforms(transforms = DEFAULT_TRANSFORMS):
+    # A set name, a comma separated string or a list of TRANSFORMS names
+    if isinstance(transforms, str):
+        transforms = TRANSFORM_SETS.get(transforms, [x.strip() for x in transforms.split(',') if x.strip()])
+    transforms = list(transforms)
+    unknown = [x for x in transforms if x not in TRANSFORMS]
+    if unknown or not transforms:
+        raise ValueError("Unknown test-time transforms: " + str(unknown or transforms))
+    return transforms
+
+def predict_tta(predict_on_batch, x, transforms = DEFAULT_TRANSFORMS):
+    """Mean prediction over the transformed variants of the batch x, in a single model call.
+
+    The variants are concatenated along the batch axis and the transforms are inverted on the outputs.
+    Transforms that swap height and width of a non-square x give a second batch of the other shape.
+    """
+
+    transforms = get_transforms(transforms)
+    x = np.asarray(x)
+    groups = {}
+    for name in transforms:
+        variant = TRANSFORMS[name][0](x)
+        groups.setdefault(variant.shape[1:3], []).append((name, variant))
+
+    out = None
+    for variants in groups.values():
+        preds = np.asarray(predict_on_batch(np.concatenate([v for _, v in variants], axis=0)), dtype=np.float32)
+        for (name, _), pred in zip(variants, np.split(preds, len(variants))):
+            restored = TRANSFORMS[name][1](pred)
+            if out is None:
+                out = np.zeros(restored.shape, dtype=np.float32)
+            out += restored
+    out /= len(transforms)
+    return out
+
+class TTAModel:
+    # A model whose predict_on_batch averages over test-time transforms, for EvaluationSession,
+    # model_registry.predict and the ensemble. Batches grow by the number of transforms.
+
+    def __init__(self, model, transforms = DEFAULT_TRANSFORMS):
+        self.model = model
+        self.transforms = get_transforms(transforms)
+        self.name = getattr(model, 'name', 'model') + '_tta' + str(len(self.transforms))
+
+    def predict_on_batch(self, x):
+        return predict_tta(self.model.predict_on_batch, x, self.transforms)
+
+def with_tta(model, transforms = None):
+    # model itself without transforms
+    if transforms is None or isinstance(model, TTAModel):
+        return model
+    return TTAModel(model, transforms)
@@ -4,16 +4,55 @@ from keras.models import Model
 
 if __name__ == "__main__":
     import train_utils
+    import profiling
+    import batch_tuner
+    import checkpointing as ckpt
+    import DepthwiseConv3D as dc3d
 else:
     from . import train_utils
+    from . import profiling
+    from . import batch_tuner
+    from . import checkpointing as ckpt
+    from . import DepthwiseConv3D as dc3d
 
 N_SPACE = 3
 STRIDES_SPACE = 2 
 STRIDES_SPECTRUM = 2
 DROPOUT_RATE = 0.4
 
+########################################################################
+def depth_conv_layer(x, filters, kernel, name, blockType = 'full'):
+    # 'full' keeps the original dense Conv3D, 'separable' is a true depthwise-separable convolution
+    if blockType == 'separable':
+        x = dc3d.DepthwiseConv3D(kernel, padding="same", use_bias=False, name=name + '_a')(x)
+    else:
+        x = dc3d.conv3d_block(x, filters, kernel, blockType, name=name + '_a', use_bias=False)
+    x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name=name + '_b')(x)
+    return x
+
+def entry_conv_block(x, filters, kernel, name, strides = (1, 1, 1), padding = "valid"):
+    # Conv3D, BN and ReLU of the entry block, the dropout that follows stays outside of a recomputed block
+    x = layers.Conv3D(filters, kernel, strides=strides, use_bias=False, padding=padding, name=name)(x)
+    x = layers.BatchNormalization(axis=-1, name=name + '_bn')(x)
+    x = layers.Activation("relu", name=name + '_act')(x)
+    return x
+
+def separable_block(x, k, filters, kernel, blockType = 'full'):
+    # Encoder block k up to its pooling, the dropout and the residual stay outside of a recomputed block
+    if k > 2:
+        x = layers.Activation("relu", name='block'+str(k-1)+'_conv2_act')(x)
+    x = depth_conv_layer(x, filters, kernel, 'block'+str(k)+'_DepthConv1', blockType)
+    x = layers.BatchNormalization(axis=-1, name='block'+str(k)+'_DepthConv1_bn')(x)
+
+    x = layers.Activation("relu", name='block'+str(k)+'_conv2_act_mid')(x)
+    x = depth_conv_layer(x, filters, kernel, 'block'+str(k)+'_DepthConv2', blockType)
+    x = layers.BatchNormalization(axis=-1, name='block'+str(k)+'_DepthConv2_bn')(x)
+
+    x = layers.MaxPooling3D(kernel, strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), padding="same", name='block'+str(k)+'_pool')(x)
+    return x
+
 ## With filters 128, 256, 728  and spectral_step =15
-def get_xception3d_1(dropMiddle, width, height, numChannels, numClasses):
+def get_xception3d_1(dropMiddle, width, height, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
     channel_axis = -1
     depth = numChannels
     spectral_step = 15
@@ -23,14 +62,12 @@ def get_xception3d_1(dropMiddle, width, height, numChannels, numClasses):
     ### [First half of the network: downsampling inputs] ###
 
     # Entry block
-    x = layers.Conv3D(32, (N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), use_bias=False, padding="same", name='block1_conv1')(inputs)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv1_bn')(x)
-    x = layers.Activation("relu", name='block1_conv1_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 32, (N_SPACE, N_SPACE, spectral_step), 'block1_conv1',
+        strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), padding="same"), inputs, ckpt.is_checkpointed(checkpointPolicy, 0), 'block1_conv1_recompute')
     x = layers.Dropout(DROPOUT_RATE)(x)
 
-    x = layers.Conv3D(64, (N_SPACE, N_SPACE, spectral_step), use_bias=False, name='block1_conv2')(x)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv2_bn')(x)
-    x = layers.Activation('relu', name='block1_conv2_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 64, (N_SPACE, N_SPACE, spectral_step), 'block1_conv2'), x,
+        ckpt.is_checkpointed(checkpointPolicy, 1), 'block1_conv2_recompute')
     x = layers.Dropout(DROPOUT_RATE)(x)
 
     previous_block_activation = x  # Set aside residual
@@ -39,19 +76,8 @@ def get_xception3d_1(dropMiddle, width, height, numChannels, numClasses):
     k = 1
     for filters in  [128, 256, 728]:
         k += 1
-        if k > 2:
-            x = layers.Activation("relu", name='block'+str(k-1)+'_conv2_act')(x)
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv1_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv1_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv1_bn')(x)
-
-        x = layers.Activation("relu", name='block'+str(k)+'_conv2_act_mid')(x)
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv2_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv2_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv2_bn')(x)
-
-        x = layers.MaxPooling3D((N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), 
-            padding="same", name='block'+str(k)+'_pool')(x)
+        x = ckpt.checkpoint_block(lambda y: separable_block(y, k, filters, (N_SPACE, N_SPACE, spectral_step), blockType), x,
+            ckpt.is_checkpointed(checkpointPolicy, k), 'block'+str(k)+'_recompute')
         x = layers.Dropout(DROPOUT_RATE*0.6)(x)
 
         # Project residual
@@ -115,7 +141,7 @@ def get_xception3d_1(dropMiddle, width, height, numChannels, numClasses):
     return model
 
 ## With filters 128, 256  and spectral_step = 15
-def get_xception3d_3(dropMiddle, width, height, numChannels, numClasses):
+def get_xception3d_3(dropMiddle, width, height, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
     channel_axis = -1
     depth = numChannels
     spectral_step = 15
@@ -124,14 +150,12 @@ def get_xception3d_3(dropMiddle, width, height, numChannels, numClasses):
     ### [First half of the network: downsampling inputs] ###
 
     # Entry block
-    x = layers.Conv3D(32, (N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), use_bias=False, padding="same", name='block1_conv1')(inputs)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv1_bn')(x)
-    x = layers.Activation("relu", name='block1_conv1_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 32, (N_SPACE, N_SPACE, spectral_step), 'block1_conv1',
+        strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), padding="same"), inputs, ckpt.is_checkpointed(checkpointPolicy, 0), 'block1_conv1_recompute')
     x = layers.Dropout(DROPOUT_RATE)(x)
 
-    x = layers.Conv3D(64, (N_SPACE, N_SPACE, spectral_step), use_bias=False, name='block1_conv2')(x)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv2_bn')(x)
-    x = layers.Activation('relu', name='block1_conv2_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 64, (N_SPACE, N_SPACE, spectral_step), 'block1_conv2'), x,
+        ckpt.is_checkpointed(checkpointPolicy, 1), 'block1_conv2_recompute')
     x = layers.Dropout(DROPOUT_RATE)(x)
 
     previous_block_activation = x  # Set aside residual
@@ -140,19 +164,8 @@ def get_xception3d_3(dropMiddle, width, height, numChannels, numClasses):
     k = 1
     for filters in  [128, 256]:
         k += 1
-        if k > 2:
-            x = layers.Activation("relu", name='block'+str(k-1)+'_conv2_act')(x)
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv1_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv1_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv1_bn')(x)
-
-        x = layers.Activation("relu", name='block'+str(k)+'_conv2_act_mid')(x)
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv2_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv2_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv2_bn')(x)
-
-        x = layers.MaxPooling3D((N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), 
-            padding="same", name='block'+str(k)+'_pool')(x)
+        x = ckpt.checkpoint_block(lambda y: separable_block(y, k, filters, (N_SPACE, N_SPACE, spectral_step), blockType), x,
+            ckpt.is_checkpointed(checkpointPolicy, k), 'block'+str(k)+'_recompute')
         x = layers.Dropout(DROPOUT_RATE)(x)
 
         # Project residual
@@ -214,7 +227,7 @@ def get_xception3d_3(dropMiddle, width, height, numChannels, numClasses):
     return model
 
 ## With filters 128, 256  and spectral_step = 10,20
-def get_xception3d_4(dropMiddle, width, height, numChannels, numClasses):
+def get_xception3d_4(dropMiddle, width, height, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
     channel_axis = -1
     depth = numChannels
     inputs = layers.Input((width, height, depth, 1), name='entry')
@@ -224,14 +237,12 @@ def get_xception3d_4(dropMiddle, width, height, numChannels, numClasses):
     ### [First half of the network: downsampling inputs] ###
 
     # Entry block
-    x = layers.Conv3D(32, (N_SPACE, N_SPACE, spectral_step1), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), use_bias=False, padding="same", name='block1_conv1')(inputs)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv1_bn')(x)
-    x = layers.Activation("relu", name='block1_conv1_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 32, (N_SPACE, N_SPACE, spectral_step1), 'block1_conv1',
+        strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), padding="same"), inputs, ckpt.is_checkpointed(checkpointPolicy, 0), 'block1_conv1_recompute')
     x = layers.Dropout(DROPOUT_RATE)(x)
 
-    x = layers.Conv3D(64, (N_SPACE, N_SPACE, spectral_step1), use_bias=False, name='block1_conv2')(x)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv2_bn')(x)
-    x = layers.Activation('relu', name='block1_conv2_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 64, (N_SPACE, N_SPACE, spectral_step1), 'block1_conv2'), x,
+        ckpt.is_checkpointed(checkpointPolicy, 1), 'block1_conv2_recompute')
     x = layers.Dropout(DROPOUT_RATE)(x)
 
     previous_block_activation = x  # Set aside residual
@@ -240,20 +251,8 @@ def get_xception3d_4(dropMiddle, width, height, numChannels, numClasses):
     k = 1
     for filters in  [128, 256]:
         k += 1
-        if k > 2:
-            x = layers.Activation("relu", name='block'+str(k-1)+'_conv2_act')(x)
-
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step2), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv1_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv1_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv1_bn')(x)
-
-        x = layers.Activation("relu", name='block'+str(k)+'_conv2_act_mid')(x)
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step2), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv2_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv2_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv2_bn')(x)
-
-        x = layers.MaxPooling3D((N_SPACE, N_SPACE, spectral_step2), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), 
-            padding="same", name='block'+str(k)+'_pool')(x)
+        x = ckpt.checkpoint_block(lambda y: separable_block(y, k, filters, (N_SPACE, N_SPACE, spectral_step2), blockType), x,
+            ckpt.is_checkpointed(checkpointPolicy, k), 'block'+str(k)+'_recompute')
         x = layers.Dropout(DROPOUT_RATE)(x)
 
         # Project residual
@@ -315,7 +314,7 @@ def get_xception3d_4(dropMiddle, width, height, numChannels, numClasses):
     return model
 
 ## With filters 128, 256  and spectral_step = 10,20 and 3D dropout
-def get_xception3d_5(dropMiddle, width, height, numChannels, numClasses):
+def get_xception3d_5(dropMiddle, width, height, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
     channel_axis = -1
     depth = numChannels
     inputs = layers.Input((width, height, depth, 1), name='entry')
@@ -325,14 +324,12 @@ def get_xception3d_5(dropMiddle, width, height, numChannels, numClasses):
     ### [First half of the network: downsampling inputs] ###
 
     # Entry block
-    x = layers.Conv3D(32, (N_SPACE, N_SPACE, spectral_step1), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), use_bias=False, padding="same", name='block1_conv1')(inputs)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv1_bn')(x)
-    x = layers.Activation("relu", name='block1_conv1_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 32, (N_SPACE, N_SPACE, spectral_step1), 'block1_conv1',
+        strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), padding="same"), inputs, ckpt.is_checkpointed(checkpointPolicy, 0), 'block1_conv1_recompute')
     x = layers.SpatialDropout3D(DROPOUT_RATE)(x)
 
-    x = layers.Conv3D(64, (N_SPACE, N_SPACE, spectral_step1), use_bias=False, name='block1_conv2')(x)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv2_bn')(x)
-    x = layers.Activation('relu', name='block1_conv2_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 64, (N_SPACE, N_SPACE, spectral_step1), 'block1_conv2'), x,
+        ckpt.is_checkpointed(checkpointPolicy, 1), 'block1_conv2_recompute')
     x = layers.SpatialDropout3D(DROPOUT_RATE)(x)
 
     previous_block_activation = x  # Set aside residual
@@ -341,20 +338,8 @@ def get_xception3d_5(dropMiddle, width, height, numChannels, numClasses):
     k = 1
     for filters in  [128, 256]:
         k += 1
-        if k > 2:
-            x = layers.Activation("relu", name='block'+str(k-1)+'_conv2_act')(x)
-            
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step2), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv1_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv1_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv1_bn')(x)
-
-        x = layers.Activation("relu", name='block'+str(k)+'_conv2_act_mid')(x)
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step2), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv2_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv2_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv2_bn')(x)
-
-        x = layers.MaxPooling3D((N_SPACE, N_SPACE, spectral_step2), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), 
-            padding="same", name='block'+str(k)+'_pool')(x)
+        x = ckpt.checkpoint_block(lambda y: separable_block(y, k, filters, (N_SPACE, N_SPACE, spectral_step2), blockType), x,
+            ckpt.is_checkpointed(checkpointPolicy, k), 'block'+str(k)+'_recompute')
         x = layers.SpatialDropout3D(DROPOUT_RATE)(x)
 
         # Project residual
@@ -417,7 +402,7 @@ def get_xception3d_5(dropMiddle, width, height, numChannels, numClasses):
     return model
 ######################################################################
 
-def get_xception3d_10(dropMiddle, width, height, numChannels, numClasses):
+def get_xception3d_10(dropMiddle, width, height, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
     dr = 0.5
     
     channel_axis = -1
@@ -428,14 +413,12 @@ def get_xception3d_10(dropMiddle, width, height, numChannels, numClasses):
     ### [First half of the network: downsampling inputs] ###
 
     # Entry block
-    x = layers.Conv3D(32, (N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), use_bias=False, padding="same", name='block1_conv1')(inputs)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv1_bn')(x)
-    x = layers.Activation("relu", name='block1_conv1_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 32, (N_SPACE, N_SPACE, spectral_step), 'block1_conv1',
+        strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), padding="same"), inputs, ckpt.is_checkpointed(checkpointPolicy, 0), 'block1_conv1_recompute')
     x = layers.Dropout(dr)(x)
 
-    x = layers.Conv3D(64, (N_SPACE, N_SPACE, spectral_step), use_bias=False, name='block1_conv2')(x)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv2_bn')(x)
-    x = layers.Activation('relu', name='block1_conv2_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 64, (N_SPACE, N_SPACE, spectral_step), 'block1_conv2'), x,
+        ckpt.is_checkpointed(checkpointPolicy, 1), 'block1_conv2_recompute')
     x = layers.Dropout(dr)(x)
 
     previous_block_activation = x  # Set aside residual
@@ -444,20 +427,8 @@ def get_xception3d_10(dropMiddle, width, height, numChannels, numClasses):
     k = 1
     for filters in  [128, 256]:
         k += 1
-        if k > 2:
-            x = layers.Activation("relu", name='block'+str(k-1)+'_conv2_act')(x)
-
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv1_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv1_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv1_bn')(x)
-
-        x = layers.Activation("relu", name='block'+str(k)+'_conv2_act_mid')(x)
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv2_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv2_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv2_bn')(x)
-
-        x = layers.MaxPooling3D((N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), 
-            padding="same", name='block'+str(k)+'_pool')(x)
+        x = ckpt.checkpoint_block(lambda y: separable_block(y, k, filters, (N_SPACE, N_SPACE, spectral_step), blockType), x,
+            ckpt.is_checkpointed(checkpointPolicy, k), 'block'+str(k)+'_recompute')
         x = layers.Dropout(dr)(x)
 
         # Project residual
@@ -518,7 +489,7 @@ def get_xception3d_10(dropMiddle, width, height, numChannels, numClasses):
     model = Model(inputs, outputs, name = "xception3D_10")
     return model
 
-def get_xception3d_20(dropMiddle, width, height, numChannels, numClasses):
+def get_xception3d_20(dropMiddle, width, height, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
     dr = 0.5
     
     channel_axis = -1
@@ -529,14 +500,12 @@ def get_xception3d_20(dropMiddle, width, height, numChannels, numClasses):
     ### [First half of the network: downsampling inputs] ###
 
     # Entry block
-    x = layers.Conv3D(32, (N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), use_bias=False, padding="same", name='block1_conv1')(inputs)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv1_bn')(x)
-    x = layers.Activation("relu", name='block1_conv1_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 32, (N_SPACE, N_SPACE, spectral_step), 'block1_conv1',
+        strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), padding="same"), inputs, ckpt.is_checkpointed(checkpointPolicy, 0), 'block1_conv1_recompute')
     x = layers.Dropout(dr)(x)
 
-    x = layers.Conv3D(64, (N_SPACE, N_SPACE, spectral_step), use_bias=False, name='block1_conv2')(x)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv2_bn')(x)
-    x = layers.Activation('relu', name='block1_conv2_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 64, (N_SPACE, N_SPACE, spectral_step), 'block1_conv2'), x,
+        ckpt.is_checkpointed(checkpointPolicy, 1), 'block1_conv2_recompute')
     x = layers.Dropout(dr)(x)
 
     previous_block_activation = x  # Set aside residual
@@ -545,20 +514,8 @@ def get_xception3d_20(dropMiddle, width, height, numChannels, numClasses):
     k = 1
     for filters in  [128, 256]:
         k += 1
-        if k > 2:
-            x = layers.Activation("relu", name='block'+str(k-1)+'_conv2_act')(x)
-
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv1_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv1_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv1_bn')(x)
-
-        x = layers.Activation("relu", name='block'+str(k)+'_conv2_act_mid')(x)
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv2_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv2_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv2_bn')(x)
-
-        x = layers.MaxPooling3D((N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), 
-            padding="same", name='block'+str(k)+'_pool')(x)
+        x = ckpt.checkpoint_block(lambda y: separable_block(y, k, filters, (N_SPACE, N_SPACE, spectral_step), blockType), x,
+            ckpt.is_checkpointed(checkpointPolicy, k), 'block'+str(k)+'_recompute')
         x = layers.Dropout(dr)(x)
 
         # Project residual
@@ -619,7 +576,7 @@ def get_xception3d_20(dropMiddle, width, height, numChannels, numClasses):
     model = Model(inputs, outputs, name = "xception3D_20")
     return model
 
-def get_xception3d_30(dropMiddle, width, height, numChannels, numClasses):
+def get_xception3d_30(dropMiddle, width, height, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
     dr = 0.5
     
     channel_axis = -1
@@ -630,14 +587,12 @@ def get_xception3d_30(dropMiddle, width, height, numChannels, numClasses):
     ### [First half of the network: downsampling inputs] ###
 
     # Entry block
-    x = layers.Conv3D(32, (N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), use_bias=False, padding="same", name='block1_conv1')(inputs)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv1_bn')(x)
-    x = layers.Activation("relu", name='block1_conv1_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 32, (N_SPACE, N_SPACE, spectral_step), 'block1_conv1',
+        strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), padding="same"), inputs, ckpt.is_checkpointed(checkpointPolicy, 0), 'block1_conv1_recompute')
     x = layers.Dropout(dr)(x)
 
-    x = layers.Conv3D(64, (N_SPACE, N_SPACE, spectral_step), use_bias=False, name='block1_conv2')(x)
-    x = layers.BatchNormalization(axis=channel_axis, name='block1_conv2_bn')(x)
-    x = layers.Activation('relu', name='block1_conv2_act')(x)
+    x = ckpt.checkpoint_block(lambda y: entry_conv_block(y, 64, (N_SPACE, N_SPACE, spectral_step), 'block1_conv2'), x,
+        ckpt.is_checkpointed(checkpointPolicy, 1), 'block1_conv2_recompute')
     x = layers.Dropout(dr)(x)
 
     previous_block_activation = x  # Set aside residual
@@ -646,20 +601,8 @@ def get_xception3d_30(dropMiddle, width, height, numChannels, numClasses):
     k = 1
     for filters in  [128, 256]:
         k += 1
-        if k > 2:
-            x = layers.Activation("relu", name='block'+str(k-1)+'_conv2_act')(x)
-
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv1_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv1_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv1_bn')(x)
-
-        x = layers.Activation("relu", name='block'+str(k)+'_conv2_act_mid')(x)
-        x = layers.Conv3D(filters, (N_SPACE, N_SPACE, spectral_step), padding="same", groups=1, use_bias=False, name='block'+str(k)+'_DepthConv2_a')(x) #DepthwiseConv3D
-        x = layers.Conv3D(filters, (1,1,1), padding="same", use_bias=False, name='block'+str(k)+'_DepthConv2_b')(x)
-        x = layers.BatchNormalization(axis=channel_axis, name='block'+str(k)+'_DepthConv2_bn')(x)
-
-        x = layers.MaxPooling3D((N_SPACE, N_SPACE, spectral_step), strides=(STRIDES_SPACE, STRIDES_SPACE, STRIDES_SPECTRUM), 
-            padding="same", name='block'+str(k)+'_pool')(x)
+        x = ckpt.checkpoint_block(lambda y: separable_block(y, k, filters, (N_SPACE, N_SPACE, spectral_step), blockType), x,
+            ckpt.is_checkpointed(checkpointPolicy, k), 'block'+str(k)+'_recompute')
         x = layers.Dropout(dr)(x)
 
         # Project residual
@@ -898,44 +841,53 @@ def get_xception3d_2(dropMiddle, width, height, numChannels, numClasses):
     return model
 
 ###################################### TRAINING #######################################
-def get_xception3d_mean(height, width, numChannels, numClasses):
-    model = get_xception3d_1('mean', height, width, numChannels, numClasses)
+def get_xception3d_mean(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    model = get_xception3d_1('mean', height, width, numChannels, numClasses, blockType, checkpointPolicy)
     return model 
 
-def get_xception3d_max(height, width, numChannels, numClasses):
-    model = get_xception3d_1('max', height, width, numChannels, numClasses)
+def get_xception3d_max(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    model = get_xception3d_1('max', height, width, numChannels, numClasses, blockType, checkpointPolicy)
     return model 
 
-def get_xception3d2_mean(height, width, numChannels, numClasses):
+def check_xception3d2_args(blockType, checkpointPolicy):
+    # xception3d2 has its own separable layers and no recomputed blocks, the arguments are only accepted at their defaults
+    if blockType != 'full':
+        raise ValueError("xception3d2 does not support blockType " + str(blockType))
+    if ckpt.get_checkpoint_interval(checkpointPolicy) > 0:
+        raise ValueError("xception3d2 does not support checkpointPolicy " + str(checkpointPolicy))
+
+def get_xception3d2_mean(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    check_xception3d2_args(blockType, checkpointPolicy)
     model = get_xception3d_2('mean', height, width, numChannels, numClasses)
     return model 
 
-def get_xception3d2_max(height, width, numChannels, numClasses):
+def get_xception3d2_max(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    check_xception3d2_args(blockType, checkpointPolicy)
     model = get_xception3d_2('max', height, width, numChannels, numClasses)
     return model 
 
-def get_xception3d3_mean(height, width, numChannels, numClasses):
-    model = get_xception3d_3('mean', height, width, numChannels, numClasses)
+def get_xception3d3_mean(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    model = get_xception3d_3('mean', height, width, numChannels, numClasses, blockType, checkpointPolicy)
     return model 
 
-def get_xception3d3_max(height, width, numChannels, numClasses):
-    model = get_xception3d_3('max', height, width, numChannels, numClasses)
+def get_xception3d3_max(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    model = get_xception3d_3('max', height, width, numChannels, numClasses, blockType, checkpointPolicy)
     return model 
 
-def get_xception3d4_mean(height, width, numChannels, numClasses):
-    model = get_xception3d_4('mean', height, width, numChannels, numClasses)
+def get_xception3d4_mean(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    model = get_xception3d_4('mean', height, width, numChannels, numClasses, blockType, checkpointPolicy)
     return model 
 
-def get_xception3d4_max(height, width, numChannels, numClasses):
-    model = get_xception3d_4('max', height, width, numChannels, numClasses)
+def get_xception3d4_max(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    model = get_xception3d_4('max', height, width, numChannels, numClasses, blockType, checkpointPolicy)
     return model 
 
-def get_xception3d5_mean(height, width, numChannels, numClasses):
-    model = get_xception3d_5('mean', height, width, numChannels, numClasses)
+def get_xception3d5_mean(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    model = get_xception3d_5('mean', height, width, numChannels, numClasses, blockType, checkpointPolicy)
     return model 
 
-def get_xception3d5_max(height, width, numChannels, numClasses):
-    model = get_xception3d_5('max', height, width, numChannels, numClasses)
+def get_xception3d5_max(height, width, numChannels, numClasses, blockType = 'full', checkpointPolicy = None):
+    model = get_xception3d_5('max', height, width, numChannels, numClasses, blockType, checkpointPolicy)
     return model 
 
 
@@ -944,9 +896,11 @@ def get_xception3d5_max(height, width, numChannels, numClasses):
 #     return x_train_preproc, x_test_preproc
 
 def get_xception_model(framework, x_train_raw, ytrain, x_test_raw, ytest, height, width, numChannels, numClasses, numEpochs=200, batchSize=8, 
-    optimizerName = "RMSProp", learning_rate = 0.00001, decay = 0, lossFunction = "BCE+JC"):
+    optimizerName = "RMSProp", learning_rate = 0.00001, decay = 0, lossFunction = "BCE+JC", tuneBatchSize = False, memoryBudgetMB = None, executionMode = None,
+    blockType = 'full', accumulationSteps = 1, checkpointPolicy = None):
 
     backend.clear_session()
+    executionMode = train_utils.set_execution_mode(executionMode)
     
     ## already preprocessed from 0 to 1
     # x_train_preproc, x_test_preproc = preproc_data(x_train_raw, x_test_raw)
@@ -954,69 +908,75 @@ def get_xception_model(framework, x_train_raw, ytrain, x_test_raw, ytest, height
     x_train_preproc = x_train_raw
     x_test_preproc = x_test_raw
 
-    if 'xception3d_max' in framework:
-        model = get_xception3d_max(height, width, numChannels, numClasses)
-        batchSize = 4
-        # learning_rate = 0.00001
+    with profiling.stage('build_model'):
+        if 'xception3d_max' in framework:
+            model = get_xception3d_max(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 4
+            # learning_rate = 0.00001
 
-    elif 'xception3d_mean' in framework: 
-        model = get_xception3d_mean(height, width, numChannels, numClasses)
-        batchSize = 4
-        # learning_rate = 0.00001
+        elif 'xception3d_mean' in framework: 
+            model = get_xception3d_mean(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 4
+            # learning_rate = 0.00001
 
-    elif 'xception3d2_max' in framework:
-        model = get_xception3d2_max(height, width, numChannels, numClasses)
-        batchSize = 32
+        elif 'xception3d2_max' in framework:
+            model = get_xception3d2_max(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 32
 
-    elif 'xception3d2_mean' in framework:
-        model = get_xception3d2_mean(height, width, numChannels, numClasses)
-        batchSize = 32
+        elif 'xception3d2_mean' in framework:
+            model = get_xception3d2_mean(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 32
     
-    elif 'xception3d3_max' in framework:
-        model = get_xception3d3_max(height, width, numChannels, numClasses)
-
-    elif 'xception3d3_mean' in framework:
-        model = get_xception3d3_mean(height, width, numChannels, numClasses)
-
-    elif 'xception3d4_max' in framework:
-        model = get_xception3d4_max(height, width, numChannels, numClasses)
-        batchSize = 16
-        # learning_rate = 0.00001
-
-    elif 'xception3d4_mean' in framework:
-        model = get_xception3d4_mean(height, width, numChannels, numClasses)
-        batchSize = 16
-        # learning_rate = 0.00001
-
-    elif 'xception3d5_max' in framework:
-        model = get_xception3d5_max(height, width, numChannels, numClasses)
-        batchSize = 16
-        # learning_rate = 0.0000005 #0.0000001
-
-    elif 'xception3d5_mean' in framework:
-        model = get_xception3d5_mean(height, width, numChannels, numClasses)
-        batchSize = 16
-        # learning_rate = 0.0000005 #0.0000001
-
-    elif 'xception3d_10n' in framework:
-        model = get_xception3d_10('max', width, height, numChannels, numClasses)
-        batchSize = 16
-        learning_rate = 0.000001 #0.0000001
-
-    elif 'xception3d_20n' in framework:
-        model = get_xception3d_20('max', width, height, numChannels, numClasses)
-        batchSize = 16
-        learning_rate = 0.000001 #0.0000001
-
-    elif 'xception3d_30n' in framework:
-        model = get_xception3d_30('max', width, height, numChannels, numClasses)
-        batchSize = 16
-        learning_rate = 0.000001 #0.0000001
-
-    else: 
-        print("Model:" + framework + " is not supported")
-
-    model = train_utils.compile_custom(framework, model, optimizerName, learning_rate, decay, lossFunction)
+        elif 'xception3d3_max' in framework:
+            model = get_xception3d3_max(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+
+        elif 'xception3d3_mean' in framework:
+            model = get_xception3d3_mean(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+
+        elif 'xception3d4_max' in framework:
+            model = get_xception3d4_max(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 16
+            # learning_rate = 0.00001
+
+        elif 'xception3d4_mean' in framework:
+            model = get_xception3d4_mean(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 16
+            # learning_rate = 0.00001
+
+        elif 'xception3d5_max' in framework:
+            model = get_xception3d5_max(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 16
+            # learning_rate = 0.0000005 #0.0000001
+
+        elif 'xception3d5_mean' in framework:
+            model = get_xception3d5_mean(height, width, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 16
+            # learning_rate = 0.0000005 #0.0000001
+
+        elif 'xception3d_10n' in framework:
+            model = get_xception3d_10('max', width, height, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 16
+            learning_rate = 0.000001 #0.0000001
+
+        elif 'xception3d_20n' in framework:
+            model = get_xception3d_20('max', width, height, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 16
+            learning_rate = 0.000001 #0.0000001
+
+        elif 'xception3d_30n' in framework:
+            model = get_xception3d_30('max', width, height, numChannels, numClasses, blockType, checkpointPolicy)
+            batchSize = 16
+            learning_rate = 0.000001 #0.0000001
+
+        else: 
+            print("Model:" + framework + " is not supported")
+
+    # replaces the per-variant batch sizes above with one probed on this host
+    if tuneBatchSize:
+        batchSize = batch_tuner.tune_batch_size(model, x_train_preproc.shape[1:], memoryBudgetMB, executionMode=executionMode)
+
+    # with accumulationSteps > 1 the optimizer steps on accumulationSteps * batchSize samples
+    model = train_utils.compile_custom(framework, model, optimizerName, learning_rate, decay, lossFunction, executionMode, accumulationSteps)
     model, history = train_utils.fit_model(framework, model, x_train_preproc, ytrain, x_test_preproc, ytest, numEpochs, batchSize)
 
     return model, history
@@ -0,0 +1,71 @@
+import argparse
+import sys
+
+from tools import distributed_utils, experiment_scheduler, hio, eval_utils, artifact_writer, model_registry, train_utils
+
+# Data-parallel training of one framework on several CPU workers.
+#   on every node, with --index 0 on the chief:
+#   python train_distributed.py xception3d_max --hosts node1,node2,node3 --index 0
+#   the same with local worker processes on this machine:
+#   python train_distributed.py cnn3d --local 2 --epochs 2
+
+WIDTH = 32
+HEIGHT = 32
+NUMBER_OF_CLASSES = 1
+NUMBER_OF_CHANNELS = 311
+
+def get_worker_command(argv):
+    # this script again, without --local
+    command = [sys.executable, __file__]
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--local':
+            skip = True
+        elif not arg.startswith('--local='):
+            command.append(arg)
+    return command
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Multi-worker training of a medHSIpy model.')
+    parser.add_argument('framework')
+    parser.add_argument('--hosts', default=None, help='comma separated host[:port] list, the same on every worker')
+    parser.add_argument('--index', type=int, default=0, help='position of this worker in --hosts')
+    parser.add_argument('--local', type=int, default=None, help='launch this many worker processes on this machine')
+    parser.add_argument('--port', type=int, default=distributed_utils.DEFAULT_PORT, help='first port of the local workers')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads per worker')
+    parser.add_argument('--fold', type=int, default=None)
+    parser.add_argument('--epochs', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=4, help='per worker')
+    parser.add_argument('--optimizer', default='RMSProp')
+    parser.add_argument('--lr', type=float, default=0.0001)
+    parser.add_argument('--block-type', default=None)
+    parser.add_argument('--recompute', default=None, help="recomputed encoder blocks: 'all' or 'everyN'")
+    parser.add_argument('--checkpoint-period', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.local is not None:
+        sys.exit(distributed_utils.launch_local(args.local, get_worker_command(sys.argv[1:]), args.port, args.threads))
+
+    if args.threads is not None:
+        experiment_scheduler.set_thread_limit(args.threads)
+    strategy = distributed_utils.get_strategy(args.hosts, args.index)
+
+    builderArgs = {k: v for k, v in [("blockType", args.block_type), ("checkpointPolicy", args.recompute)] if v is not None} or None
+    model, history = distributed_utils.fit_distributed(strategy, args.framework, HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES,
+        args.epochs, args.batch_size, args.fold, args.optimizer, args.lr, builderArgs=builderArgs,
+        checkpointPeriod=args.checkpoint_period)
+
+    if distributed_utils.is_chief():
+        model = distributed_utils.get_local_model(model, args.framework, HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES, builderArgs)
+        x_test, y_test, names_test = hio.load_data('test', args.fold)
+        session = eval_utils.EvaluationSession(x_test, y_test, names_test)
+        session.predict(model)
+        [fpr, tpr, auc, trainEval, testEval] = session.evaluate(history, args.framework, args.framework)
+        session.save_metrics(args.framework, [0.3, 0.5, 0.7])
+        model_registry.get_registry().save(model, args.framework, HEIGHT, WIDTH, NUMBER_OF_CHANNELS, NUMBER_OF_CLASSES,
+            builderArgs, metrics=dict(testEval, auc=auc))
+
+    artifact_writer.close_writer()
+    train_utils.save_profile(distributed_utils.get_worker_folder(args.framework, args.index))